@@ -55,6 +55,11 @@ if __name__ == "__main__":
                 container_name='cleanup',
                 docker_run_args=f'--env PGHOST="{pg_host}"',
             ),
+            Worker(
+                envvar='EC2_CLEANUP',
+                container_name='compact',
+                docker_run_args=f'--env PGHOST="{pg_host}"',
+            ),
             Worker(
                 envvar='EC2_PROCESSOR1',
                 container_name='process',
@@ -6,6 +6,7 @@ docker build -t divisordb -f docker/divisordb.Dockerfile .
 docker build -t generate -f docker/generate.Dockerfile .
 docker build -t process -f docker/process.Dockerfile .
 docker build -t cleanup -f docker/cleanup.Dockerfile .
+docker build -t compact -f docker/compact.Dockerfile .
 
 docker run -d --name divisordb -p 5432:5432 --memory="1G" divisordb:latest
 
@@ -15,6 +16,7 @@ export PGHOST=$(docker inspect -f "{{ .NetworkSettings.IPAddress }}" divisordb)
 sleep 5
 docker run -d --name generate --env PGHOST="$PGHOST" --memory="1G" generate:latest
 docker run -d --name cleanup --env PGHOST="$PGHOST" --memory="1G" cleanup:latest
+docker run -d --name compact --env PGHOST="$PGHOST" --memory="1G" compact:latest
 sleep 5
 docker run -d --name process --env PGHOST="$PGHOST" process:latest
 
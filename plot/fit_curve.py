@@ -1,6 +1,9 @@
-import vaex
+from riemann.fitting import MODELS
+from riemann.fitting import crossing
+from riemann.fitting import evaluate
+from riemann.fitting import fit
+from riemann.fitting import points_below_max
 import numpy as np
-from scipy.optimize import curve_fit
 import matplotlib.pyplot as plt
 
 if __name__ == "__main__":
@@ -9,7 +12,8 @@ if __name__ == "__main__":
     parser.add_argument(
         '--divisor_sums_csv_path',
         type=str,
-        help='The csv file containing divisor sum data'
+        help='The csv file of cumulative max witness values, e.g., written '
+             'by riemann.cumulative_max'
     )
     parser.add_argument(
         '--fit_log',
@@ -18,54 +22,34 @@ if __name__ == "__main__":
         help='Whether to fit to a reciprocal or a log, default is reciprocal'
     )
     args = parser.parse_args()
-    df = vaex.from_csv(args.divisor_sums_csv_path)
+    (log_n, _, cumulative_max) = np.loadtxt(
+        args.divisor_sums_csv_path, delimiter=',', skiprows=1,
+        usecols=(0, 1, 2), unpack=True)
 
-    pts = list(
-        zip(df['log_n'].values, df['cumulative_max_witness_value'].values))
-    max_pt = pts[-1]
-    pts = [(x, y) for (x, y) in pts if y < max_pt[1]]
-
-    x, y = zip(*pts)
+    x, y = points_below_max(log_n, cumulative_max)
+    model = MODELS['log_log' if args.fit_log else 'reciprocal']
+    params = fit(model, x, y)
 
     if args.fit_log:
-        def func(x, a, b):
-            return a + b * np.log(np.log(x))
-        guess = np.array([1, 1])
-    else:
-        def func(x, a, b):  # type: ignore
-            return a + b / x
-        guess = np.array([1, 1])
-
-    params, cov = curve_fit(func, x, y, guess)
-
-    if args.fit_log:
-        for x in range(600, 1000000):
-            if func(x, *params) > 1.782:
-                print(x)
-                break
+        passing = crossing(model, params, 1.782)
+        if passing is not None:
+            print(passing)
         else:
-            print(f"Didn't find a passing value! Largest was {func(x, *params):.8f}")
+            print("Didn't find a passing value!")
     else:
         print(params[0])
 
     print(params)
-    print(cov)
-
-    df['regression_line'] = df.apply(
-        lambda x: func(x, *params), [df.log_n])
 
-    df.viz.scatter(
-        df.log_n,
-        df.cumulative_max_witness_value,
-        ylabel='witness_value',
-        xlabel='$\log(n)$',
+    plt.scatter(
+        log_n,
+        cumulative_max,
         c="red",
         alpha=0.5,
         s=4,
     )
-    plt.plot(
-        df.log_n.values,
-        df.regression_line.values,
-    )
+    plt.plot(log_n, evaluate(model, params, log_n))
+    plt.ylabel('witness_value')
+    plt.xlabel('$\log(n)$')
 
     plt.show()
@@ -1,5 +1,37 @@
-import vaex
 import matplotlib.pyplot as plt
+import numpy as np
+
+
+def plot_artifacts(path):
+    '''Plot the artifacts written by riemann.downsample.'''
+    artifacts = np.load(path)
+    plt.pcolormesh(
+        artifacts['histogram_log_n_edges'],
+        artifacts['histogram_witness_value_edges'],
+        artifacts['histogram'].T,
+        cmap='coolwarm',
+    )
+    plt.ylabel('witness_value')
+    plt.xlabel('$\log(n)$')
+    plt.show()
+    plt.clf()
+
+    edges = artifacts['min_max_edges']
+    centers = (edges[:-1] + edges[1:]) / 2
+    plt.fill_between(
+        centers,
+        artifacts['min_witness_value'],
+        artifacts['max_witness_value'],
+        alpha=0.5,
+    )
+    plt.plot(
+        artifacts['cumulative_max_log_n'],
+        artifacts['cumulative_max_witness_value'],
+        c="red",
+    )
+    plt.ylabel('witness_value')
+    plt.xlabel('$\log(n)$')
+    plt.show()
 
 
 if __name__ == "__main__":
@@ -15,8 +47,18 @@ if __name__ == "__main__":
         type=str,
         help='The hdf5 file containing divisor sum data'
     )
+    parser.add_argument(
+        '--plot_artifacts_path',
+        type=str,
+        help='The npz file written by riemann.downsample'
+    )
     args = parser.parse_args()
 
+    if args.plot_artifacts_path:
+        plot_artifacts(args.plot_artifacts_path)
+        raise SystemExit
+
+    import vaex
     if args.divisor_sums_csv_path:
         df = vaex.from_csv(args.divisor_sums_csv_path)
     else:
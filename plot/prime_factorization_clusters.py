@@ -1,6 +1,10 @@
 from bokeh.models import HoverTool, ColumnDataSource, LinearColorMapper
 from bokeh.palettes import Spectral10
 from bokeh.plotting import figure, output_file, save
+from riemann.columnar_store import load_exponent_matrix
+from riemann.feature_cache import FeatureCache
+from scipy.sparse import csr_matrix
+from scipy.sparse import hstack
 from sklearn.preprocessing import StandardScaler
 import matplotlib.pyplot as plt
 import numpy as np
@@ -8,17 +12,46 @@ import os.path
 import pandas as pd
 import umap
 
+HOVER_PRIMES = [2, 3, 5, 7, 11, 13]
+
 
 def hover_data(df):
-    data = []
     cols_to_use = ['num_prime_factors',
-                   'num_distinct_prime_factors', '2', '3', '5', '7', '11', '13']
+                   'num_distinct_prime_factors'] + [str(p) for p in HOVER_PRIMES]
+    return df[cols_to_use].applymap("{:.3f}".format).agg(','.join, axis=1)
+
+
+def load_columnar_features(columnar_store_dir, min_witness_value):
+    '''
+    Load the features of the stored exponent matrix: the exponents of each
+    prime as a fraction of the number of prime factors, as a sparse matrix,
+    and a dataframe of the witness values and summary features.
+    '''
+    matrix = load_exponent_matrix(
+        columnar_store_dir, min_witness_value=min_witness_value)
+    num_prime_factors = matrix.num_prime_factors()
+    fractions = csr_matrix(
+        (matrix.data / num_prime_factors[matrix.row_ids()],
+         matrix.indices, matrix.indptr),
+        shape=(len(matrix), matrix.column_count()))
 
-    for index, row in df.iterrows():
-        data.append(','.join(["{:.3f}".format(row[col])
-                              for col in cols_to_use]))
+    df = pd.DataFrame(dict(
+        log_n=matrix.log_n,
+        witness_value=StandardScaler().fit_transform(
+            matrix.witness_value.reshape(-1, 1))[:, 0],
+        num_prime_factors=num_prime_factors,
+        num_distinct_prime_factors=matrix.num_distinct_prime_factors(),
+    ))
+    dense = fractions[:, :len(HOVER_PRIMES)].toarray()
+    for (i, p) in enumerate(HOVER_PRIMES):
+        df[str(p)] = dense[:, i] if i < dense.shape[1] else 0.0
 
-    return data
+    features = hstack([
+        csr_matrix(df[['witness_value', 'num_prime_factors',
+                       'num_distinct_prime_factors']].values),
+        fractions,
+    ]).tocsr()
+    return (features, df)
 
 
 if __name__ == "__main__":
@@ -29,44 +62,93 @@ if __name__ == "__main__":
         type=str,
         help='The csv file containing divisor sum data'
     )
+    parser.add_argument(
+        '--columnar_store_dir',
+        type=str,
+        help='If set, read the exponents from this columnar store instead'
+    )
     parser.add_argument(
         '--embedding_path',
         type=str,
         default='embedding.npy',
-        help='The file containing a precomputed embedding'
+        help='The file containing a precomputed embedding, which a computed '
+             'embedding is saved to'
+    )
+    parser.add_argument(
+        '--min_witness_value',
+        type=float,
+        default=1.69,
+        help='Embed only divisor sums with at least this witness value'
+    )
+    parser.add_argument(
+        '--n_neighbors',
+        type=int,
+        default=15,
+        help='The UMAP n_neighbors parameter'
+    )
+    parser.add_argument(
+        '--min_dist',
+        type=float,
+        default=0.1,
+        help='The UMAP min_dist parameter'
+    )
+    parser.add_argument(
+        '--cache_dir',
+        type=str,
+        default='data/feature_cache',
+        help='The directory to cache embeddings in, keyed by their inputs'
+    )
+    parser.add_argument(
+        '--cache_max_gb',
+        type=float,
+        default=10,
+        help='The size of the cache, beyond which old embeddings are evicted'
     )
     args = parser.parse_args()
-    df = pd.read_csv(args.divisor_sums_csv_path)
-    df = df.loc[df['witness_value'] >= 1.69]
-    df[['witness_value']] = StandardScaler().fit_transform(df[['witness_value']])
-
-    # extra features, and normalizing each prime factor column
-    prime_cols = cols = list(df)[2:]
-    df['num_prime_factors'] = df[prime_cols].sum(axis=1)
-    df['num_distinct_prime_factors'] = df[prime_cols].astype(bool).sum(axis=1)
-    for col in prime_cols:
-        df[col] = df[col] / df['num_prime_factors']
-
-    # to normalize all columns, use this instead of the previous line
-    # df[df.columns.values.tolist()] = StandardScaler().fit_transform(df[df.columns.values.tolist()])
+    if args.columnar_store_dir:
+        (features, df) = load_columnar_features(
+            args.columnar_store_dir, args.min_witness_value)
+    else:
+        df = pd.read_csv(args.divisor_sums_csv_path)
+        df = df.loc[df['witness_value'] >= args.min_witness_value]
+        df[['witness_value']] = StandardScaler().fit_transform(df[['witness_value']])
+
+        # extra features, and normalizing each prime factor column
+        prime_cols = cols = list(df)[2:]
+        df['num_prime_factors'] = df[prime_cols].sum(axis=1)
+        df['num_distinct_prime_factors'] = df[prime_cols].astype(bool).sum(axis=1)
+        for col in prime_cols:
+            df[col] = df[col] / df['num_prime_factors']
+
+        # to normalize all columns, use this instead of the previous line
+        # df[df.columns.values.tolist()] = StandardScaler().fit_transform(df[df.columns.values.tolist()])
+        features = df.drop('log_n', axis=1)
+        features = features.loc[:, (features != 0).any(axis=0)].values
     print(df.describe())
 
     if os.path.isfile(args.embedding_path):
         print("Loading pre-existing embedding")
         embedding = np.load(args.embedding_path)
     else:
-        df = df.drop('log_n', axis=1)
-        df = df.loc[:, (df != 0).any(axis=0)]
-        reducer = umap.UMAP()
-        embedding = reducer.fit_transform(df.values)
+        umap_params = dict(n_neighbors=args.n_neighbors, min_dist=args.min_dist)
+        cache = FeatureCache(
+            args.cache_dir, max_bytes=int(args.cache_max_gb * 2**30))
+        inputs = ([features.data, features.indices, features.indptr]
+                  if args.columnar_store_dir else [features])
+        embedding = cache.get_or_compute(
+            lambda: umap.UMAP(**umap_params).fit_transform(features),
+            inputs,
+            min_witness_value=args.min_witness_value,
+            normalization='fraction_of_prime_factors',
+            umap=umap_params)
         print(embedding.shape)
         print(f"Saving to {args.embedding_path}")
         np.save(args.embedding_path, embedding)
 
     embedding_df = pd.DataFrame(embedding, columns=('x', 'y'))
-    embedding_df['witness_value'] = df['witness_value']
+    embedding_df['witness_value'] = df['witness_value'].values
     print("starting historgramming")
-    embedding_df['hover'] = hover_data(df)
+    embedding_df['hover'] = hover_data(df).values
 
     output_file(filename="umap_viz.html",
                 title="UMAP visualization of witness values")
@@ -0,0 +1,367 @@
+'''
+A node-local agent that multiplexes many worker processes onto a single
+database connection.
+
+The agent claims search blocks in batches on behalf of its local workers, and
+buffers their finished blocks so they can be written in a single transaction.
+Workers reach the agent over a Unix socket using a multiprocessing manager,
+and see it as an ordinary DivisorDb.
+'''
+from collections import defaultdict
+from collections import deque
+from datetime import datetime
+from datetime import timedelta
+from multiprocessing.managers import BaseManager
+from typing import Callable
+from typing import Deque
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+import os
+import threading
+import time
+
+from riemann.database import DivisorDb
+from riemann.storage_policy import StoragePolicy
+from riemann.types import ArchivedSearchRange
+from riemann.types import LevelStats
+from riemann.types import RiemannDivisorSum
+from riemann.types import SearchIndex
+from riemann.types import SearchMetadata
+from riemann.types import SummaryStats
+
+DEFAULT_ADDRESS = '/tmp/riemann_divisor_agent.sock'
+DEFAULT_AUTHKEY = 'riemann'
+
+
+class BatchingDivisorDb(DivisorDb):
+    '''
+    A DivisorDb that batches claims and finishes against another DivisorDb.
+
+    Claimed blocks are prefetched claim_batch_size at a time, so their
+    start_time is set when the batch is claimed rather than when a worker
+    picks them up. Keep claim_batch_size near the number of local workers so
+    prefetched blocks are not mistaken for stale blocks.
+
+    Finished blocks are buffered until finish_batch_size of them are pending
+    or flush_period_seconds have passed since the last flush. If writing them
+    fails, e.g., because the connection was lost, they stay buffered, the
+    connection is replaced by calling reconnect, if given, and the write is
+    retried with a backoff of up to max_backoff_seconds. If the agent dies
+    with finished blocks pending, those blocks remain IN_PROGRESS and are
+    eventually marked stale and recomputed.
+    '''
+
+    def __init__(self,
+                 divisorDb: DivisorDb,
+                 claim_batch_size: int = 16,
+                 finish_batch_size: int = 16,
+                 flush_period_seconds: float = 30,
+                 reconnect: Optional[Callable[[], DivisorDb]] = None,
+                 max_backoff_seconds: float = 60):
+        self.divisorDb = divisorDb
+        self.claim_batch_size = claim_batch_size
+        self.finish_batch_size = finish_batch_size
+        self.flush_period_seconds = flush_period_seconds
+        self.reconnect = reconnect
+        self.max_backoff_seconds = max_backoff_seconds
+        self.lock = threading.RLock()
+        self.claimed: Dict[str, Deque[SearchMetadata]] = defaultdict(deque)
+        self.finished: List[Tuple[SearchMetadata, List[RiemannDivisorSum]]] = []
+        self.last_flush_time = time.monotonic()
+        # after a failed flush, the time before which flushes are not retried
+        self.backoff_seconds = 0.0
+        self.retry_time = 0.0
+
+    def initialize_schema(self):
+        self.divisorDb.initialize_schema()
+
+    def load(self) -> Iterable[RiemannDivisorSum]:
+        with self.lock:
+            self.flush()
+            return list(self.divisorDb.load())
+
+    def load_metadata(self) -> List[SearchMetadata]:
+        with self.lock:
+            self.flush()
+            return self.divisorDb.load_metadata()
+
+    def load_finished_search_blocks(
+            self,
+            search_index_type: str,
+            count: int) -> List[SearchMetadata]:
+        with self.lock:
+            self.flush()
+            return self.divisorDb.load_finished_search_blocks(
+                search_index_type, count)
+
+    def summarize(self) -> SummaryStats:
+        with self.lock:
+            self.flush()
+            return self.divisorDb.summarize()
+
+    def load_witness_records(self) -> List[RiemannDivisorSum]:
+        with self.lock:
+            self.flush()
+            return self.divisorDb.load_witness_records()
+
+    def load_top_witness_values(
+            self,
+            count: int,
+            level: Optional[int] = None) -> List[RiemannDivisorSum]:
+        with self.lock:
+            self.flush()
+            return self.divisorDb.load_top_witness_values(count, level)
+
+    def load_log_n_range(
+            self,
+            min_log_n: float,
+            max_log_n: float) -> List[RiemannDivisorSum]:
+        with self.lock:
+            self.flush()
+            return self.divisorDb.load_log_n_range(min_log_n, max_log_n)
+
+    def load_above_witness_value(
+            self, min_witness_value: float) -> List[RiemannDivisorSum]:
+        with self.lock:
+            self.flush()
+            return self.divisorDb.load_above_witness_value(min_witness_value)
+
+    def load_level_stats(self, search_index_type: str) -> List[LevelStats]:
+        with self.lock:
+            self.flush()
+            return self.divisorDb.load_level_stats(search_index_type)
+
+    def max_divisor_sum_id(self) -> int:
+        with self.lock:
+            self.flush()
+            return self.divisorDb.max_divisor_sum_id()
+
+    def load_log_n_and_witness_values(
+            self,
+            after_id: int,
+            through_id: int) -> List[Tuple[float, float]]:
+        with self.lock:
+            self.flush()
+            return self.divisorDb.load_log_n_and_witness_values(
+                after_id, through_id)
+
+    def get_storage_policy(self) -> StoragePolicy:
+        return self.divisorDb.get_storage_policy()
+
+    def insert_search_blocks(
+            self,
+            blocks: List[SearchMetadata],
+            next_search_index: Optional[SearchIndex] = None) -> None:
+        with self.lock:
+            self.divisorDb.insert_search_blocks(blocks, next_search_index)
+
+    def load_next_search_index(
+            self, search_index_type: str) -> Optional[SearchIndex]:
+        with self.lock:
+            return self.divisorDb.load_next_search_index(search_index_type)
+
+    def count_eligible_search_blocks(self, search_index_type: str) -> int:
+        with self.lock:
+            return self.divisorDb.count_eligible_search_blocks(search_index_type)
+
+    def claim_next_search_block(self, search_index_type: str) -> SearchMetadata:
+        with self.lock:
+            claimed = self.claimed[search_index_type]
+            if not claimed:
+                self.flush()
+                claimed.extend(self.divisorDb.claim_next_search_blocks(
+                    search_index_type, self.claim_batch_size))
+            return claimed.popleft()
+
+    def claim_speculative_search_block(
+            self,
+            search_index_type: str,
+            running_for: timedelta,
+            max_copies: int = 1) -> SearchMetadata:
+        with self.lock:
+            self.flush()
+            return self.divisorDb.claim_speculative_search_block(
+                search_index_type, running_for, max_copies)
+
+    def finish_search_block(self,
+                            metadata: SearchMetadata,
+                            divisor_sums: List[RiemannDivisorSum]) -> None:
+        with self.lock:
+            self.finished.append((metadata, divisor_sums))
+            if (len(self.finished) >= self.finish_batch_size
+                    or self.seconds_since_last_flush() >= self.flush_period_seconds):
+                # the block is buffered either way, so the worker moves on
+                self.flush_with_backoff()
+
+    def compact_finished_search_blocks(
+            self,
+            search_index_type: str,
+            finished_before: datetime,
+            max_blocks: int = 10000) -> int:
+        with self.lock:
+            self.flush()
+            return self.divisorDb.compact_finished_search_blocks(
+                search_index_type, finished_before, max_blocks)
+
+    def load_archived_search_ranges(
+            self, search_index_type: str) -> List[ArchivedSearchRange]:
+        with self.lock:
+            self.flush()
+            return self.divisorDb.load_archived_search_ranges(search_index_type)
+
+    def renew_claim(self, metadata: SearchMetadata) -> SearchMetadata:
+        with self.lock:
+            return self.divisorDb.renew_claim(metadata)
+
+    def mark_block_as_failed(self, metadata: SearchMetadata) -> None:
+        with self.lock:
+            self.divisorDb.mark_block_as_failed(metadata)
+
+    def seconds_since_last_flush(self) -> float:
+        return time.monotonic() - self.last_flush_time
+
+    def flush(self) -> None:
+        '''
+        Write all buffered finished blocks to the underlying database.
+
+        Blocks the database rejects, e.g., because they were marked stale in
+        the meantime, are reported and dropped, since the worker that computed
+        them has already moved on. If the write fails for any other reason,
+        the blocks are buffered again, the connection is replaced, and the
+        error is raised.
+        '''
+        with self.lock:
+            finished, self.finished = self.finished, []
+            self.last_flush_time = time.monotonic()
+            if not finished:
+                return
+            try:
+                self.divisorDb.finish_search_blocks(finished)
+            except ValueError as e:
+                print(f"Dropped rejected finished blocks: {e}")
+            except Exception:
+                self.finished = finished + self.finished
+                self.replace_connection()
+                raise
+
+    def flush_with_backoff(self) -> None:
+        '''
+        Flush, unless a flush failed less than the current backoff ago. A
+        failure is reported rather than raised, and doubles the backoff.
+        '''
+        with self.lock:
+            if time.monotonic() < self.retry_time:
+                return
+            try:
+                self.flush()
+                self.backoff_seconds = 0
+            except Exception as e:
+                self.backoff_seconds = min(
+                    self.max_backoff_seconds, max(1, 2 * self.backoff_seconds))
+                self.retry_time = time.monotonic() + self.backoff_seconds
+                print(f"Failed to write {len(self.finished)} finished blocks, "
+                      f"retrying in {self.backoff_seconds}s: {e}")
+
+    def replace_connection(self) -> None:
+        '''Replace the underlying database with a new connection, if possible.'''
+        if self.reconnect is None:
+            return
+        try:
+            self.divisorDb = self.reconnect()
+        except Exception as e:
+            print(f"Failed to reconnect: {e}")
+
+
+class DivisorDbManager(BaseManager):
+    pass
+
+
+def serve(divisorDb: BatchingDivisorDb,
+          address: str = DEFAULT_ADDRESS,
+          authkey: str = DEFAULT_AUTHKEY) -> None:
+    '''Serve divisorDb to local workers until the process is killed.'''
+    if os.path.exists(address):
+        os.remove(address)
+
+    def flush_periodically():
+        while True:
+            time.sleep(divisorDb.flush_period_seconds)
+            # an error must not end the thread, or nothing is written again
+            try:
+                if divisorDb.seconds_since_last_flush() >= divisorDb.flush_period_seconds:
+                    divisorDb.flush_with_backoff()
+            except Exception as e:
+                print(f"Periodic flush failed: {e}")
+
+    threading.Thread(target=flush_periodically, daemon=True).start()
+
+    DivisorDbManager.register('divisor_db', callable=lambda: divisorDb)
+    manager = DivisorDbManager(address=address, authkey=bytes(authkey, 'utf-8'))
+    manager.get_server().serve_forever()
+
+
+def connect(address: str = DEFAULT_ADDRESS,
+            authkey: str = DEFAULT_AUTHKEY) -> DivisorDb:
+    '''Connect to a running agent, returning a proxy for its DivisorDb.'''
+    DivisorDbManager.register('divisor_db')
+    manager = DivisorDbManager(address=address, authkey=bytes(authkey, 'utf-8'))
+    manager.connect()
+    return manager.divisor_db()  # type: ignore
+
+
+if __name__ == "__main__":
+    import argparse
+    from riemann.postgres_database import PostgresDivisorDb
+    from riemann.sqlite_database import SqliteDivisorDb
+    from riemann.storage_policy import storage_policy_from_spec
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_source_name', type=str,
+                        help='The psycopg data_source_name string')
+    parser.add_argument('--sqlite_path', type=str,
+                        help='If set, use the sqlite database in this file '
+                             'instead of postgres')
+    parser.add_argument('--address', type=str, default=DEFAULT_ADDRESS,
+                        help='The Unix socket path to serve workers on')
+    parser.add_argument('--authkey', type=str, default=DEFAULT_AUTHKEY,
+                        help='The key workers use to authenticate')
+    parser.add_argument('--claim_batch_size', type=int, default=16,
+                        help='The number of blocks to claim at a time')
+    parser.add_argument('--finish_batch_size', type=int, default=16,
+                        help='The number of finished blocks to write at a time')
+    parser.add_argument('--flush_period_seconds', type=float, default=30,
+                        help='The longest time a finished block is buffered')
+    parser.add_argument('--max_backoff_seconds', type=float, default=60,
+                        help='The longest time to wait before retrying a '
+                             'failed write of finished blocks')
+    parser.add_argument('--storage_policy', type=str,
+                        help='If set, the policy deciding which divisor sums '
+                             'are stored, one of fixed:<witness value>, '
+                             'record_delta:<delta> or top_k_per_level:<k>')
+
+    args = parser.parse_args()
+
+    def open_database() -> DivisorDb:
+        db: DivisorDb
+        if args.sqlite_path:
+            db = SqliteDivisorDb(args.sqlite_path)
+        else:
+            db = PostgresDivisorDb(data_source_name=args.data_source_name)
+        if args.storage_policy:
+            db.storage_policy = storage_policy_from_spec(args.storage_policy)
+        return db
+
+    serve(
+        BatchingDivisorDb(
+            open_database(),
+            claim_batch_size=args.claim_batch_size,
+            finish_batch_size=args.finish_batch_size,
+            flush_period_seconds=args.flush_period_seconds,
+            reconnect=open_database,
+            max_backoff_seconds=args.max_backoff_seconds,
+        ),
+        address=args.address,
+        authkey=args.authkey,
+    )
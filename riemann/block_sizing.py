@@ -0,0 +1,173 @@
+'''
+Size superabundant search blocks so that each takes roughly a target
+wall-clock duration to process.
+
+The cost of processing a single search index grows with its level, so a fixed
+block size yields blocks that take longer and longer as the search advances.
+Instead, the cost per index at each level is measured from the compute time
+recorded in the level statistics, and extrapolated to levels that have not
+been measured yet. The wall-clock time of recently finished blocks beyond
+their compute time, e.g., claiming, prefetching and finishing them, is
+measured as a fixed overhead per block.
+'''
+from dataclasses import dataclass
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+import math
+import statistics
+
+from riemann.search_strategy import SuperabundantSearchStrategy
+from riemann.types import LevelStats
+from riemann.types import SearchMetadata
+from riemann.types import SuperabundantEnumerationIndex
+
+
+@dataclass(frozen=True)
+class BlockCostModel:
+    '''
+    The measured seconds needed to process one search index, per level, and
+    the seconds each block takes beyond that.
+    '''
+    seconds_per_index: Dict[int, float]
+    block_overhead_seconds: float = 0
+
+    def estimate(self, level: int) -> Optional[float]:
+        '''
+        Estimate the seconds per index at a level, or None if nothing has been
+        measured. Unmeasured levels are extrapolated by fitting
+        log(seconds_per_index) as a linear function of the level.
+        '''
+        if level in self.seconds_per_index:
+            return self.seconds_per_index[level]
+        if not self.seconds_per_index:
+            return None
+
+        levels = list(self.seconds_per_index.keys())
+        if len(levels) == 1:
+            return self.seconds_per_index[levels[0]]
+
+        log_costs = [math.log(self.seconds_per_index[x]) for x in levels]
+        mean_level = sum(levels) / len(levels)
+        mean_log_cost = sum(log_costs) / len(log_costs)
+        variance = sum((x - mean_level)**2 for x in levels)
+        slope = sum(
+            (x - mean_level) * (y - mean_log_cost)
+            for (x, y) in zip(levels, log_costs)
+        ) / variance
+        # the cost per index never decreases with the level
+        slope = max(slope, 0)
+        return math.exp(mean_log_cost + slope * (level - mean_level))
+
+
+def fit_cost_model(
+        level_stats: Iterable[LevelStats],
+        finished_blocks: Iterable[SearchMetadata[SuperabundantEnumerationIndex]] = ()
+) -> BlockCostModel:
+    '''
+    Fit the cost per index at each level from the compute seconds of the
+    level statistics, and the overhead per block as the median of the
+    wall-clock seconds of finished blocks beyond their estimated compute
+    time. Blocks that span more than one level, or whose level has not been
+    measured, are ignored.
+    '''
+    seconds_per_index = {
+        stats.level: stats.seconds / stats.count
+        for stats in level_stats
+        if stats.count > 0 and stats.seconds > 0
+    }
+
+    overheads = []
+    for block in finished_blocks:
+        start = block.starting_search_index
+        end = block.ending_search_index
+        if (block.start_time is None or block.end_time is None
+                or start.level != end.level
+                or start.level not in seconds_per_index):
+            continue
+        size = end.index_in_level - start.index_in_level + 1
+        overheads.append(
+            (block.end_time - block.start_time).total_seconds()
+            - size * seconds_per_index[start.level])
+
+    return BlockCostModel(
+        seconds_per_index=seconds_per_index,
+        block_overhead_seconds=(
+            max(0, statistics.median(overheads)) if overheads else 0))
+
+
+def choose_block_size(
+        seconds_per_index: float,
+        target_seconds: float,
+        remaining_in_level: int,
+        min_block_size: int,
+        max_block_size: int,
+        tail_fraction: float = 0.25,
+        next_seconds_per_index: Optional[float] = None,
+        block_overhead_seconds: float = 0) -> int:
+    '''
+    Choose a block size that takes about target_seconds, without straddling
+    a level boundary when that is cheaper.
+
+    A block that would reach past the end of the level can be cut at the
+    boundary, which costs one more block's overhead. A block that would
+    leave a tail smaller than tail_fraction of itself in the level can absorb
+    that tail, which costs the time it takes past target_seconds, and never
+    exceeds max_block_size. Otherwise, the block straddling the boundary,
+    sized at this level's cost, costs the time its indices at the next level
+    (costing next_seconds_per_index each) take past their estimate. Without
+    an estimate for the next level, blocks are kept within the level.
+    '''
+    size = round(target_seconds / seconds_per_index)
+    size = max(min_block_size, min(max_block_size, size))
+    if (remaining_in_level - size >= tail_fraction * size
+            or remaining_in_level > max_block_size):
+        return size
+    if next_seconds_per_index is None:
+        return remaining_in_level
+
+    extra_seconds_per_index = max(0, next_seconds_per_index - seconds_per_index)
+    if remaining_in_level <= size:
+        cut_seconds = block_overhead_seconds
+        straddle_seconds = (size - remaining_in_level) * extra_seconds_per_index
+    else:
+        # the next block straddles the boundary, starting with the tail
+        tail = remaining_in_level - size
+        cut_seconds = tail * seconds_per_index
+        straddle_seconds = (size - tail) * extra_seconds_per_index
+    return remaining_in_level if cut_seconds <= straddle_seconds else size
+
+
+def generate_timed_search_blocks(
+        search_strategy: SuperabundantSearchStrategy,
+        count: int,
+        cost_model: BlockCostModel,
+        target_seconds: float,
+        default_block_size: int,
+        min_block_size: int,
+        max_block_size: int) -> List[SearchMetadata[SuperabundantEnumerationIndex]]:
+    '''
+    Generate search blocks sized for target_seconds according to cost_model.
+    Blocks at levels the model cannot estimate use default_block_size, cut at
+    the end of the level, so the level's cost can be measured.
+    '''
+    blocks = []
+    for i in range(count):
+        level = search_strategy.search_index().level
+        seconds_per_index = cost_model.estimate(level)
+        if seconds_per_index is None:
+            block_size = min(
+                default_block_size, search_strategy.remaining_in_level())
+        else:
+            block_size = choose_block_size(
+                seconds_per_index,
+                target_seconds,
+                search_strategy.remaining_in_level(),
+                min_block_size,
+                max_block_size,
+                next_seconds_per_index=cost_model.estimate(level + 1),
+                block_overhead_seconds=cost_model.block_overhead_seconds,
+            )
+        blocks.append(search_strategy.generate_next_block(block_size))
+    return blocks
@@ -9,6 +9,7 @@ import time
 
 from riemann.database import DivisorDb
 from riemann.postgres_database import PostgresDivisorDb
+from riemann.sqlite_database import SqliteDivisorDb
 from riemann.types import SearchBlockState
 from riemann.types import SearchMetadata
 
@@ -61,6 +62,11 @@ if __name__ == "__main__":
         type=str,
         help='The psycopg data_source_name string'
     )
+    parser.add_argument(
+        '--sqlite_path',
+        type=str,
+        help='If set, use the sqlite database in this file instead of postgres'
+    )
     parser.add_argument(
         '--refresh_period_seconds',
         type=int,
@@ -75,7 +81,11 @@ if __name__ == "__main__":
     )
 
     args = parser.parse_args()
-    db = PostgresDivisorDb(data_source_name=args.data_source_name)
+    db: DivisorDb
+    if args.sqlite_path:
+        db = SqliteDivisorDb(args.sqlite_path)
+    else:
+        db = PostgresDivisorDb(data_source_name=args.data_source_name)
     main(
         db,
         refresh_period_seconds=args.refresh_period_seconds,
@@ -0,0 +1,460 @@
+'''
+A columnar, append-only store of divisor sums for analysis jobs.
+
+Workers append the divisor sums of finished blocks to chunk files, one set of
+files per writer, so writers never contend. Each chunk stores a float64
+log_n column, a float64 witness value column, and the exponents of each n's
+prime factorization, packed as uint8 values with int64 row offsets. A small
+JSON index per chunk records the runs of rows at each level (the number of
+prime factors of n, counted with multiplicity) and the search blocks the rows
+came from. The index is written last, so readers only see complete chunks.
+
+An n is not fully factored over the stored primes if it has a prime factor
+larger than the largest of them, or an exponent too large for a uint8. The
+exponents column then holds only the part of its factorization that fits,
+and the index records the remaining cofactor and the divisor sum of the row,
+so the row can still be reconstructed exactly.
+
+Chunks are read with numpy.memmap, so scanning them does not copy the data
+into memory. The exponents can be loaded as a sparse matrix in CSR form, with
+a column per prime, for analyses of the factorizations.
+'''
+from dataclasses import dataclass
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+import json
+import os
+import shutil
+import socket
+
+from gmpy2 import is_prime
+from gmpy2 import log
+from gmpy2 import mpz
+from gmpy2 import remove
+from riemann.primes import primes
+from riemann.superabundant import prime_factor_count
+from riemann.superabundant import prime_factor_divisor_sum
+from riemann.types import RiemannDivisorSum
+from riemann.types import SearchMetadata
+from riemann.types import SummaryStats
+import numpy as np
+
+LOG_N_SUFFIX = '.log_n.f64'
+WITNESS_VALUE_SUFFIX = '.witness_value.f64'
+EXPONENT_OFFSETS_SUFFIX = '.exponent_offsets.i64'
+EXPONENTS_SUFFIX = '.exponents.u8'
+INDEX_SUFFIX = '.index.json'
+
+
+MAX_EXPONENT = 255
+
+
+def prime_exponents(n: int) -> Tuple[List[int], int]:
+    '''
+    Return the exponents of the first primes in the factorization of n,
+    stopping at the largest prime that divides n, and the cofactor of n left
+    over: its prime factors larger than the largest stored prime, and the
+    prime powers whose exponent is larger than MAX_EXPONENT, whose stored
+    exponent is 0.
+    '''
+    n = mpz(n)
+    cofactor = mpz(1)
+    exponents = []
+    for p in primes:
+        if n == 1:
+            break
+        n, exponent = remove(n, p)
+        if exponent > MAX_EXPONENT:
+            cofactor *= mpz(p)**exponent
+            exponent = 0
+        exponents.append(exponent)
+    while exponents and exponents[-1] == 0:
+        exponents.pop()
+    return (exponents, int(cofactor * n))
+
+
+def cofactor_level(cofactor: int) -> int:
+    '''The number of prime factors of a cofactor, with multiplicity.'''
+    # a large prime cofactor is common, and slow to count by trial division
+    return 1 if is_prime(cofactor) else prime_factor_count(cofactor)
+
+
+def level_runs(levels: List[int]) -> List[Tuple[int, int, int]]:
+    '''Group consecutive rows with the same level as (level, start, stop).'''
+    runs: List[Tuple[int, int, int]] = []
+    for (row, level) in enumerate(levels):
+        if runs and runs[-1][0] == level:
+            runs[-1] = (level, runs[-1][1], row + 1)
+        else:
+            runs.append((level, row, row + 1))
+    return runs
+
+
+class ColumnarStoreWriter:
+    '''
+    Buffers divisor sums and writes them as a new chunk once rows_per_chunk
+    rows are buffered, or when flushed.
+
+    Rows buffered when a worker dies are lost, but can be restored from the
+    database by rebuilding the store.
+    '''
+
+    def __init__(self,
+                 directory: str,
+                 writer_id: Optional[str] = None,
+                 rows_per_chunk: int = 1000000):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.writer_id = writer_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.rows_per_chunk = rows_per_chunk
+        self.next_chunk_number = len([
+            name for name in os.listdir(directory)
+            if name.startswith(f"{self.writer_id}-")
+            and name.endswith(INDEX_SUFFIX)
+        ])
+        self.clear()
+
+    def clear(self) -> None:
+        self.log_n: List[float] = []
+        self.witness_values: List[float] = []
+        self.exponent_offsets: List[int] = [0]
+        self.exponents: List[int] = []
+        self.levels: List[int] = []
+        self.blocks: List[Tuple[str, str, str, int, int]] = []
+        # the row, cofactor and divisor sum of rows not fully factored
+        self.cofactors: List[Tuple[int, str, str]] = []
+
+    def append(self,
+               divisor_sums: List[RiemannDivisorSum],
+               block: Optional[SearchMetadata] = None) -> None:
+        '''Append rows, optionally recording the block they came from.'''
+        start_row = len(self.log_n)
+        for divisor_sum in divisor_sums:
+            (exponents, cofactor) = prime_exponents(divisor_sum.n)
+            if cofactor != 1:
+                self.cofactors.append((
+                    len(self.log_n), str(cofactor),
+                    str(divisor_sum.divisor_sum)))
+            self.log_n.append(float(log(divisor_sum.n)))
+            self.witness_values.append(float(divisor_sum.witness_value))
+            self.exponents.extend(exponents)
+            self.exponent_offsets.append(len(self.exponents))
+            self.levels.append(sum(exponents) + cofactor_level(cofactor))
+
+        if block is not None:
+            self.blocks.append((
+                block.search_index_type,
+                block.starting_search_index.serialize(),
+                block.ending_search_index.serialize(),
+                start_row,
+                len(self.log_n),
+            ))
+
+        if len(self.log_n) >= self.rows_per_chunk:
+            self.flush()
+
+    def flush(self) -> None:
+        '''Write the buffered rows as a chunk.'''
+        if not self.log_n:
+            self.clear()
+            return
+
+        prefix = os.path.join(
+            self.directory,
+            f"{self.writer_id}-{self.next_chunk_number:06d}")
+        columns: List[Tuple[str, np.ndarray]] = [
+            (LOG_N_SUFFIX, np.array(self.log_n, dtype=np.float64)),
+            (WITNESS_VALUE_SUFFIX,
+             np.array(self.witness_values, dtype=np.float64)),
+            (EXPONENT_OFFSETS_SUFFIX,
+             np.array(self.exponent_offsets, dtype=np.int64)),
+            (EXPONENTS_SUFFIX, np.array(self.exponents, dtype=np.uint8)),
+        ]
+        for (suffix, column) in columns:
+            with open(prefix + suffix, 'wb') as outfile:
+                column.tofile(outfile)
+                outfile.flush()
+                os.fsync(outfile.fileno())
+
+        index = dict(
+            rows=len(self.log_n),
+            levels=level_runs(self.levels),
+            blocks=self.blocks,
+            cofactors=self.cofactors,
+            max_witness_value=max(self.witness_values),
+        )
+        tmp_path = prefix + INDEX_SUFFIX + '.tmp'
+        with open(tmp_path, 'w') as outfile:
+            json.dump(index, outfile)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(tmp_path, prefix + INDEX_SUFFIX)
+
+        self.next_chunk_number += 1
+        self.clear()
+
+
+def memmap_column(path: str, dtype) -> np.ndarray:
+    if os.path.getsize(path) == 0:
+        # numpy cannot memory-map an empty file
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+@dataclass(frozen=True)
+class ColumnarChunk:
+    log_n: np.ndarray
+    witness_value: np.ndarray
+    exponent_offsets: np.ndarray
+    exponents: np.ndarray
+    index: Dict
+
+    def __len__(self) -> int:
+        return self.index['rows']
+
+    def prime_exponents(self, row: int) -> np.ndarray:
+        return self.exponents[
+            self.exponent_offsets[row]:self.exponent_offsets[row + 1]]
+
+    def divisor_sum(self, row: int) -> RiemannDivisorSum:
+        '''Reconstruct the exact divisor sum stored in a row.'''
+        factorization = [
+            (primes[i], int(exponent))
+            for (i, exponent) in enumerate(self.prime_exponents(row))
+        ]
+        n = mpz(1)
+        for (p, exponent) in factorization:
+            n *= mpz(p)**exponent
+        divisor_sum = mpz(prime_factor_divisor_sum(factorization))
+        # chunks written before cofactors were recorded have none
+        for (cofactor_row, cofactor, stored_sum) in self.index.get(
+                'cofactors', []):
+            if cofactor_row == row:
+                n *= mpz(cofactor)
+                divisor_sum = mpz(stored_sum)
+        return RiemannDivisorSum(
+            n=n,
+            divisor_sum=divisor_sum,
+            witness_value=float(self.witness_value[row]))
+
+    def level_slices(self, level: int) -> List[slice]:
+        '''The row ranges at the given level.'''
+        return [
+            slice(start, stop)
+            for (run_level, start, stop) in self.index['levels']
+            if run_level == level
+        ]
+
+
+def load_chunk(prefix: str) -> ColumnarChunk:
+    with open(prefix + INDEX_SUFFIX) as infile:
+        index = json.load(infile)
+    return ColumnarChunk(
+        log_n=memmap_column(prefix + LOG_N_SUFFIX, np.float64),
+        witness_value=memmap_column(prefix + WITNESS_VALUE_SUFFIX, np.float64),
+        exponent_offsets=memmap_column(
+            prefix + EXPONENT_OFFSETS_SUFFIX, np.int64),
+        exponents=memmap_column(prefix + EXPONENTS_SUFFIX, np.uint8),
+        index=index,
+    )
+
+
+def load_chunks(directory: str) -> Iterable[ColumnarChunk]:
+    '''Load every complete chunk in the store, in name order.'''
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(INDEX_SUFFIX):
+            yield load_chunk(
+                os.path.join(directory, name[:-len(INDEX_SUFFIX)]))
+
+
+def load_level(directory: str, level: int) -> Tuple[np.ndarray, np.ndarray]:
+    '''Return the log_n and witness values of every row at a level.'''
+    log_n = []
+    witness_value = []
+    for chunk in load_chunks(directory):
+        for rows in chunk.level_slices(level):
+            log_n.append(chunk.log_n[rows])
+            witness_value.append(chunk.witness_value[rows])
+    if not log_n:
+        return (np.zeros(0), np.zeros(0))
+    return (np.concatenate(log_n), np.concatenate(witness_value))
+
+
+@dataclass(frozen=True)
+class ExponentMatrix:
+    '''
+    The prime factorizations of a set of rows, as a sparse matrix in CSR
+    form: the nonzero exponents of row i are data[indptr[i]:indptr[i+1]],
+    and are those of the primes[j] for j in indices[indptr[i]:indptr[i+1]].
+    The cofactors of rows that are not fully factored are left out.
+    '''
+    log_n: np.ndarray
+    witness_value: np.ndarray
+    indptr: np.ndarray
+    indices: np.ndarray
+    data: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.log_n)
+
+    def row_ids(self) -> np.ndarray:
+        '''The row of each nonzero exponent.'''
+        return np.repeat(np.arange(len(self)), np.diff(self.indptr))
+
+    def num_prime_factors(self) -> np.ndarray:
+        '''The number of prime factors of each row, with multiplicity.'''
+        return np.bincount(
+            self.row_ids(), weights=self.data, minlength=len(self)
+        ).astype(np.int64)
+
+    def num_distinct_prime_factors(self) -> np.ndarray:
+        return np.diff(self.indptr)
+
+    def column_count(self) -> int:
+        return int(self.indices.max()) + 1 if len(self.indices) else 0
+
+    def to_dense(self, columns: Optional[int] = None) -> np.ndarray:
+        '''The exponents of the first columns primes, as a dense matrix.'''
+        columns = self.column_count() if columns is None else columns
+        dense = np.zeros((len(self), columns), dtype=np.uint8)
+        inside = self.indices < columns
+        dense[self.row_ids()[inside], self.indices[inside]] = self.data[inside]
+        return dense
+
+
+def chunk_exponent_matrix(
+        chunk: ColumnarChunk, rows: np.ndarray) -> ExponentMatrix:
+    '''The exponent matrix of the rows of a chunk selected by a mask.'''
+    offsets = chunk.exponent_offsets
+    lengths = np.diff(offsets)
+    row_ids = np.repeat(np.arange(len(lengths)), lengths)
+    # the column of each exponent is its position in its row
+    columns = np.arange(len(chunk.exponents)) - offsets[row_ids]
+    keep = (chunk.exponents != 0) & rows[row_ids]
+    row_lengths = np.bincount(row_ids[keep], minlength=len(lengths))[rows]
+    indptr = np.zeros(len(row_lengths) + 1, dtype=np.int64)
+    np.cumsum(row_lengths, out=indptr[1:])
+    return ExponentMatrix(
+        log_n=np.asarray(chunk.log_n[rows]),
+        witness_value=np.asarray(chunk.witness_value[rows]),
+        indptr=indptr,
+        indices=columns[keep],
+        data=np.asarray(chunk.exponents[keep]),
+    )
+
+
+def load_exponent_matrix(
+        directory: str,
+        min_witness_value: Optional[float] = None) -> ExponentMatrix:
+    '''
+    Load the prime factorizations of every row in the store, optionally only
+    of those with at least min_witness_value, as an ExponentMatrix.
+    '''
+    matrices = []
+    for chunk in load_chunks(directory):
+        rows = np.ones(len(chunk), dtype=bool)
+        if min_witness_value is not None:
+            rows = np.asarray(chunk.witness_value >= min_witness_value)
+        matrices.append(chunk_exponent_matrix(chunk, rows))
+
+    if not matrices:
+        return ExponentMatrix(
+            log_n=np.zeros(0), witness_value=np.zeros(0),
+            indptr=np.zeros(1, dtype=np.int64),
+            indices=np.zeros(0, dtype=np.int64),
+            data=np.zeros(0, dtype=np.uint8))
+
+    indptr_offsets = np.cumsum([0] + [len(m.data) for m in matrices[:-1]])
+    return ExponentMatrix(
+        log_n=np.concatenate([m.log_n for m in matrices]),
+        witness_value=np.concatenate([m.witness_value for m in matrices]),
+        indptr=np.concatenate([np.zeros(1, dtype=np.int64)] + [
+            m.indptr[1:] + offset
+            for (m, offset) in zip(matrices, indptr_offsets)]),
+        indices=np.concatenate([m.indices for m in matrices]),
+        data=np.concatenate([m.data for m in matrices]),
+    )
+
+
+def summarize(directory: str) -> SummaryStats:
+    '''Compute the same summary as DivisorDb.summarize from the store.'''
+    largest_n: Optional[Tuple[float, ColumnarChunk, int]] = None
+    largest_witness: Optional[Tuple[float, ColumnarChunk, int]] = None
+    for chunk in load_chunks(directory):
+        if len(chunk) == 0:
+            continue
+        row = int(np.argmax(chunk.log_n))
+        if largest_n is None or chunk.log_n[row] > largest_n[0]:
+            largest_n = (chunk.log_n[row], chunk, row)
+        row = int(np.argmax(chunk.witness_value))
+        if (largest_witness is None
+                or chunk.witness_value[row] > largest_witness[0]):
+            largest_witness = (chunk.witness_value[row], chunk, row)
+
+    if largest_n is None or largest_witness is None:
+        raise ValueError("No data!")
+
+    return SummaryStats(
+        largest_computed_n=largest_n[1].divisor_sum(largest_n[2]),
+        largest_witness_value=largest_witness[1].divisor_sum(
+            largest_witness[2]))
+
+
+def rebuild(divisor_sums: Iterable[RiemannDivisorSum],
+            directory: str,
+            rows_per_chunk: int = 1000000,
+            batch_size: int = 10000) -> None:
+    '''
+    Write the divisor sums as a new store in directory, which must not
+    exist yet. The store is written next to it and moved into place once
+    complete, so an interrupted rebuild leaves no partial store behind.
+    '''
+    if os.path.exists(directory):
+        raise ValueError(f"Cannot rebuild into existing {directory}")
+    partial_directory = directory + '.partial'
+    if os.path.exists(partial_directory):
+        shutil.rmtree(partial_directory)
+
+    writer = ColumnarStoreWriter(
+        partial_directory, writer_id='rebuild', rows_per_chunk=rows_per_chunk)
+    batch = []
+    for divisor_sum in divisor_sums:
+        batch.append(divisor_sum)
+        if len(batch) >= batch_size:
+            writer.append(batch)
+            batch = []
+    writer.append(batch)
+    writer.flush()
+    os.rename(partial_directory, directory)
+
+
+if __name__ == "__main__":
+    import argparse
+    from riemann.database import DivisorDb
+    from riemann.postgres_database import PostgresDivisorDb
+    from riemann.sqlite_database import SqliteDivisorDb
+    parser = argparse.ArgumentParser(
+        description='Rebuild a columnar store from the divisor sums table')
+    parser.add_argument('--data_source_name', type=str,
+                        help='The psycopg data_source_name string')
+    parser.add_argument('--sqlite_path', type=str,
+                        help='If set, use the sqlite database in this file '
+                             'instead of postgres')
+    parser.add_argument('--columnar_store_dir', type=str, required=True,
+                        help='The new directory to write chunks to, which '
+                             'must not exist yet')
+    parser.add_argument('--rows_per_chunk', type=int, default=1000000,
+                        help='The number of rows in each chunk')
+
+    args = parser.parse_args()
+    db: DivisorDb
+    if args.sqlite_path:
+        db = SqliteDivisorDb(args.sqlite_path)
+    else:
+        db = PostgresDivisorDb(data_source_name=args.data_source_name)
+
+    rebuild(db.load(), args.columnar_store_dir,
+            rows_per_chunk=args.rows_per_chunk)
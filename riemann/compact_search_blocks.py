@@ -0,0 +1,107 @@
+'''
+A job that repeatedly moves long-finished search blocks out of the search
+blocks table and into an archive of contiguous ranges, so the table only holds
+active and recently finished blocks.
+'''
+
+from datetime import datetime
+from datetime import timedelta
+import time
+
+from riemann.database import DivisorDb
+from riemann.postgres_database import PostgresDivisorDb
+from riemann.sqlite_database import SqliteDivisorDb
+
+
+def compact(divisorDb: DivisorDb,
+            search_index_type: str,
+            archive_after: timedelta,
+            max_blocks: int) -> int:
+    '''
+    Archive every block that finished more than archive_after ago, in
+    transactions of at most max_blocks blocks. Returns the number archived.
+    '''
+    finished_before = datetime.now() - archive_after
+    total = 0
+    while True:
+        count = divisorDb.compact_finished_search_blocks(
+            search_index_type, finished_before, max_blocks)
+        total += count
+        if count < max_blocks:
+            return total
+
+
+def main(divisorDb: DivisorDb,
+         search_index_type: str,
+         refresh_period_seconds: int,
+         archive_after: timedelta,
+         max_blocks: int) -> None:
+    failure_count = 0
+    while True:
+        try:
+            count = compact(
+                divisorDb, search_index_type, archive_after, max_blocks)
+            print(f"Archived {count} finished search blocks")
+            failure_count = 0
+        except ValueError as e:
+            print(f"Failed with error: {e}")
+            failure_count += 1
+            if failure_count > 7:
+                print(f"Failed {failure_count} times, quitting.")
+                raise e
+
+        time.sleep(refresh_period_seconds)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--data_source_name',
+        type=str,
+        help='The psycopg data_source_name string'
+    )
+    parser.add_argument(
+        '--sqlite_path',
+        type=str,
+        help='If set, use the sqlite database in this file instead of postgres'
+    )
+    parser.add_argument(
+        '--search_index_type',
+        type=str,
+        choices=['ExhaustiveSearchIndex', 'SuperabundantEnumerationIndex'],
+        default='SuperabundantEnumerationIndex',
+        help='The type of search blocks to archive'
+    )
+    parser.add_argument(
+        '--refresh_period_seconds',
+        type=int,
+        default=60*60,
+        help='The duration to wait between compactions'
+    )
+    parser.add_argument(
+        '--archive_after_days',
+        type=float,
+        default=7,
+        help='The duration after which a finished search block is archived'
+    )
+    parser.add_argument(
+        '--max_blocks',
+        type=int,
+        default=10000,
+        help='The number of search blocks to archive in each transaction'
+    )
+
+    args = parser.parse_args()
+    db: DivisorDb
+    if args.sqlite_path:
+        db = SqliteDivisorDb(args.sqlite_path)
+    else:
+        db = PostgresDivisorDb(data_source_name=args.data_source_name)
+    main(
+        db,
+        search_index_type=args.search_index_type,
+        refresh_period_seconds=args.refresh_period_seconds,
+        archive_after=timedelta(days=args.archive_after_days),
+        max_blocks=args.max_blocks,
+    )
@@ -0,0 +1,128 @@
+'''
+Extract the points where the cumulative maximum witness value changes.
+
+The input is either exported binary columns sorted by log_n, streamed in
+windows so memory stays bounded, or the witness records the database already
+maintains. Besides the changes, every sample_every-th row is kept, so plots
+of the cumulative maximum have points between records.
+'''
+from typing import Iterable
+from typing import Optional
+from typing import TextIO
+from typing import Tuple
+
+from gmpy2 import log
+from riemann.database import DivisorDb
+import numpy as np
+
+CumulativeMaxPoints = Tuple[np.ndarray, np.ndarray, np.ndarray]
+
+
+def windows(
+        log_n: np.ndarray,
+        witness_value: np.ndarray,
+        window_rows: int) -> Iterable[Tuple[np.ndarray, np.ndarray]]:
+    '''Split a pair of (memory-mapped) columns into windows of rows.'''
+    for start in range(0, len(log_n), window_rows):
+        yield (np.asarray(log_n[start:start + window_rows]),
+               np.asarray(witness_value[start:start + window_rows]))
+
+
+def cumulative_max_changes(
+        chunks: Iterable[Tuple[np.ndarray, np.ndarray]],
+        min_log_n: Optional[float] = None,
+        sample_every: int = 500000) -> Iterable[CumulativeMaxPoints]:
+    '''
+    For chunks of rows sorted by log_n, yield the log_n, witness value and
+    cumulative maximum witness value of the rows that set a new maximum, and
+    of every sample_every-th row, skipping rows with log_n <= min_log_n.
+    '''
+    the_max = -np.inf
+    row = 0
+    for (log_n, witness_value) in chunks:
+        if min_log_n is not None:
+            keep = log_n > min_log_n
+            log_n = log_n[keep]
+            witness_value = witness_value[keep]
+        if len(log_n) == 0:
+            continue
+
+        maxes = np.maximum.accumulate(witness_value)
+        np.maximum(maxes, the_max, out=maxes)
+        previous = np.empty_like(maxes)
+        previous[0] = the_max
+        previous[1:] = maxes[:-1]
+        selected = witness_value > previous
+        selected[(-row) % sample_every::sample_every] = True
+
+        yield (log_n[selected], witness_value[selected], maxes[selected])
+        the_max = maxes[-1]
+        row += len(log_n)
+
+
+def witness_record_points(divisorDb: DivisorDb) -> CumulativeMaxPoints:
+    '''The changes of the cumulative maximum, from the stored records.'''
+    records = divisorDb.load_witness_records()
+    log_n = np.array([float(log(r.n)) for r in records], dtype=np.float64)
+    witness_value = np.array(
+        [r.witness_value for r in records], dtype=np.float64)
+    return (log_n, witness_value, witness_value)
+
+
+def write_points(
+        points: Iterable[CumulativeMaxPoints], output_file: TextIO) -> int:
+    '''Write points as csv, returning the number written.'''
+    output_file.write('log_n,witness_value,cumulative_max_witness_value\n')
+    count = 0
+    for columns in points:
+        np.savetxt(output_file, np.column_stack(columns),
+                   fmt='%.10f', delimiter=',')
+        count += len(columns[0])
+    return count
+
+
+if __name__ == "__main__":
+    import argparse
+    from riemann.export_for_plotting import load_sorted_binary_columns
+    from riemann.postgres_database import PostgresDivisorDb
+    from riemann.sqlite_database import SqliteDivisorDb
+    parser = argparse.ArgumentParser(
+        description='Extract the changes of the cumulative max witness value')
+    parser.add_argument('--binary_columns_dir', type=str,
+                        help='If set, read the binary columns exported to '
+                             'this directory and sorted by log_n, instead '
+                             'of the witness records in the database')
+    parser.add_argument('--data_source_name', type=str,
+                        help='The psycopg data_source_name string')
+    parser.add_argument('--sqlite_path', type=str,
+                        help='If set, use the sqlite database in this file '
+                             'instead of postgres')
+    parser.add_argument('--min_log_n', type=float, default=None,
+                        help='If set, skip binary column rows with at most '
+                             'this log_n')
+    parser.add_argument('--sample_every', type=int, default=500000,
+                        help='Also keep every this many rows')
+    parser.add_argument('--window_rows', type=int, default=10000000,
+                        help='The number of rows to hold in memory')
+    parser.add_argument('--output_path', type=str,
+                        default='cumulative_max_changes.csv',
+                        help='The csv file to write to')
+
+    args = parser.parse_args()
+    points: Iterable[CumulativeMaxPoints]
+    if args.binary_columns_dir:
+        points = cumulative_max_changes(
+            windows(*load_sorted_binary_columns(args.binary_columns_dir),
+                    window_rows=args.window_rows),
+            min_log_n=args.min_log_n,
+            sample_every=args.sample_every)
+    else:
+        db: DivisorDb
+        if args.sqlite_path:
+            db = SqliteDivisorDb(args.sqlite_path)
+        else:
+            db = PostgresDivisorDb(data_source_name=args.data_source_name)
+        points = [witness_record_points(db)]
+
+    with open(args.output_path, 'w') as outfile:
+        print(f"Wrote {write_points(points, outfile)} points")
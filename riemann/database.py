@@ -1,16 +1,79 @@
 '''An interface for a database containing divisor sums.'''
 from abc import ABC
 from abc import abstractmethod
+from datetime import datetime
+from datetime import timedelta
+from typing import Dict
 from typing import Iterable
 from typing import List
+from typing import Optional
+from typing import Tuple
 
+from riemann.storage_policy import FixedThresholdPolicy
+from riemann.storage_policy import LevelCutoff
+from riemann.storage_policy import StoragePolicy
+from riemann.types import ArchivedSearchRange
+from riemann.types import LevelStats
 from riemann.types import RiemannDivisorSum
+from riemann.types import SearchIndex
 from riemann.types import SearchMetadata
 from riemann.types import SummaryStats
 
 
 class DivisorDb(ABC):
     threshold_witness_value = 1.767
+    # If None, a FixedThresholdPolicy at threshold_witness_value is used.
+    storage_policy: Optional[StoragePolicy] = None
+
+    def get_storage_policy(self) -> StoragePolicy:
+        '''The policy deciding which divisor sums are stored.'''
+        if self.storage_policy is None:
+            return FixedThresholdPolicy(self.threshold_witness_value)
+        return self.storage_policy
+
+    def divisor_sums_to_store(
+            self,
+            finished_blocks: List[Tuple[SearchMetadata, List[RiemannDivisorSum]]]
+    ) -> List[List[RiemannDivisorSum]]:
+        '''
+        Select the divisor sums of each finished block to store, using the
+        storage policy. The running record and the level cutoffs are loaded,
+        once each, only if the policy needs them, so this should be called
+        before a write transaction starts.
+        '''
+        policy = self.get_storage_policy()
+        record_witness_value = None
+        if policy.uses_record:
+            try:
+                record_witness_value = float(
+                    self.summarize().largest_witness_value.witness_value)
+            except ValueError:
+                pass
+
+        level_cutoff = None
+        if policy.level_cutoff_rank is not None:
+            level_cutoff = self.level_cutoffs(policy.level_cutoff_rank)
+        return [
+            policy.select(
+                metadata, divisor_sums, record_witness_value, level_cutoff)
+            for (metadata, divisor_sums) in finished_blocks
+        ]
+
+    def level_cutoffs(self, rank: int) -> LevelCutoff:
+        '''
+        The witness value of the given rank among those stored at a level, or
+        None if fewer are stored, loaded once per level.
+        '''
+        cutoffs: Dict[int, Optional[float]] = {}
+
+        def level_cutoff(level: int) -> Optional[float]:
+            if level not in cutoffs:
+                top = self.load_top_witness_values(rank, level)
+                cutoffs[level] = (
+                    float(top[-1].witness_value) if len(top) == rank else None)
+            return cutoffs[level]
+
+        return level_cutoff
 
     @abstractmethod
     def initialize_schema(self):
@@ -32,14 +95,111 @@ class DivisorDb(ABC):
         '''Load the entire database of Metadata records.'''
         pass
 
+    @abstractmethod
+    def load_finished_search_blocks(
+            self,
+            search_index_type: str,
+            count: int) -> List[SearchMetadata]:
+        '''Load up to count of the most recently finished search blocks.'''
+        pass
+
     @abstractmethod
     def summarize(self) -> SummaryStats:
         '''Summarize the contents of the database.'''
         pass
 
     @abstractmethod
-    def insert_search_blocks(self, blocks: List[SearchMetadata]) -> None:
-        '''Insert new search blocks, and mark them as not started.'''
+    def load_top_witness_values(
+            self,
+            count: int,
+            level: Optional[int] = None) -> List[RiemannDivisorSum]:
+        '''
+        Load the stored divisor sums with the count largest witness values,
+        optionally only those whose n has level prime factors (counted with
+        multiplicity), sorted by decreasing witness value.
+        '''
+        pass
+
+    @abstractmethod
+    def load_log_n_range(
+            self,
+            min_log_n: float,
+            max_log_n: float) -> List[RiemannDivisorSum]:
+        '''
+        Load the stored divisor sums with min_log_n <= log(n) < max_log_n,
+        sorted by n.
+        '''
+        pass
+
+    @abstractmethod
+    def load_above_witness_value(
+            self, min_witness_value: float) -> List[RiemannDivisorSum]:
+        '''
+        Load the stored divisor sums with a witness value of at least
+        min_witness_value, sorted by n.
+        '''
+        pass
+
+    @abstractmethod
+    def load_level_stats(self, search_index_type: str) -> List[LevelStats]:
+        '''Load the merged statistics of each level, sorted by level.'''
+        pass
+
+    @abstractmethod
+    def load_witness_records(self) -> List[RiemannDivisorSum]:
+        '''
+        Load the records of the cumulative maximum witness value, i.e., the
+        stored divisor sums whose witness value is larger than that of every
+        stored divisor sum with a smaller n, sorted by n.
+        '''
+        pass
+
+    @abstractmethod
+    def max_divisor_sum_id(self) -> int:
+        '''
+        The id of the most recently stored divisor sum, or 0 if none are
+        stored. Ids increase in the order divisor sums are stored, and no
+        divisor sum with a smaller id is stored after this returns: it waits
+        for any transaction that may still commit one.
+        '''
+        pass
+
+    @abstractmethod
+    def load_log_n_and_witness_values(
+            self,
+            after_id: int,
+            through_id: int) -> List[Tuple[float, float]]:
+        '''
+        Load log(n) and the witness value of each stored divisor sum with
+        after_id < id <= through_id, sorted by id.
+        '''
+        pass
+
+    @abstractmethod
+    def insert_search_blocks(
+            self,
+            blocks: List[SearchMetadata],
+            next_search_index: Optional[SearchIndex] = None) -> None:
+        '''
+        Insert new search blocks, and mark them as not started.
+
+        If next_search_index is given, it is stored in the same transaction as
+        the index that the next generated search block should start from.
+        '''
+        pass
+
+    @abstractmethod
+    def load_next_search_index(
+            self, search_index_type: str) -> Optional[SearchIndex]:
+        '''
+        Load the next_search_index most recently stored by
+        insert_search_blocks, or None if none has been stored.
+        '''
+        pass
+
+    @abstractmethod
+    def count_eligible_search_blocks(self, search_index_type: str) -> int:
+        '''Count the search blocks that are eligible to be claimed.'''
         pass
 
     @abstractmethod
@@ -47,6 +207,43 @@ class DivisorDb(ABC):
         '''Claim the next search block, and mark it as started.'''
         pass
 
+    def claim_next_search_blocks(
+            self,
+            search_index_type: str,
+            count: int) -> List[SearchMetadata]:
+        '''
+        Claim up to count search blocks, and mark them as started.
+
+        Raises a ValueError if no block could be claimed. Implementations
+        should override this to claim the blocks in a single round trip.
+        '''
+        blocks = []
+        for i in range(count):
+            try:
+                blocks.append(self.claim_next_search_block(search_index_type))
+            except ValueError:
+                break
+
+        if not blocks:
+            raise ValueError('No legal search block to claim')
+        return blocks
+
+    @abstractmethod
+    def claim_speculative_search_block(
+            self,
+            search_index_type: str,
+            running_for: timedelta,
+            max_copies: int = 1) -> SearchMetadata:
+        '''
+        Claim a copy of the oldest search block that has been IN_PROGRESS for
+        longer than running_for, and has fewer than max_copies speculative
+        copies. The block stays IN_PROGRESS, and whichever copy finishes first
+        is kept.
+
+        Raises a ValueError if there is no such block.
+        '''
+        pass
+
     @abstractmethod
     def finish_search_block(self,
                             metadata: SearchMetadata,
@@ -54,10 +251,98 @@ class DivisorDb(ABC):
         '''
         Mark a search block as finished, store its hash, and insert the
         relevant subset of the corresponding divisor sums.
+
+        If metadata.block_hash is already set, it is stored as is, and
+        divisor_sums need only contain the sums worth storing. The block's
+        level statistics are merged into the database's, and are computed
+        from divisor_sums unless metadata.level_stats is set or
+        metadata.block_hash is set. The divisor sums to store are selected by
+        the storage policy, whose version is stored with the block.
+
+        Finishing a block that is already FINISHED with the same hash, such as
+        a speculative copy of a block, does nothing, and a divisor sum whose n
+        is already stored is not stored again.
+
+        Raises a ValueError if the block is not IN_PROGRESS, was finished
+        with a different hash, or was claimed again since metadata's claim.
+        '''
+        pass
+
+    def finish_search_blocks(
+            self,
+            finished_blocks: List[Tuple[SearchMetadata, List[RiemannDivisorSum]]]
+    ) -> None:
+        '''
+        Finish many search blocks at once, as with finish_search_block.
+
+        Blocks that can be finished are stored even if others cannot, after
+        which a ValueError describing the rejected blocks is raised.
+        Implementations should override this to finish the blocks in a single
+        transaction.
+        '''
+        errors = []
+        for (metadata, divisor_sums) in finished_blocks:
+            try:
+                self.finish_search_block(metadata, divisor_sums)
+            except ValueError as e:
+                errors.append(str(e))
+
+        if errors:
+            raise ValueError('\n'.join(errors))
+
+    @abstractmethod
+    def renew_claim(self, metadata: SearchMetadata) -> SearchMetadata:
+        '''
+        Reset the start_time of a claimed search block to now, so it is not
+        considered stale while it is computed, and return its metadata. Raises
+        ValueError if the block is not IN_PROGRESS or was claimed again since
+        metadata's claim.
         '''
         pass
 
     @abstractmethod
     def mark_block_as_failed(self, metadata: SearchMetadata) -> None:
-        '''Mark a search block as failed.'''
+        '''
+        Mark a search block as failed, if it is IN_PROGRESS and has not been
+        claimed again since metadata's claim. Otherwise, e.g., if the block
+        was never claimed or is already FINISHED, this does nothing and does
+        not raise.
+        '''
         pass
+
+    @abstractmethod
+    def compact_finished_search_blocks(
+            self,
+            search_index_type: str,
+            finished_before: datetime,
+            max_blocks: int = 10000) -> int:
+        '''
+        Move up to max_blocks of the search blocks that finished before
+        finished_before, oldest first, into the archive of ranges, merging
+        them with the ranges they are contiguous with. Archived blocks are no
+        longer loaded with the other search blocks.
+
+        Nothing is compacted unless a next search index has been stored for
+        search_index_type, since new blocks would otherwise be generated from
+        the remaining ones. Returns the number of blocks archived.
+        '''
+        pass
+
+    @abstractmethod
+    def load_archived_search_ranges(
+            self, search_index_type: str) -> List[ArchivedSearchRange]:
+        '''Load the archived ranges, sorted by their starting index.'''
+        pass
+
+
+def witness_record_candidates(
+        divisor_sums: Iterable[RiemannDivisorSum]) -> List[RiemannDivisorSum]:
+    '''
+    Return the divisor sums that are witness value records among
+    divisor_sums, sorted by n. Only these can be records in the database.
+    '''
+    candidates: List[RiemannDivisorSum] = []
+    for divisor_sum in sorted(divisor_sums, key=lambda d: d.n):
+        if not candidates or divisor_sum.witness_value > candidates[-1].witness_value:
+            candidates.append(divisor_sum)
+    return candidates
@@ -0,0 +1,232 @@
+'''
+Downsample witness values to fixed-size artifacts for plotting.
+
+At the sizes of the divisor sums table, most rows are invisible at screen
+resolution, so plots are drawn from artifacts whose size depends only on
+the resolution asked for:
+
+ - the minimum and maximum witness value in each bin of log_n,
+ - a 2D histogram of log_n and witness value,
+ - a largest-triangle-three-buckets (LTTB) subset of a line, such as the
+   cumulative maximum witness value,
+ - a histogram of witness values per level, from the stored level stats.
+
+The binned artifacts are accumulated over chunks of exported binary columns,
+so memory is bounded by the chunk size.
+'''
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Tuple
+
+from riemann.cumulative_max import cumulative_max_changes
+from riemann.level_stats import WITNESS_HISTOGRAM_EDGES
+from riemann.types import LevelStats
+import numpy as np
+
+Columns = Tuple[np.ndarray, np.ndarray]
+
+
+def column_limits(chunks: Iterable[Columns]) -> Tuple[float, float]:
+    '''The smallest and largest log_n in the chunks.'''
+    lower = np.inf
+    upper = -np.inf
+    for (log_n, _) in chunks:
+        if len(log_n):
+            lower = min(lower, float(np.min(log_n)))
+            upper = max(upper, float(np.max(log_n)))
+    if lower > upper:
+        raise ValueError("No data!")
+    return (lower, upper)
+
+
+def bin_indices(
+        values: np.ndarray, lower: float, upper: float, bins: int) -> np.ndarray:
+    '''The bin of each value, for bins equal parts of [lower, upper].'''
+    width = (upper - lower) / bins or 1
+    return np.clip(((values - lower) / width).astype(np.int64), 0, bins - 1)
+
+
+def min_max_bins(
+        chunks: Iterable[Columns],
+        limits: Tuple[float, float],
+        bins: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Return the bin edges, and the minimum and maximum witness value and the
+    row count of each bin of log_n within limits. Empty bins have a minimum
+    and maximum of nan.
+    '''
+    (lower, upper) = limits
+    mins = np.full(bins, np.inf)
+    maxes = np.full(bins, -np.inf)
+    counts = np.zeros(bins, dtype=np.int64)
+    for (log_n, witness_value) in chunks:
+        inside = (log_n >= lower) & (log_n <= upper)
+        indices = bin_indices(log_n[inside], lower, upper, bins)
+        witness_value = witness_value[inside]
+        np.minimum.at(mins, indices, witness_value)
+        np.maximum.at(maxes, indices, witness_value)
+        counts += np.bincount(indices, minlength=bins)
+
+    empty = counts == 0
+    mins[empty] = np.nan
+    maxes[empty] = np.nan
+    return (np.linspace(lower, upper, bins + 1), mins, maxes, counts)
+
+
+def histogram2d(
+        chunks: Iterable[Columns],
+        limits: Tuple[Tuple[float, float], Tuple[float, float]],
+        bins: Tuple[int, int]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Return the counts of rows in each bin of log_n and witness value within
+    limits, and the bin edges of each.
+    '''
+    log_n_edges = np.linspace(limits[0][0], limits[0][1], bins[0] + 1)
+    witness_edges = np.linspace(limits[1][0], limits[1][1], bins[1] + 1)
+    counts = np.zeros(bins, dtype=np.int64)
+    for (log_n, witness_value) in chunks:
+        (chunk_counts, _, _) = np.histogram2d(
+            log_n, witness_value, bins=(log_n_edges, witness_edges))
+        counts += chunk_counts.astype(np.int64)
+    return (counts, log_n_edges, witness_edges)
+
+
+def lttb(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    '''
+    Select the indices of threshold points of the line through (x, y), sorted
+    by x, that keep its visual shape, using largest-triangle-three-buckets.
+    '''
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    # the first and last points are kept, and the rest split into buckets
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        (start, stop) = (edges[i], edges[i + 1])
+        if i + 2 < len(edges):
+            (next_start, next_stop) = (edges[i + 1], edges[i + 2])
+        else:
+            (next_start, next_stop) = (n - 1, n)
+        average_x = np.mean(x[next_start:next_stop])
+        average_y = np.mean(y[next_start:next_stop])
+        # twice the area of the triangles with the previous point and the
+        # average of the next bucket
+        areas = np.abs(
+            (x[a] - average_x) * (y[start:stop] - y[a])
+            - (x[a] - x[start:stop]) * (average_y - y[a]))
+        a = start + int(np.argmax(areas))
+        selected[i + 1] = a
+    return selected
+
+
+def level_histograms(
+        stats: List[LevelStats]) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Return the levels, and a matrix of the counts of witness values in each
+    bin of WITNESS_HISTOGRAM_EDGES at each level.
+    '''
+    levels = np.array([s.level for s in stats], dtype=np.int64)
+    counts = np.zeros(
+        (len(stats), len(WITNESS_HISTOGRAM_EDGES)), dtype=np.int64)
+    for (row, s) in enumerate(stats):
+        counts[row, :len(s.witness_histogram)] = s.witness_histogram
+    return (levels, counts)
+
+
+def downsample(
+        chunks: List[Columns],
+        bins: int = 2000,
+        witness_value_limits: Tuple[float, float] = (1.68, 1.782),
+        witness_value_bins: int = 500,
+        line_points: int = 2000) -> Dict[str, np.ndarray]:
+    '''
+    Compute the plot artifacts of the chunks, sorted by log_n, with the
+    cumulative maximum witness value downsampled with LTTB.
+    '''
+    limits = column_limits(chunks)
+    (edges, mins, maxes, counts) = min_max_bins(chunks, limits, bins)
+    (histogram, log_n_edges, witness_edges) = histogram2d(
+        chunks, (limits, witness_value_limits), (bins, witness_value_bins))
+
+    changes = list(cumulative_max_changes(chunks))
+    line_x = np.concatenate([log_n for (log_n, _, _) in changes])
+    line_y = np.concatenate([the_max for (_, _, the_max) in changes])
+    line = lttb(line_x, line_y, line_points)
+
+    return dict(
+        min_max_edges=edges,
+        min_witness_value=mins,
+        max_witness_value=maxes,
+        bin_counts=counts,
+        histogram=histogram,
+        histogram_log_n_edges=log_n_edges,
+        histogram_witness_value_edges=witness_edges,
+        cumulative_max_log_n=line_x[line],
+        cumulative_max_witness_value=line_y[line],
+    )
+
+
+if __name__ == "__main__":
+    import argparse
+    from riemann.cumulative_max import windows
+    from riemann.database import DivisorDb
+    from riemann.export_for_plotting import load_sorted_binary_columns
+    from riemann.postgres_database import PostgresDivisorDb
+    from riemann.sqlite_database import SqliteDivisorDb
+    parser = argparse.ArgumentParser(
+        description='Downsample witness values to plot-ready artifacts')
+    parser.add_argument('--binary_columns_dir', type=str,
+                        help='If set, downsample the binary columns exported '
+                             'to this directory and sorted by log_n')
+    parser.add_argument('--data_source_name', type=str,
+                        help='If --binary_columns_dir is not set, the '
+                             'psycopg data_source_name string of the '
+                             'database whose level stats are used')
+    parser.add_argument('--sqlite_path', type=str,
+                        help='If set, use the sqlite database in this file '
+                             'instead of postgres')
+    parser.add_argument('--search_index_type', type=str,
+                        default='SuperabundantEnumerationIndex',
+                        help='The search index type of the level stats')
+    parser.add_argument('--bins', type=int, default=2000,
+                        help='The number of bins of log_n')
+    parser.add_argument('--witness_value_bins', type=int, default=500,
+                        help='The number of bins of witness values')
+    parser.add_argument('--line_points', type=int, default=2000,
+                        help='The number of points of the cumulative maximum')
+    parser.add_argument('--window_rows', type=int, default=10000000,
+                        help='The number of rows to hold in memory')
+    parser.add_argument('--output_path', type=str,
+                        default='divisor_sums_plot.npz',
+                        help='The npz file to write the artifacts to')
+
+    args = parser.parse_args()
+    artifacts: Dict[str, np.ndarray]
+    if args.binary_columns_dir:
+        (log_n, witness_value) = load_sorted_binary_columns(
+            args.binary_columns_dir)
+        artifacts = downsample(
+            list(windows(log_n, witness_value, args.window_rows)),
+            bins=args.bins,
+            witness_value_bins=args.witness_value_bins,
+            line_points=args.line_points)
+    else:
+        db: DivisorDb
+        if args.sqlite_path:
+            db = SqliteDivisorDb(args.sqlite_path)
+        else:
+            db = PostgresDivisorDb(data_source_name=args.data_source_name)
+        (levels, counts) = level_histograms(
+            db.load_level_stats(args.search_index_type))
+        artifacts = dict(
+            levels=levels,
+            level_histogram=counts,
+            level_histogram_edges=np.array(WITNESS_HISTOGRAM_EDGES))
+    # numpy types allow_pickle as a keyword, confusing mypy about **kwargs
+    np.savez(args.output_path, **artifacts)  # type: ignore
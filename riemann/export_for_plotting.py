@@ -1,22 +1,58 @@
 '''
 A one-off script that exports the Riemann divisor sums table to a file format
 suitable for plotting.
+
+Besides CSV, the table can be exported as binary columns: a directory of
+chunks, each a float64 log_n column and a float64 witness value column,
+written directly with numpy and read back with numpy.memmap. The rows are
+split into disjoint ranges of their ids, which are exported in parallel over
+several connections. A watermark records the largest id exported, so a later
+export, or one resumed after a crash, only exports the rows stored since.
+The exported chunks can then be sorted by log_n with an external merge sort.
 '''
 
+from functools import partial
+from multiprocessing import Pool
+from typing import Callable
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import TextIO
+from typing import Tuple
+import json
+import os
+import time
+
 from gmpy2 import log
+from riemann.columnar_store import LOG_N_SUFFIX
+from riemann.columnar_store import WITNESS_VALUE_SUFFIX
+from riemann.columnar_store import memmap_column
 from riemann.database import DivisorDb
+from riemann.external_sort import external_sort
+from riemann.external_sort import load_columns
 from riemann.postgres_database import PostgresDivisorDb
 from riemann.primes import primes
+from riemann.sqlite_database import SqliteDivisorDb
 from riemann.superabundant import factorize
-from typing import TextIO
+from riemann.types import RiemannDivisorSum
+import numpy as np
 
+EXPORT_INDEX_SUFFIX = '.export.json'
+WATERMARK_FILENAME = 'watermark.json'
+SORTED_PREFIX = 'sorted_by_log_n'
 
-def export_divisor_sums(divisorDb: DivisorDb, output_file: TextIO) -> None:
+
+def export_divisor_sums(
+        divisorDb: DivisorDb,
+        output_file: TextIO,
+        divisor_sums: Optional[Iterable[RiemannDivisorSum]] = None) -> None:
+    if divisor_sums is None:
+        divisor_sums = divisorDb.load()
     # for now, use only 115 primes for columns
     # prime_subset = list(primes[:115])
     # prime_columns = ','.join(['%d' % p for p in prime_subset])
     output_file.write('log_n,witness_value\n')  # ,' + prime_columns + '\n')
-    for rds in divisorDb.load():
+    for rds in divisor_sums:
         log_n = log(rds.n)
         # factorization = factorize(rds.n, prime_subset)
         # factor_columns = ','.join(['%d' % d for (p, d) in factorization])
@@ -24,6 +60,151 @@ def export_divisor_sums(divisorDb: DivisorDb, output_file: TextIO) -> None:
             f'{log_n:.10f},{rds.witness_value:.10f}\n')  # ,{factor_columns}\n')
 
 
+def export_witness_records(divisorDb: DivisorDb, output_file: TextIO) -> None:
+    '''Export only the records of the cumulative maximum witness value.'''
+    output_file.write('log_n,witness_value\n')
+    for rds in divisorDb.load_witness_records():
+        output_file.write(f'{log(rds.n):.10f},{rds.witness_value:.10f}\n')
+
+
+def load_watermark(directory: str) -> int:
+    '''The largest id exported to the directory, or 0 if none.'''
+    path = os.path.join(directory, WATERMARK_FILENAME)
+    if not os.path.exists(path):
+        return 0
+    with open(path) as infile:
+        return json.load(infile)['watermark']
+
+
+def save_watermark(directory: str, watermark: int) -> None:
+    path = os.path.join(directory, WATERMARK_FILENAME)
+    with open(path + '.tmp', 'w') as outfile:
+        json.dump(dict(watermark=watermark), outfile)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(path + '.tmp', path)
+
+
+def id_ranges(
+        after_id: int,
+        through_id: int,
+        rows_per_range: int) -> List[Tuple[int, int]]:
+    '''Split after_id < id <= through_id into ranges of rows_per_range ids.'''
+    return [
+        (start, min(start + rows_per_range, through_id))
+        for start in range(after_id, through_id, rows_per_range)
+    ]
+
+
+def chunk_prefix(directory: str, after_id: int, through_id: int) -> str:
+    return os.path.join(directory, f"ids-{after_id:012d}-{through_id:012d}")
+
+
+def remove_unfinished_chunks(directory: str, watermark: int) -> None:
+    '''
+    Remove the chunks of ids past the watermark, left by an export that did
+    not finish. Their ranges are exported again.
+    '''
+    for name in os.listdir(directory):
+        if not name.startswith('ids-'):
+            continue
+        after_id = int(name.split('.')[0].split('-')[1])
+        if after_id >= watermark:
+            os.remove(os.path.join(directory, name))
+
+
+def export_id_range(
+        connect: Callable[[], DivisorDb],
+        directory: str,
+        id_range: Tuple[int, int]) -> int:
+    '''Export the rows in one range of ids as a chunk, and count them.'''
+    (after_id, through_id) = id_range
+    rows = connect().load_log_n_and_witness_values(after_id, through_id)
+    values = np.array(rows, dtype=np.float64).reshape(len(rows), 2)
+
+    prefix = chunk_prefix(directory, after_id, through_id)
+    for (suffix, column) in [(LOG_N_SUFFIX, values[:, 0]),
+                             (WITNESS_VALUE_SUFFIX, values[:, 1])]:
+        with open(prefix + suffix, 'wb') as outfile:
+            np.ascontiguousarray(column).tofile(outfile)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+
+    # the index is written last, so readers only see complete chunks
+    with open(prefix + EXPORT_INDEX_SUFFIX + '.tmp', 'w') as outfile:
+        json.dump(dict(rows=len(rows)), outfile)
+    os.replace(prefix + EXPORT_INDEX_SUFFIX + '.tmp',
+               prefix + EXPORT_INDEX_SUFFIX)
+    return len(rows)
+
+
+def export_binary_columns(
+        connect: Callable[[], DivisorDb],
+        directory: str,
+        processes: int = 4,
+        rows_per_range: int = 1000000) -> int:
+    '''
+    Export the rows stored since the last export to the directory as binary
+    columns, each range of rows_per_range ids in its own process with its own
+    connection from connect, which must be picklable. Returns the number of
+    rows exported.
+
+    The export stops at max_divisor_sum_id, which waits for transactions
+    still storing rows with smaller ids, so no row is stored below the
+    watermark after it is saved.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    watermark = load_watermark(directory)
+    remove_unfinished_chunks(directory, watermark)
+    ranges = id_ranges(watermark, connect().max_divisor_sum_id(), rows_per_range)
+
+    exported = 0
+    with Pool(processes) as pool:
+        counts = pool.imap(
+            partial(export_id_range, connect, directory), ranges)
+        # ranges finish in order, so the watermark only passes finished ranges
+        for ((_, through_id), count) in zip(ranges, counts):
+            save_watermark(directory, through_id)
+            exported += count
+    return exported
+
+
+def load_binary_column_chunks(
+        directory: str) -> Iterable[Tuple[np.ndarray, np.ndarray]]:
+    '''The log_n and witness value columns of each chunk, in id order.'''
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(EXPORT_INDEX_SUFFIX):
+            prefix = os.path.join(directory, name[:-len(EXPORT_INDEX_SUFFIX)])
+            yield (memmap_column(prefix + LOG_N_SUFFIX, np.float64),
+                   memmap_column(prefix + WITNESS_VALUE_SUFFIX, np.float64))
+
+
+def load_binary_columns(directory: str) -> Tuple[np.ndarray, np.ndarray]:
+    '''Load every exported log_n and witness value into memory.'''
+    chunks = list(load_binary_column_chunks(directory))
+    if not chunks:
+        return (np.zeros(0), np.zeros(0))
+    return (np.concatenate([log_n for (log_n, _) in chunks]),
+            np.concatenate([witness_value for (_, witness_value) in chunks]))
+
+
+def sort_binary_columns(directory: str, max_rows: int = 10000000) -> int:
+    '''
+    Sort every exported row by log_n, holding at most about max_rows rows in
+    memory. Returns the number of rows.
+    '''
+    return external_sort(
+        load_binary_column_chunks(directory),
+        os.path.join(directory, SORTED_PREFIX),
+        max_rows=max_rows)
+
+
+def load_sorted_binary_columns(
+        directory: str) -> Tuple[np.ndarray, np.ndarray]:
+    '''Memory-map the log_n and witness value columns sorted by log_n.'''
+    return load_columns(os.path.join(directory, SORTED_PREFIX))
+
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
@@ -32,14 +213,87 @@ if __name__ == "__main__":
         type=str,
         help='The psycopg data_source_name string'
     )
+    parser.add_argument(
+        '--sqlite_path',
+        type=str,
+        help='If set, use the sqlite database in this file instead of postgres'
+    )
     parser.add_argument(
         '--divisor_sums_filepath',
         type=str,
         default='divisor_sums.csv',
         help='The filepath to write divisor sum witness values to (default divisor_sums.csv)'
     )
+    parser.add_argument(
+        '--min_witness_value',
+        type=float,
+        default=None,
+        help='If set, export only divisor sums with at least this witness value'
+    )
+    parser.add_argument(
+        '--witness_records_only',
+        action='store_true',
+        help='Export only the records of the cumulative maximum witness value'
+    )
+    parser.add_argument(
+        '--binary_columns_dir',
+        type=str,
+        default=None,
+        help='If set, export the rows stored since the last export to this '
+             'directory as binary columns, instead of to a csv'
+    )
+    parser.add_argument(
+        '--processes',
+        type=int,
+        default=4,
+        help='The number of connections to export binary columns over'
+    )
+    parser.add_argument(
+        '--rows_per_range',
+        type=int,
+        default=1000000,
+        help='The number of row ids in each exported chunk of binary columns'
+    )
+    parser.add_argument(
+        '--sort_by_log_n',
+        action='store_true',
+        help='After exporting binary columns, also sort them by log_n'
+    )
+    parser.add_argument(
+        '--sort_max_rows',
+        type=int,
+        default=10000000,
+        help='The number of rows to hold in memory while sorting'
+    )
 
     args = parser.parse_args()
-    db = PostgresDivisorDb(data_source_name=args.data_source_name)
-    with open(args.divisor_sums_filepath, 'w') as outfile:
-        export_divisor_sums(db, outfile)
+    connect: Callable[[], DivisorDb]
+    if args.sqlite_path:
+        connect = partial(SqliteDivisorDb, args.sqlite_path)
+    else:
+        connect = partial(
+            PostgresDivisorDb, data_source_name=args.data_source_name)
+
+    if args.binary_columns_dir:
+        count = export_binary_columns(
+            connect,
+            args.binary_columns_dir,
+            processes=args.processes,
+            rows_per_range=args.rows_per_range)
+        print(f"Exported {count} rows")
+        if args.sort_by_log_n:
+            start = time.time()
+            count = sort_binary_columns(
+                args.binary_columns_dir, max_rows=args.sort_max_rows)
+            print(f"Sorted {count} rows in {time.time() - start:.1f}s")
+    else:
+        db = connect()
+        with open(args.divisor_sums_filepath, 'w') as outfile:
+            if args.witness_records_only:
+                export_witness_records(db, outfile)
+            elif args.min_witness_value is not None:
+                export_divisor_sums(
+                    db, outfile,
+                    db.load_above_witness_value(args.min_witness_value))
+            else:
+                export_divisor_sums(db, outfile)
@@ -0,0 +1,146 @@
+'''
+An external merge sort of pairs of float64 columns, sorting by the first
+column in a bounded amount of memory.
+
+The input is split into sorted runs of at most max_rows rows, written to
+temporary files. The runs are then merged a window at a time: each run
+contributes its next window of rows, and every row no larger than the
+smallest of the windows' last keys is sorted and written, since no row still
+unread can be smaller.
+'''
+from typing import Iterable
+from typing import List
+from typing import Tuple
+import os
+import shutil
+import tempfile
+
+from riemann.columnar_store import memmap_column
+import numpy as np
+
+KEY_SUFFIX = '.key.f64'
+VALUE_SUFFIX = '.value.f64'
+
+
+def write_columns(prefix: str, key: np.ndarray, value: np.ndarray) -> None:
+    with open(prefix + KEY_SUFFIX, 'wb') as outfile:
+        key.tofile(outfile)
+    with open(prefix + VALUE_SUFFIX, 'wb') as outfile:
+        value.tofile(outfile)
+
+
+def load_columns(prefix: str) -> Tuple[np.ndarray, np.ndarray]:
+    return (memmap_column(prefix + KEY_SUFFIX, np.float64),
+            memmap_column(prefix + VALUE_SUFFIX, np.float64))
+
+
+def sort_runs(
+        chunks: Iterable[Tuple[np.ndarray, np.ndarray]],
+        directory: str,
+        max_rows: int) -> List[str]:
+    '''
+    Write the rows of the chunks as sorted runs of at most max_rows rows,
+    returning the prefix of each run.
+    '''
+    runs: List[str] = []
+    keys: List[np.ndarray] = []
+    values: List[np.ndarray] = []
+    buffered = 0
+
+    def write_run():
+        key = np.concatenate(keys)
+        value = np.concatenate(values)
+        order = np.argsort(key, kind='stable')
+        prefix = os.path.join(directory, f"run-{len(runs):06d}")
+        write_columns(prefix, key[order], value[order])
+        runs.append(prefix)
+        keys.clear()
+        values.clear()
+
+    for (key, value) in chunks:
+        start = 0
+        while start < len(key):
+            stop = min(len(key), start + max_rows - buffered)
+            keys.append(np.asarray(key[start:stop], dtype=np.float64))
+            values.append(np.asarray(value[start:stop], dtype=np.float64))
+            buffered += stop - start
+            start = stop
+            if buffered == max_rows:
+                write_run()
+                buffered = 0
+    if buffered:
+        write_run()
+    return runs
+
+
+def merge_runs(runs: List[str], output_prefix: str, max_rows: int) -> int:
+    '''
+    Merge sorted runs into one sorted pair of columns at output_prefix,
+    holding at most about max_rows rows in memory. Returns the number of rows.
+    '''
+    columns = [load_columns(run) for run in runs]
+    positions = [0] * len(runs)
+    window = max(1, max_rows // max(1, 2 * len(runs)))
+    total = 0
+
+    with open(output_prefix + KEY_SUFFIX, 'wb') as key_file, \
+            open(output_prefix + VALUE_SUFFIX, 'wb') as value_file:
+        while True:
+            live = [
+                i for (i, (key, _)) in enumerate(columns)
+                if positions[i] < len(key)
+            ]
+            if not live:
+                break
+
+            ends = {
+                i: min(positions[i] + window, len(columns[i][0]))
+                for i in live
+            }
+            # Rows up to the bound are final. A run whose window reaches its
+            # end has no unread rows, so it does not limit the bound.
+            limits = [
+                columns[i][0][ends[i] - 1] for i in live
+                if ends[i] < len(columns[i][0])
+            ]
+            bound = min(limits) if limits else np.inf
+
+            keys = []
+            values = []
+            for i in live:
+                (key, value) = columns[i]
+                start = positions[i]
+                stop = start + int(np.searchsorted(
+                    key[start:ends[i]], bound, side='right'))
+                keys.append(key[start:stop])
+                values.append(value[start:stop])
+                positions[i] = stop
+
+            key = np.concatenate(keys)
+            order = np.argsort(key, kind='stable')
+            key[order].tofile(key_file)
+            np.concatenate(values)[order].tofile(value_file)
+            total += len(key)
+    return total
+
+
+def external_sort(
+        chunks: Iterable[Tuple[np.ndarray, np.ndarray]],
+        output_prefix: str,
+        max_rows: int = 10000000) -> int:
+    '''
+    Sort the rows of the (key, value) chunks by key into a pair of columns at
+    output_prefix, which replace any existing ones only once complete.
+    Returns the number of rows.
+    '''
+    directory = os.path.dirname(os.path.abspath(output_prefix))
+    run_directory = tempfile.mkdtemp(dir=directory)
+    try:
+        runs = sort_runs(chunks, run_directory, max_rows)
+        tmp_prefix = os.path.join(run_directory, 'merged')
+        total = merge_runs(runs, tmp_prefix, max_rows)
+        for suffix in [KEY_SUFFIX, VALUE_SUFFIX]:
+            os.replace(tmp_prefix + suffix, output_prefix + suffix)
+    finally:
+        shutil.rmtree(run_directory)
+    return total
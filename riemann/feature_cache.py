@@ -0,0 +1,90 @@
+'''
+A content-addressed cache of arrays derived from divisor sum data, such as
+UMAP embeddings and features.
+
+An entry's key is a hash of the input arrays and of the parameters used to
+derive it, so a result is reused exactly when its inputs are unchanged, no
+matter which file they came from. Entries are .npy files in a directory,
+evicted least recently used first once they exceed a total size.
+'''
+from typing import Any
+from typing import Callable
+from typing import List
+from typing import Optional
+import hashlib
+import json
+import os
+
+import numpy as np
+
+ENTRY_SUFFIX = '.npy'
+
+
+def cache_key(arrays: List[np.ndarray], **params: Any) -> str:
+    '''Hash the contents, types and shapes of the arrays, and the params.'''
+    digest = hashlib.sha256()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(f"{array.dtype.str}{array.shape}".encode())
+        digest.update(array.data)
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+class FeatureCache:
+    def __init__(self, directory: str, max_bytes: int = 10 * 2**30):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ENTRY_SUFFIX)
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        # the modification time orders entries for eviction
+        os.utime(path)
+        return np.load(path)
+
+    def put(self, key: str, value: np.ndarray) -> None:
+        tmp_path = self.path(key) + '.tmp'
+        with open(tmp_path, 'wb') as outfile:
+            np.save(outfile, value)
+        os.replace(tmp_path, self.path(key))
+        self.evict(keep=key)
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        '''
+        Remove the least recently used entries until the cache fits in
+        max_bytes, except for the entry keep.
+        '''
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(ENTRY_SUFFIX):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, name, stat.st_size))
+        total = sum(size for (_, _, size) in entries)
+        for (_, name, size) in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if keep is not None and name == keep + ENTRY_SUFFIX:
+                continue
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+    def get_or_compute(self,
+                       compute: Callable[[], np.ndarray],
+                       arrays: List[np.ndarray],
+                       **params: Any) -> np.ndarray:
+        '''
+        Return the cached result of compute for the input arrays and params,
+        computing and storing it if it is not cached.
+        '''
+        key = cache_key(arrays, **params)
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
@@ -0,0 +1,224 @@
+'''
+Fit curves to the records of the cumulative maximum witness value, and find
+where they cross a target witness value, such as the 1.782 of Robin's
+inequality.
+
+Each model is linear in its parameters, y = a + b * f(x) for x = log(n), so
+it is fit by linear least squares, and can be fit incrementally by keeping
+the sums the least squares solution depends on. The crossing is found by
+inverting f when possible, and otherwise by bisection.
+'''
+from dataclasses import dataclass
+from typing import Callable
+from typing import Iterable
+from typing import Optional
+from typing import Tuple
+
+from gmpy2 import log
+from riemann.types import RiemannDivisorSum
+import numpy as np
+
+Params = Tuple[float, float]
+
+
+@dataclass(frozen=True)
+class Model:
+    '''The model y = a + b * feature(x), where inverse inverts feature.'''
+    name: str
+    feature: Callable[[np.ndarray], np.ndarray]
+    inverse: Optional[Callable[[np.ndarray], np.ndarray]]
+    # the smallest x the feature is defined for
+    min_x: float
+
+
+MODELS = dict(
+    reciprocal=Model(
+        name='reciprocal',
+        feature=lambda x: 1 / x,
+        inverse=lambda f: 1 / f,
+        min_x=0),
+    log_log=Model(
+        name='log_log',
+        feature=lambda x: np.log(np.log(x)),
+        inverse=lambda f: np.exp(np.exp(f)),
+        min_x=1),
+)
+
+
+def in_domain(
+        model: Model,
+        x: np.ndarray,
+        y: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    '''The points whose x the model's feature is defined for.'''
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    inside = x > model.min_x
+    return (x[inside], y[inside])
+
+
+def evaluate(model: Model, params: Params, x: np.ndarray) -> np.ndarray:
+    (a, b) = params
+    return a + b * model.feature(np.asarray(x, dtype=np.float64))
+
+
+def fit(model: Model, x: np.ndarray, y: np.ndarray) -> Params:
+    '''Fit the model's parameters to the points by least squares.'''
+    (x, y) = in_domain(model, x, y)
+    features = model.feature(x)
+    design = np.column_stack([np.ones_like(features), features])
+    ((a, b), _, _, _) = np.linalg.lstsq(design, y, rcond=None)
+    return (float(a), float(b))
+
+
+def bisect_root(
+        func: Callable[[float], float],
+        lower: float,
+        upper: float,
+        tolerance: float = 1e-12,
+        max_iterations: int = 200) -> Optional[float]:
+    '''
+    Find x in [lower, upper] with func(x) = 0 by bisection, or None if func
+    does not change sign on the interval.
+    '''
+    (f_lower, f_upper) = (func(lower), func(upper))
+    if f_lower == 0:
+        return lower
+    if f_upper == 0:
+        return upper
+    if np.sign(f_lower) == np.sign(f_upper):
+        return None
+    for _ in range(max_iterations):
+        middle = (lower + upper) / 2
+        f_middle = func(middle)
+        if f_middle == 0 or upper - lower <= tolerance * max(1, abs(middle)):
+            return middle
+        if np.sign(f_middle) == np.sign(f_lower):
+            (lower, f_lower) = (middle, f_middle)
+        else:
+            upper = middle
+    return (lower + upper) / 2
+
+
+def crossing(
+        model: Model,
+        params: Params,
+        target: float,
+        bracket: Optional[Tuple[float, float]] = None) -> Optional[float]:
+    '''
+    The x at which the fit curve reaches target, or None if it never does.
+    Without an inverse, the crossing is searched for within bracket.
+    '''
+    (a, b) = params
+    if model.inverse is not None:
+        if b == 0:
+            return None
+        with np.errstate(all='ignore'):
+            x = float(model.inverse(np.float64((target - a) / b)))
+        if np.isfinite(x) and x > model.min_x:
+            return x
+        return None
+    if bracket is None:
+        raise ValueError(f"Model {model.name} needs a bracket to search")
+    return bisect_root(
+        lambda x: float(evaluate(model, params, np.float64(x))) - target,
+        *bracket)
+
+
+def points_below_max(
+        x: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Drop the points at the largest cumulative maximum, which has not been
+    superseded, so does not show where the curve is.
+    '''
+    below = y < np.max(y)
+    return (x[below], y[below])
+
+
+class IncrementalFit:
+    '''
+    A least squares fit of a model to witness records that arrive over time,
+    in increasing order of n. The latest record is the current maximum, so it
+    only joins the fit once it is superseded.
+    '''
+
+    def __init__(self, model: Model):
+        self.model = model
+        # the sums of 1, f, f^2, y and f*y over the fit points
+        self.sums = np.zeros(5)
+        self.pending: Optional[Tuple[float, float]] = None
+
+    def add(self, x: np.ndarray, y: np.ndarray) -> None:
+        '''Add points to the fit.'''
+        (x, y) = in_domain(self.model, x, y)
+        f = self.model.feature(x)
+        self.sums += [len(f), f.sum(), (f * f).sum(), y.sum(), (f * y).sum()]
+
+    def update(self, records: Iterable[RiemannDivisorSum]) -> int:
+        '''
+        Add the records with a larger n than any seen before, returning the
+        number of new records.
+        '''
+        new_points = [
+            (float(log(r.n)), float(r.witness_value)) for r in records]
+        if self.pending is not None:
+            new_points = [p for p in new_points if p[0] > self.pending[0]]
+        if not new_points:
+            return 0
+
+        points = ([self.pending] if self.pending else []) + new_points
+        (x, y) = np.array(points[:-1]).reshape(-1, 2).T
+        self.add(x, y)
+        self.pending = points[-1]
+        return len(new_points)
+
+    def params(self) -> Params:
+        (count, f, ff, y, fy) = self.sums
+        determinant = count * ff - f * f
+        if determinant == 0:
+            raise ValueError("Not enough points to fit!")
+        b = (count * fy - f * y) / determinant
+        a = (y - b * f) / count
+        return (float(a), float(b))
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    from riemann.database import DivisorDb
+    from riemann.postgres_database import PostgresDivisorDb
+    from riemann.sqlite_database import SqliteDivisorDb
+    parser = argparse.ArgumentParser(
+        description='Fit a curve to the stored witness records')
+    parser.add_argument('--data_source_name', type=str,
+                        help='The psycopg data_source_name string')
+    parser.add_argument('--sqlite_path', type=str,
+                        help='If set, use the sqlite database in this file '
+                             'instead of postgres')
+    parser.add_argument('--model', type=str, choices=sorted(MODELS),
+                        default='reciprocal', help='The model to fit')
+    parser.add_argument('--target', type=float, default=1.782,
+                        help='The witness value to find the crossing of')
+    parser.add_argument('--refresh_period_seconds', type=int, default=0,
+                        help='If positive, keep refitting as new records '
+                             'arrive, waiting this long between checks')
+
+    args = parser.parse_args()
+    db: DivisorDb
+    if args.sqlite_path:
+        db = SqliteDivisorDb(args.sqlite_path)
+    else:
+        db = PostgresDivisorDb(data_source_name=args.data_source_name)
+
+    model = MODELS[args.model]
+    incremental_fit = IncrementalFit(model)
+    while True:
+        if incremental_fit.update(db.load_witness_records()):
+            try:
+                params = incremental_fit.params()
+                print(f"params={params} "
+                      f"crossing={crossing(model, params, args.target)}")
+            except ValueError as e:
+                print(e)
+        if args.refresh_period_seconds <= 0:
+            break
+        time.sleep(args.refresh_period_seconds)
@@ -6,10 +6,14 @@ from datetime import datetime
 from typing import List
 import time
 
+from riemann.block_sizing import fit_cost_model
+from riemann.block_sizing import generate_timed_search_blocks
 from riemann.database import DivisorDb
 from riemann.postgres_database import PostgresDivisorDb
 from riemann.search_strategy import SearchStrategy
+from riemann.search_strategy import SuperabundantSearchStrategy
 from riemann.search_strategy import search_strategy_by_name
+from riemann.sqlite_database import SqliteDivisorDb
 from riemann.types import SearchBlockState
 from riemann.types import SearchIndex
 from riemann.types import SearchMetadata
@@ -44,38 +48,79 @@ def get_starting_index(
         )[0].ending_search_index
 
 
+def generate_blocks(divisorDb: DivisorDb,
+                    search_strategy: SearchStrategy,
+                    args) -> List[SearchMetadata]:
+    '''
+    Generate the next batch of search blocks, sized for a target duration if
+    args.target_block_seconds is set and the strategy supports it.
+    '''
+    if (args.target_block_seconds is None
+            or not isinstance(search_strategy, SuperabundantSearchStrategy)):
+        return search_strategy.generate_search_blocks(
+            count=args.refresh_count,
+            batch_size=args.block_size
+        )
+
+    cost_model = fit_cost_model(
+        divisorDb.load_level_stats(search_strategy.index_name()),
+        divisorDb.load_finished_search_blocks(
+            search_strategy.index_name(), args.cost_model_sample_size))
+    return generate_timed_search_blocks(
+        search_strategy,
+        count=args.refresh_count,
+        cost_model=cost_model,
+        target_seconds=args.target_block_seconds,
+        default_block_size=args.block_size,
+        min_block_size=args.min_block_size,
+        max_block_size=args.max_block_size,
+    )
+
+
+def refresh_search_blocks(divisorDb: DivisorDb,
+                          search_strategy: SearchStrategy,
+                          args) -> None:
+    '''
+    Generate and insert new search blocks if fewer than
+    args.refresh_threshold are eligible to be claimed.
+    '''
+    start = datetime.now()
+    index_name = search_strategy.index_name()
+    eligible_count = divisorDb.count_eligible_search_blocks(index_name)
+
+    if eligible_count < args.refresh_threshold:
+        starting_index = divisorDb.load_next_search_index(index_name)
+        if starting_index is None:
+            # The database predates stored search indices, or is empty
+            all_metadata = divisorDb.load_metadata()
+            starting_index = get_starting_index(
+                search_strategy,
+                all_metadata,
+                get_eligible_blocks(all_metadata))
+        search_strategy = search_strategy.starting_from(starting_index)
+        new_blocks = generate_blocks(divisorDb, search_strategy, args)
+        divisorDb.insert_search_blocks(
+            new_blocks,
+            next_search_index=search_strategy.search_index())
+        end = datetime.now()
+        print(
+            f"Computed {len(new_blocks)} new search blocks "
+            f"in {end-start}"
+        )
+    else:
+        print(
+            f"Found {eligible_count} eligible blocks. "
+            f"Waiting until less than {args.refresh_threshold} to refresh."
+        )
+
+
 def main(divisorDb: DivisorDb,
          search_strategy: SearchStrategy,
          args=None) -> None:
     failure_count = 0
     while True:
         try:
-            start = datetime.now()
-            all_metadata = divisorDb.load_metadata()
-            eligible_blocks = get_eligible_blocks(all_metadata)
-
-            if len(eligible_blocks) < args.refresh_threshold:
-                starting_index = get_starting_index(
-                    search_strategy,
-                    all_metadata,
-                    eligible_blocks)
-                new_blocks = search_strategy.starting_from(
-                    starting_index).generate_search_blocks(
-                    count=args.refresh_count,
-                    batch_size=args.block_size
-                )
-                divisorDb.insert_search_blocks(new_blocks)
-                end = datetime.now()
-                print(
-                    f"Computed {len(new_blocks)} new search blocks "
-                    f"in {end-start}"
-                )
-            else:
-                print(
-                    f"Found {len(eligible_blocks)} eligible blocks. "
-                    f"Waiting until less than {args.refresh_threshold} to refresh."
-                )
-
+            refresh_search_blocks(divisorDb, search_strategy, args)
             failure_count = 0
         except ValueError as e:
             print(f"Failed with error: {e}")
@@ -95,6 +140,11 @@ if __name__ == "__main__":
         type=str,
         help='The psycopg data_source_name string'
     )
+    parser.add_argument(
+        '--sqlite_path',
+        type=str,
+        help='If set, use the sqlite database in this file instead of postgres'
+    )
     parser.add_argument(
         '--search_strategy_name',
         type=str,
@@ -108,6 +158,33 @@ if __name__ == "__main__":
         default=250000,
         help='The size of a single search block'
     )
+    parser.add_argument(
+        '--target_block_seconds',
+        type=float,
+        default=None,
+        help='If set, size superabundant search blocks to take about this '
+             'many seconds, using the compute time in the level statistics. '
+             '--block_size is used until durations have been measured.'
+    )
+    parser.add_argument(
+        '--min_block_size',
+        type=int,
+        default=1000,
+        help='The smallest block size chosen by --target_block_seconds'
+    )
+    parser.add_argument(
+        '--max_block_size',
+        type=int,
+        default=10000000,
+        help='The largest block size chosen by --target_block_seconds'
+    )
+    parser.add_argument(
+        '--cost_model_sample_size',
+        type=int,
+        default=500,
+        help='The number of recently finished blocks used to measure the '
+             'overhead of a block beyond its compute time'
+    )
     parser.add_argument(
         '--refresh_count',
         type=int,
@@ -128,7 +205,11 @@ if __name__ == "__main__":
     )
 
     args = parser.parse_args()
-    db = PostgresDivisorDb(data_source_name=args.data_source_name)
+    db: DivisorDb
+    if args.sqlite_path:
+        db = SqliteDivisorDb(args.sqlite_path)
+    else:
+        db = PostgresDivisorDb(data_source_name=args.data_source_name)
     search_strategy_name = args.search_strategy_name
     search_strategy = search_strategy_by_name(search_strategy_name)()
     main(db, search_strategy, args)
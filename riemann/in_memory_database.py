@@ -1,21 +1,93 @@
-'''A simple in-memory divisor database.'''
+'''
+An in-memory divisor database.
+
+Claimable and in-progress blocks are kept in per-type heaps, and the summary
+statistics are maintained as blocks are finished, so that claims, finishes
+and summaries stay fast with millions of search blocks. The whole database
+can be snapshotted to disk and restored.
+'''
+from collections import defaultdict
 from datetime import datetime
+from datetime import timedelta
+from typing import Dict
 from typing import Iterable
 from typing import List
+from typing import Optional
+from typing import Tuple
+import bisect
+import heapq
+import itertools
+import os
+import pickle
 
 from dataclasses import replace
+from gmpy2 import log
 from riemann.database import DivisorDb
+from riemann.level_stats import block_level_stats
+from riemann.level_stats import count_pruned
+from riemann.level_stats import merge_all_level_stats
+from riemann.search_archive import adjacent_range_keys
+from riemann.search_archive import merge_archived_ranges
+from riemann.search_archive import next_search_index
+from riemann.search_archive import search_index_order
+from riemann.superabundant import prime_factor_count
+from riemann.types import ArchivedSearchRange
+from riemann.types import LevelStats
 from riemann.types import RiemannDivisorSum
+from riemann.types import SearchIndex
 from riemann.types import SearchBlockState
 from riemann.types import SearchMetadata
 from riemann.types import SummaryStats
 from riemann.types import hash_divisor_sums
+from sortedcontainers import SortedList  # type: ignore
+
+CLAIMABLE_STATES = [SearchBlockState.NOT_STARTED, SearchBlockState.FAILED]
 
 
 class InMemoryDivisorDb(DivisorDb):
     def __init__(self):
-        self.data = dict()
-        self.metadata = dict()
+        self.data: Dict[int, RiemannDivisorSum] = dict()
+        self.metadata: Dict[Tuple, SearchMetadata] = dict()
+        self.speculative_claims: Dict[Tuple, int] = dict()
+        self.next_search_index: Dict[str, SearchIndex] = dict()
+
+        # Heap entries are (time, insertion order, key). Entries are not
+        # removed when a block changes state, but skipped when they no longer
+        # match the stored block.
+        self.claimable: Dict[str, List] = defaultdict(list)
+        self.in_progress: Dict[str, List] = defaultdict(list)
+        self.eligible_count: Dict[str, int] = defaultdict(int)
+        self.finished: Dict[str, List[Tuple]] = defaultdict(list)
+        # a plain int rather than an itertools.count, so snapshots only
+        # pickle plain data
+        self.insertion_order = 0
+
+        self.largest_computed_n: Optional[RiemannDivisorSum] = None
+        self.largest_witness_value: Optional[RiemannDivisorSum] = None
+        # witness value records, sorted by n, with their n's for bisection
+        self.witness_records: List[RiemannDivisorSum] = []
+        self.witness_record_ns: List[int] = []
+        self.level_stats: Dict[str, Dict[int, LevelStats]] = defaultdict(dict)
+        # sorted (key, n) pairs, for range and top-K queries
+        self.by_witness_value: SortedList = SortedList()
+        self.by_log_n: SortedList = SortedList()
+        self.by_level: Dict[int, SortedList] = defaultdict(SortedList)
+        # archived ranges by type and starting index
+        self.archive: Dict[str, Dict[SearchIndex, ArchivedSearchRange]] = (
+            defaultdict(dict))
+
+    def snapshot(self, path: str) -> None:
+        '''Atomically write the entire database to a file.'''
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as outfile:
+            pickle.dump(self, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def restore(path: str) -> 'InMemoryDivisorDb':
+        '''Load a database written by snapshot.'''
+        with open(path, 'rb') as infile:
+            return pickle.load(infile)
 
     def load(self) -> Iterable[RiemannDivisorSum]:
         return self.data.values()
@@ -23,13 +95,35 @@ class InMemoryDivisorDb(DivisorDb):
     def load_metadata(self) -> List[SearchMetadata]:
         return list(self.metadata.values())
 
+    def load_finished_search_blocks(
+            self,
+            search_index_type: str,
+            count: int) -> List[SearchMetadata]:
+        # blocks are appended in the order they finish
+        recent: List[SearchMetadata] = []
+        for key in reversed(self.finished[search_index_type]):
+            if len(recent) >= count:
+                break
+            block = self.metadata.get(key)
+            if block is not None and block.state == SearchBlockState.FINISHED:
+                recent.append(block)
+        return recent
+
     def initialize_schema(self):
         pass
 
-    def insert_search_blocks(self, blocks: List[SearchMetadata]) -> None:
-        already_processed_pks = set(self.metadata.keys())
-        proposed_pks = set([x.key() for x in blocks])
-        duplicates = already_processed_pks & proposed_pks
+    def insert_search_blocks(
+            self,
+            blocks: List[SearchMetadata],
+            next_search_index: Optional[SearchIndex] = None) -> None:
+        # Only the proposed keys are checked, not every existing block.
+        duplicates = set()
+        seen = set()
+        for block in blocks:
+            pk = block.key()
+            if pk in self.metadata or pk in seen:
+                duplicates.add(pk)
+            seen.add(pk)
 
         if duplicates:
             raise ValueError(f"PK violation for key values={duplicates}")
@@ -37,47 +131,287 @@ class InMemoryDivisorDb(DivisorDb):
         for block in blocks:
             block = replace(block, state=SearchBlockState.NOT_STARTED)
             self.metadata[block.key()] = block
+            self.push_claimable(block)
+
+        if next_search_index is not None:
+            self.next_search_index[
+                next_search_index.__class__.__name__] = next_search_index
+
+    def next_insertion_order(self) -> int:
+        '''The next tiebreaker of heap entries with the same time.'''
+        self.insertion_order += 1
+        return self.insertion_order
+
+    def push_claimable(self, block: SearchMetadata) -> None:
+        heapq.heappush(
+            self.claimable[block.search_index_type],
+            (block.creation_time, self.next_insertion_order(), block.key()))
+        self.eligible_count[block.search_index_type] += 1
+
+    def load_next_search_index(
+            self, search_index_type: str) -> Optional[SearchIndex]:
+        return self.next_search_index.get(search_index_type)
+
+    def count_eligible_search_blocks(self, search_index_type: str) -> int:
+        return self.eligible_count[search_index_type]
 
     def claim_next_search_block(self,
                                 search_index_type: str) -> SearchMetadata:
-        eligible = [
-            x for x in self.metadata.values()
-            if x.state == SearchBlockState.NOT_STARTED
-        ]
-        chosen = min(eligible, key=lambda metadata: metadata.creation_time)
+        claimable = self.claimable[search_index_type]
+        while claimable:
+            (_, _, key) = heapq.heappop(claimable)
+            block = self.metadata.get(key)
+            if block is not None and block.state in CLAIMABLE_STATES:
+                break
+        else:
+            raise ValueError('No legal search block to claim')
+
+        self.eligible_count[search_index_type] -= 1
         chosen = replace(
-            chosen,
+            block,
             state=SearchBlockState.IN_PROGRESS,
             start_time=datetime.now(),
+            claim_token=(block.claim_token or 0) + 1,
         )
-        self.metadata[chosen.key()] = chosen
+        self.metadata[key] = chosen
+        heapq.heappush(
+            self.in_progress[search_index_type],
+            (chosen.start_time, self.next_insertion_order(), key))
+        return chosen
+
+    def claim_speculative_search_block(
+            self,
+            search_index_type: str,
+            running_for: timedelta,
+            max_copies: int = 1) -> SearchMetadata:
+        started_before = datetime.now() - running_for
+        in_progress = self.in_progress[search_index_type]
+        skipped = []
+        chosen = None
+        while in_progress and in_progress[0][0] < started_before:
+            entry = heapq.heappop(in_progress)
+            (start_time, _, key) = entry
+            block = self.metadata.get(key)
+            if (block is None
+                    or block.state != SearchBlockState.IN_PROGRESS
+                    or block.start_time != start_time):
+                continue
+            # keep the entry, since the block may be speculated on again
+            skipped.append(entry)
+            if self.speculative_claims.get(key, 0) < max_copies:
+                chosen = block
+                break
+
+        for entry in skipped:
+            heapq.heappush(in_progress, entry)
+
+        if chosen is None:
+            raise ValueError('No search block to speculatively claim')
+
+        self.speculative_claims[chosen.key()] = (
+            self.speculative_claims.get(chosen.key(), 0) + 1)
         return chosen
 
     def finish_search_block(self, metadata: SearchMetadata,
                             divisor_sums: List[RiemannDivisorSum]) -> None:
-        block_hash = hash_divisor_sums(divisor_sums)
+        block_hash = metadata.block_hash or hash_divisor_sums(divisor_sums)
+        stored = self.metadata.get(metadata.key())
+        if (stored is not None
+                and stored.state == SearchBlockState.FINISHED
+                and stored.block_hash == block_hash):
+            return
+        if stored is None or stored.state != SearchBlockState.IN_PROGRESS:
+            raise ValueError(
+                f"The block was not found or not IN_PROGRESS! "
+                f"metadata={metadata}")
+        if not self.holds_claim(stored, metadata):
+            raise ValueError(
+                f"The block was claimed again since! "
+                f"stored={stored.claim_token} metadata={metadata}")
+
+        [to_store] = self.divisor_sums_to_store([(metadata, divisor_sums)])
         block = replace(
-            metadata,
+            stored,
             state=SearchBlockState.FINISHED,
             end_time=datetime.now(),
             block_hash=block_hash,
+            storage_policy=self.get_storage_policy().version(),
         )
         self.metadata[block.key()] = block
-        for divisor_sum in divisor_sums:
-            if divisor_sum.witness_value > self.threshold_witness_value:
-                self.data[divisor_sum.n] = divisor_sum
+        self.finished[block.search_index_type].append(block.key())
+        self.speculative_claims.pop(block.key(), None)
+        self.level_stats[block.search_index_type] = merge_all_level_stats(
+            count_pruned(
+                block_level_stats(
+                    metadata, divisor_sums, self.threshold_witness_value),
+                metadata, to_store),
+            into=self.level_stats[block.search_index_type])
+
+        for divisor_sum in to_store:
+            self.store(divisor_sum)
+
+    def store(self, divisor_sum: RiemannDivisorSum) -> None:
+        if divisor_sum.n not in self.data:
+            n = divisor_sum.n
+            witness_value = float(divisor_sum.witness_value)
+            self.by_witness_value.add((witness_value, n))
+            self.by_log_n.add((float(log(n)), n))
+            self.by_level[prime_factor_count(n)].add((witness_value, n))
+        self.data[divisor_sum.n] = divisor_sum
+        if (self.largest_computed_n is None
+                or divisor_sum.n > self.largest_computed_n.n):
+            self.largest_computed_n = divisor_sum
+        if (self.largest_witness_value is None
+                or divisor_sum.witness_value >
+                self.largest_witness_value.witness_value):
+            self.largest_witness_value = divisor_sum
+        self.store_witness_record(divisor_sum)
+
+    def store_witness_record(self, divisor_sum: RiemannDivisorSum) -> None:
+        position = bisect.bisect_left(self.witness_record_ns, divisor_sum.n)
+        if (position > 0 and divisor_sum.witness_value <=
+                self.witness_records[position - 1].witness_value):
+            return
+
+        # records are increasing in witness value, so the records this one
+        # supersedes directly follow it
+        end = position
+        while (end < len(self.witness_records) and
+               self.witness_records[end].witness_value <= divisor_sum.witness_value):
+            end += 1
+        self.witness_records[position:end] = [divisor_sum]
+        self.witness_record_ns[position:end] = [divisor_sum.n]
+
+    def load_witness_records(self) -> List[RiemannDivisorSum]:
+        return list(self.witness_records)
+
+    def load_top_witness_values(
+            self,
+            count: int,
+            level: Optional[int] = None) -> List[RiemannDivisorSum]:
+        if count <= 0:
+            return []
+        index = self.by_witness_value if level is None else self.by_level[level]
+        return [self.data[n] for (_, n) in reversed(index[-count:])]
+
+    def load_log_n_range(
+            self,
+            min_log_n: float,
+            max_log_n: float) -> List[RiemannDivisorSum]:
+        start = self.by_log_n.bisect_left((min_log_n,))
+        end = self.by_log_n.bisect_left((max_log_n,))
+        return [self.data[n] for (_, n) in self.by_log_n[start:end]]
+
+    def load_above_witness_value(
+            self, min_witness_value: float) -> List[RiemannDivisorSum]:
+        start = self.by_witness_value.bisect_left((min_witness_value,))
+        return [
+            self.data[n]
+            for n in sorted(n for (_, n) in self.by_witness_value[start:])
+        ]
+
+    def load_level_stats(self, search_index_type: str) -> List[LevelStats]:
+        stats = self.level_stats[search_index_type]
+        return [stats[level] for level in sorted(stats)]
+
+    def max_divisor_sum_id(self) -> int:
+        # the id of a divisor sum is its position in insertion order, from 1
+        return len(self.data)
+
+    def load_log_n_and_witness_values(
+            self,
+            after_id: int,
+            through_id: int) -> List[Tuple[float, float]]:
+        return [
+            (float(log(d.n)), float(d.witness_value))
+            for d in itertools.islice(
+                self.data.values(), max(after_id, 0), max(through_id, 0))
+        ]
+
+    def holds_claim(self,
+                    stored: SearchMetadata,
+                    metadata: SearchMetadata) -> bool:
+        return (metadata.claim_token is None
+                or metadata.claim_token == stored.claim_token)
+
+    def renew_claim(self, metadata: SearchMetadata) -> SearchMetadata:
+        stored = self.metadata.get(metadata.key())
+        if (stored is None or stored.state != SearchBlockState.IN_PROGRESS
+                or not self.holds_claim(stored, metadata)):
+            raise ValueError(
+                f"The block is no longer claimed! metadata={metadata}")
+        block = replace(stored, start_time=datetime.now())
+        self.metadata[block.key()] = block
+        heapq.heappush(
+            self.in_progress[block.search_index_type],
+            (block.start_time, self.next_insertion_order(), block.key()))
+        return replace(metadata, start_time=block.start_time)
 
     def mark_block_as_failed(self, metadata: SearchMetadata) -> None:
-        block = replace(metadata, state=SearchBlockState.FAILED)
+        stored = self.metadata.get(metadata.key())
+        if (stored is None or stored.state != SearchBlockState.IN_PROGRESS
+                or not self.holds_claim(stored, metadata)):
+            return
+        block = replace(stored, state=SearchBlockState.FAILED)
         self.metadata[block.key()] = block
+        self.speculative_claims.pop(block.key(), None)
+        self.push_claimable(block)
+
+    def compact_finished_search_blocks(
+            self,
+            search_index_type: str,
+            finished_before: datetime,
+            max_blocks: int = 10000) -> int:
+        if self.load_next_search_index(search_index_type) is None:
+            return 0
+
+        # blocks are appended in the order they finish
+        blocks: List[SearchMetadata] = []
+        for key in self.finished[search_index_type]:
+            block = self.metadata.get(key)
+            if block is None or block.state != SearchBlockState.FINISHED:
+                continue
+            if (len(blocks) >= max_blocks or block.end_time is None
+                    or block.end_time >= finished_before):
+                break
+            blocks.append(block)
+        if not blocks:
+            return 0
+
+        archive = self.archive[search_index_type]
+        (followed_by, starting_at) = adjacent_range_keys(blocks)
+        followed_by_set = set(followed_by)
+        candidates = [
+            archive[start] for start in starting_at if start in archive
+        ] + [
+            r for r in archive.values()
+            if next_search_index(r.ending_search_index) in followed_by_set
+        ]
+        (removed, added) = merge_archived_ranges(candidates, blocks)
+        for archived_range in removed:
+            archive.pop(archived_range.starting_search_index, None)
+        for archived_range in added:
+            archive[archived_range.starting_search_index] = archived_range
+
+        archived_keys = set(block.key() for block in blocks)
+        for key in archived_keys:
+            del self.metadata[key]
+            self.speculative_claims.pop(key, None)
+        self.finished[search_index_type] = [
+            key for key in self.finished[search_index_type]
+            if key not in archived_keys
+        ]
+        return len(blocks)
+
+    def load_archived_search_ranges(
+            self, search_index_type: str) -> List[ArchivedSearchRange]:
+        return sorted(
+            self.archive[search_index_type].values(),
+            key=lambda r: search_index_order(r.starting_search_index))
 
     def summarize(self) -> SummaryStats:
-        if not self.data:
+        if self.largest_computed_n is None or self.largest_witness_value is None:
             raise ValueError("No data!")
 
-        largest_computed_n = max(self.data.values(), key=lambda x: x.n)
-        largest_witness_value = max(self.data.values(),
-                                    key=lambda x: x.witness_value)
-
-        return SummaryStats(largest_computed_n=largest_computed_n,
-                            largest_witness_value=largest_witness_value)
+        return SummaryStats(largest_computed_n=self.largest_computed_n,
+                            largest_witness_value=self.largest_witness_value)
@@ -0,0 +1,402 @@
+'''
+A durable local journal that lets workers keep computing through database
+outages.
+
+Workers lease a few search blocks at a time. Each finished block is appended
+to an on-disk journal, together with its hash and the divisor sums worth
+storing, before any attempt to write it to the database. When the database is
+reachable the journal is replayed into it in bulk and truncated. Replay is
+idempotent: the database only finishes blocks that are IN_PROGRESS, so a block
+replayed twice is stored once.
+'''
+from datetime import datetime
+from datetime import timedelta
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Type
+import json
+import os
+
+from dataclasses import asdict
+from dataclasses import replace
+from gmpy2 import mpz
+from riemann.database import DivisorDb
+from riemann.level_stats import block_level_stats
+from riemann.types import ArchivedSearchRange
+from riemann.types import LevelStats
+from riemann.types import RiemannDivisorSum
+from riemann.types import SearchIndex
+from riemann.types import SearchBlockState
+from riemann.types import SearchMetadata
+from riemann.types import SummaryStats
+from riemann.types import deserialize_search_index
+from riemann.types import hash_divisor_sums
+
+LEASE_FILENAME = 'leased_blocks.json'
+JOURNAL_FILENAME = 'finished_blocks.jsonl'
+
+
+def serialize_datetime(value: Optional[datetime]) -> Optional[str]:
+    return value.isoformat() if value is not None else None
+
+
+def deserialize_datetime(value: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value is not None else None
+
+
+def metadata_to_record(metadata: SearchMetadata) -> Dict:
+    return dict(
+        search_index_type=metadata.search_index_type,
+        starting_search_index=metadata.starting_search_index.serialize(),
+        ending_search_index=metadata.ending_search_index.serialize(),
+        state=metadata.state.name,
+        creation_time=serialize_datetime(metadata.creation_time),
+        start_time=serialize_datetime(metadata.start_time),
+        end_time=serialize_datetime(metadata.end_time),
+        block_hash=metadata.block_hash,
+        storage_policy=metadata.storage_policy,
+        claim_token=metadata.claim_token,
+        level_stats=(
+            [asdict(stats) for stats in metadata.level_stats]
+            if metadata.level_stats is not None else None),
+    )
+
+
+def record_to_metadata(record: Dict) -> SearchMetadata:
+    search_index_type = record['search_index_type']
+    return SearchMetadata(
+        starting_search_index=deserialize_search_index(
+            search_index_type, record['starting_search_index']),
+        ending_search_index=deserialize_search_index(
+            search_index_type, record['ending_search_index']),
+        search_index_type=search_index_type,
+        state=SearchBlockState[record['state']],
+        creation_time=datetime.fromisoformat(record['creation_time']),
+        start_time=deserialize_datetime(record['start_time']),
+        end_time=deserialize_datetime(record['end_time']),
+        block_hash=record['block_hash'],
+        storage_policy=record.get('storage_policy'),
+        claim_token=record.get('claim_token'),
+        level_stats=(
+            tuple(
+                LevelStats(**dict(
+                    stats, witness_histogram=tuple(stats['witness_histogram'])))
+                for stats in record['level_stats'])
+            if record.get('level_stats') is not None else None),
+    )
+
+
+class Journal:
+    '''The on-disk state of a journaling worker: its lease and its journal.'''
+
+    def __init__(self, journal_dir: str):
+        os.makedirs(journal_dir, exist_ok=True)
+        self.lease_path = os.path.join(journal_dir, LEASE_FILENAME)
+        self.journal_path = os.path.join(journal_dir, JOURNAL_FILENAME)
+
+    def load_lease(self) -> List[SearchMetadata]:
+        if not os.path.exists(self.lease_path):
+            return []
+        with open(self.lease_path) as infile:
+            return [record_to_metadata(record) for record in json.load(infile)]
+
+    def store_lease(self, blocks: List[SearchMetadata]) -> None:
+        tmp_path = self.lease_path + '.tmp'
+        with open(tmp_path, 'w') as outfile:
+            json.dump([metadata_to_record(block) for block in blocks], outfile)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(tmp_path, self.lease_path)
+
+    def append(self,
+               metadata: SearchMetadata,
+               divisor_sums: List[RiemannDivisorSum]) -> None:
+        '''Durably append a finished block, whose hash must be set.'''
+        record = metadata_to_record(metadata)
+        record['divisor_sums'] = [
+            ["%s" % d.n, "%s" % d.divisor_sum, float(d.witness_value)]
+            for d in divisor_sums
+        ]
+        with open(self.journal_path, 'a') as outfile:
+            outfile.write(json.dumps(record) + '\n')
+            outfile.flush()
+            os.fsync(outfile.fileno())
+
+    def load(self) -> List[Tuple[SearchMetadata, List[RiemannDivisorSum]]]:
+        '''
+        Load the journaled blocks, keeping the last entry for each block key.
+        A partially written trailing line from a crash is ignored.
+        '''
+        if not os.path.exists(self.journal_path):
+            return []
+
+        entries: Dict[Tuple, Tuple[SearchMetadata, List[RiemannDivisorSum]]] = {}
+        with open(self.journal_path) as infile:
+            for line in infile:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                metadata = record_to_metadata(record)
+                divisor_sums = [
+                    RiemannDivisorSum(
+                        n=mpz(n), divisor_sum=mpz(ds), witness_value=wv)
+                    for (n, ds, wv) in record['divisor_sums']
+                ]
+                entries[metadata.key()] = (metadata, divisor_sums)
+        return list(entries.values())
+
+    def truncate(self) -> None:
+        with open(self.journal_path, 'w') as outfile:
+            outfile.flush()
+            os.fsync(outfile.fileno())
+
+
+def check_lease_duration(lease_size: int,
+                         block_duration: timedelta,
+                         stale_threshold: timedelta) -> None:
+    '''
+    Raise ValueError if a worker cannot compute a whole lease of blocks,
+    each taking about block_duration, before they are considered stale.
+    '''
+    if lease_size * block_duration >= stale_threshold:
+        raise ValueError(
+            f"A lease of {lease_size} blocks of {block_duration} each goes "
+            f"stale after {stale_threshold} without the database; lease "
+            f"fewer blocks")
+
+
+class JournalingDivisorDb(DivisorDb):
+    '''
+    A DivisorDb that keeps workers computing while the database it wraps is
+    unreachable.
+
+    Blocks are claimed lease_size at a time and remembered on disk, and
+    finished blocks are journaled before being replayed into the database.
+    The database is reconnected using db_factory after any error in
+    unavailable_errors.
+
+    The claim of each leased block is renewed when the worker starts it, so
+    in normal operation no leased block goes stale. While the database is
+    unavailable claims cannot be renewed, so the last block of a lease goes
+    stale once lease_size blocks' worth of time has passed since the lease
+    or the last renewal; check_lease_duration validates that against the
+    stale threshold. A block that goes stale may be recomputed elsewhere, in
+    which case whichever finish reaches the database first is kept.
+    '''
+
+    def __init__(self,
+                 db_factory: Callable[[], DivisorDb],
+                 journal_dir: str,
+                 lease_size: int = 8,
+                 unavailable_errors: Tuple[Type[BaseException], ...] = (
+                     OSError, EOFError)):
+        self.db_factory = db_factory
+        self.db: Optional[DivisorDb] = None
+        self.journal = Journal(journal_dir)
+        self.lease_size = lease_size
+        self.unavailable_errors = unavailable_errors
+        self.leased = self.journal.load_lease()
+
+    def database(self) -> DivisorDb:
+        if self.db is None:
+            self.db = self.db_factory()
+        return self.db
+
+    def sync(self) -> bool:
+        '''
+        Replay the journal into the database, returning False if the database
+        is unavailable.
+        '''
+        entries = self.journal.load()
+        if not entries:
+            return True
+
+        try:
+            self.database().finish_search_blocks(entries)
+        except self.unavailable_errors as e:
+            print(f"Database unavailable, keeping {len(entries)} "
+                  f"journaled blocks. Error was: {e}")
+            self.db = None
+            return False
+        except ValueError as e:
+            # these blocks were already finished, or reclaimed by another
+            # worker after being marked stale.
+            print(f"Dropped rejected journaled blocks: {e}")
+
+        self.journal.truncate()
+        return True
+
+    def initialize_schema(self):
+        self.database().initialize_schema()
+
+    def load(self) -> Iterable[RiemannDivisorSum]:
+        self.sync()
+        return self.database().load()
+
+    def load_metadata(self) -> List[SearchMetadata]:
+        self.sync()
+        return self.database().load_metadata()
+
+    def load_finished_search_blocks(
+            self,
+            search_index_type: str,
+            count: int) -> List[SearchMetadata]:
+        self.sync()
+        return self.database().load_finished_search_blocks(
+            search_index_type, count)
+
+    def summarize(self) -> SummaryStats:
+        self.sync()
+        return self.database().summarize()
+
+    def load_witness_records(self) -> List[RiemannDivisorSum]:
+        self.sync()
+        return self.database().load_witness_records()
+
+    def load_top_witness_values(
+            self,
+            count: int,
+            level: Optional[int] = None) -> List[RiemannDivisorSum]:
+        self.sync()
+        return self.database().load_top_witness_values(count, level)
+
+    def load_log_n_range(
+            self,
+            min_log_n: float,
+            max_log_n: float) -> List[RiemannDivisorSum]:
+        self.sync()
+        return self.database().load_log_n_range(min_log_n, max_log_n)
+
+    def load_above_witness_value(
+            self, min_witness_value: float) -> List[RiemannDivisorSum]:
+        self.sync()
+        return self.database().load_above_witness_value(min_witness_value)
+
+    def load_level_stats(self, search_index_type: str) -> List[LevelStats]:
+        self.sync()
+        return self.database().load_level_stats(search_index_type)
+
+    def max_divisor_sum_id(self) -> int:
+        self.sync()
+        return self.database().max_divisor_sum_id()
+
+    def load_log_n_and_witness_values(
+            self,
+            after_id: int,
+            through_id: int) -> List[Tuple[float, float]]:
+        self.sync()
+        return self.database().load_log_n_and_witness_values(
+            after_id, through_id)
+
+    def insert_search_blocks(
+            self,
+            blocks: List[SearchMetadata],
+            next_search_index: Optional[SearchIndex] = None) -> None:
+        self.database().insert_search_blocks(blocks, next_search_index)
+
+    def load_next_search_index(
+            self, search_index_type: str) -> Optional[SearchIndex]:
+        return self.database().load_next_search_index(search_index_type)
+
+    def count_eligible_search_blocks(self, search_index_type: str) -> int:
+        return self.database().count_eligible_search_blocks(search_index_type)
+
+    def claim_next_search_block(self, search_index_type: str) -> SearchMetadata:
+        while True:
+            leased = [
+                block for block in self.leased
+                if block.search_index_type == search_index_type
+            ]
+            just_claimed = not leased
+            if just_claimed:
+                try:
+                    if self.sync():
+                        leased = self.database().claim_next_search_blocks(
+                            search_index_type, self.lease_size)
+                except self.unavailable_errors as e:
+                    self.db = None
+                    print(f"Failed to lease search blocks. Error was: {e}")
+
+                if not leased:
+                    raise ValueError(
+                        'No legal search block to claim, and no leased blocks '
+                        'remain')
+                self.leased.extend(leased)
+
+            # a block that is claimed but never finished, e.g., because the
+            # worker crashed, is eventually marked stale and recomputed.
+            claimed = leased[0]
+            self.leased.remove(claimed)
+            self.journal.store_lease(self.leased)
+            if just_claimed:
+                return claimed
+
+            # its start_time is that of the lease, so it is renewed now
+            try:
+                return self.database().renew_claim(claimed)
+            except self.unavailable_errors as e:
+                self.db = None
+                print(f"Failed to renew a leased block. Error was: {e}")
+                return claimed
+            except ValueError as e:
+                print(f"Dropped a leased block claimed elsewhere: {e}")
+
+    def claim_speculative_search_block(
+            self,
+            search_index_type: str,
+            running_for: timedelta,
+            max_copies: int = 1) -> SearchMetadata:
+        try:
+            return self.database().claim_speculative_search_block(
+                search_index_type, running_for, max_copies)
+        except self.unavailable_errors as e:
+            self.db = None
+            raise ValueError(
+                f"Failed to speculatively claim a search block. "
+                f"Error was: {e}")
+
+    def finish_search_block(self,
+                            metadata: SearchMetadata,
+                            divisor_sums: List[RiemannDivisorSum]) -> None:
+        # the hash and statistics need every divisor sum, so they are
+        # computed before the rest are dropped
+        metadata = replace(
+            metadata,
+            block_hash=metadata.block_hash or hash_divisor_sums(divisor_sums),
+            level_stats=block_level_stats(
+                metadata, divisor_sums, self.threshold_witness_value))
+        # Without the record, the policy keeps a superset of the divisor sums
+        # the database's policy will keep.
+        self.journal.append(metadata, self.get_storage_policy().select(
+            metadata, divisor_sums, None))
+        self.sync()
+
+    def compact_finished_search_blocks(
+            self,
+            search_index_type: str,
+            finished_before: datetime,
+            max_blocks: int = 10000) -> int:
+        self.sync()
+        return self.database().compact_finished_search_blocks(
+            search_index_type, finished_before, max_blocks)
+
+    def load_archived_search_ranges(
+            self, search_index_type: str) -> List[ArchivedSearchRange]:
+        self.sync()
+        return self.database().load_archived_search_ranges(search_index_type)
+
+    def renew_claim(self, metadata: SearchMetadata) -> SearchMetadata:
+        return self.database().renew_claim(metadata)
+
+    def mark_block_as_failed(self, metadata: SearchMetadata) -> None:
+        try:
+            self.database().mark_block_as_failed(metadata)
+        except self.unavailable_errors as e:
+            # the block will be marked as stale once the database returns
+            self.db = None
+            print(f"Failed to mark block as failed. Error was: {e}")
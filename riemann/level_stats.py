@@ -0,0 +1,227 @@
+'''
+Per-level statistics about computed divisor sums.
+
+The statistics of a block are computed by the worker that processes it, from
+all of the block's divisor sums, and merged into the database's totals when
+the block is finished. This allows progress and the distribution of witness
+values to be viewed level by level, without scanning the stored divisor sums,
+which only include the largest witness values.
+'''
+from bisect import bisect_right
+from collections import Counter
+from dataclasses import replace
+from datetime import datetime
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from gmpy2 import floor
+from gmpy2 import log
+from riemann.superabundant import cached_count_partitions_of_n
+from riemann.superabundant import prime_factor_count
+from riemann.types import LevelStats
+from riemann.types import RiemannDivisorSum
+from riemann.types import SearchMetadata
+from riemann.types import SuperabundantEnumerationIndex
+
+WITNESS_HISTOGRAM_EDGES = (
+    0.0, 1.0, 1.5, 1.6, 1.65, 1.7, 1.72, 1.74, 1.75, 1.76, 1.767, 1.77, 1.775,
+    1.78, 1.785, 1.79,
+)
+
+
+def histogram_bin(witness_value: float) -> int:
+    return max(0, bisect_right(WITNESS_HISTOGRAM_EDGES, witness_value) - 1)
+
+
+def superabundant_indices(
+        start: SuperabundantEnumerationIndex
+) -> Iterator[SuperabundantEnumerationIndex]:
+    '''Enumerate the superabundant search indices starting from start.'''
+    level = start.level
+    index_in_level = start.index_in_level
+    level_size = cached_count_partitions_of_n(level)
+    while True:
+        if index_in_level >= level_size:
+            level += 1
+            index_in_level = 0
+            level_size = cached_count_partitions_of_n(level)
+        yield SuperabundantEnumerationIndex(
+            level=level, index_in_level=index_in_level)
+        index_in_level += 1
+
+
+def block_size(block: SearchMetadata) -> int:
+    '''The number of search indices in a block.'''
+    start = block.starting_search_index
+    end = block.ending_search_index
+    if isinstance(start, SuperabundantEnumerationIndex):
+        return sum(
+            cached_count_partitions_of_n(level)
+            for level in range(start.level, end.level)
+        ) - start.index_in_level + end.index_in_level + 1
+    return end.n - start.n + 1
+
+
+def row_levels(
+        block: SearchMetadata,
+        divisor_sums: List[RiemannDivisorSum]) -> List[int]:
+    '''
+    The level of each divisor sum, i.e., the number of prime factors of its n
+    counted with multiplicity. The levels of all the divisor sums of a
+    superabundant block are read off its search indices, and are otherwise
+    computed by factoring.
+    '''
+    if (isinstance(block.starting_search_index, SuperabundantEnumerationIndex)
+            and len(divisor_sums) == block_size(block)):
+        return [
+            index.level for (index, _) in zip(
+                superabundant_indices(block.starting_search_index),
+                divisor_sums)
+        ]
+    return [prime_factor_count(d.n) for d in divisor_sums]
+
+
+def magnitude_level(n: int) -> int:
+    '''The level of n in an exhaustive search, the integer part of log n.'''
+    return int(floor(log(n)))
+
+
+def compute_level_stats(
+        block: SearchMetadata,
+        divisor_sums: List[RiemannDivisorSum],
+        threshold_witness_value: float,
+        seconds: float = 0) -> Tuple[LevelStats, ...]:
+    '''
+    Compute the statistics of a block from all of its divisor sums, in
+    search index order. The block's seconds are split among its levels in
+    proportion to their counts. The divisor sums of an exhaustive search
+    block are grouped by magnitude_level, and since their n can be too large
+    to store as an index, the index of their max witness is not kept.
+    '''
+    indices: Iterable[Tuple[int, int]]
+    if isinstance(block.starting_search_index, SuperabundantEnumerationIndex):
+        indices = (
+            (index.level, index.index_in_level)
+            for index in superabundant_indices(block.starting_search_index))
+    else:
+        indices = ((magnitude_level(d.n), 0) for d in divisor_sums)
+
+    counts: Dict[int, int] = {}
+    above_threshold: Dict[int, int] = {}
+    max_witness: Dict[int, Tuple[float, int]] = {}
+    histograms: Dict[int, List[int]] = {}
+    for ((level, index_in_level), divisor_sum) in zip(indices, divisor_sums):
+        witness_value = float(divisor_sum.witness_value)
+        if level not in counts:
+            counts[level] = 0
+            above_threshold[level] = 0
+            max_witness[level] = (witness_value, index_in_level)
+            histograms[level] = [0] * len(WITNESS_HISTOGRAM_EDGES)
+
+        counts[level] += 1
+        if witness_value > threshold_witness_value:
+            above_threshold[level] += 1
+        if witness_value > max_witness[level][0]:
+            max_witness[level] = (witness_value, index_in_level)
+        histograms[level][histogram_bin(witness_value)] += 1
+
+    total = sum(counts.values())
+    return tuple(
+        LevelStats(
+            level=level,
+            count=counts[level],
+            count_above_threshold=above_threshold[level],
+            max_witness_value=max_witness[level][0],
+            max_witness_index=max_witness[level][1],
+            witness_histogram=tuple(histograms[level]),
+            seconds=seconds * counts[level] / total,
+        )
+        for level in sorted(counts)
+    )
+
+
+def block_level_stats(
+        block: SearchMetadata,
+        divisor_sums: List[RiemannDivisorSum],
+        threshold_witness_value: float) -> Tuple[LevelStats, ...]:
+    '''
+    The statistics to merge when finishing a block: those attached to the
+    block, or else those computed from its divisor sums.
+
+    A block with a precomputed hash may come with only the divisor sums worth
+    storing, in which case its statistics cannot be computed.
+    '''
+    if block.level_stats is not None:
+        return block.level_stats
+    if block.block_hash is not None:
+        return ()
+    seconds = 0.0
+    if block.start_time is not None:
+        seconds = (datetime.now() - block.start_time).total_seconds()
+    return compute_level_stats(
+        block, divisor_sums, threshold_witness_value, seconds)
+
+
+def count_pruned(
+        level_stats: Tuple[LevelStats, ...],
+        block: SearchMetadata,
+        stored: List[RiemannDivisorSum]) -> Tuple[LevelStats, ...]:
+    '''
+    Set the count of each level's divisor sums that were not stored, given
+    the block's level statistics and the divisor sums stored from it.
+    '''
+    if not level_stats:
+        return level_stats
+    if isinstance(block.starting_search_index, SuperabundantEnumerationIndex):
+        stored_counts = Counter(prime_factor_count(d.n) for d in stored)
+    else:
+        stored_counts = Counter(magnitude_level(d.n) for d in stored)
+    return tuple(
+        replace(stats,
+                count_pruned=max(0, stats.count - stored_counts[stats.level]))
+        for stats in level_stats
+    )
+
+
+def merge_level_stats(first: LevelStats, second: LevelStats) -> LevelStats:
+    '''Merge the statistics of the same level.'''
+    if second.max_witness_value > first.max_witness_value or first.count == 0:
+        max_witness_value = second.max_witness_value
+        max_witness_index = second.max_witness_index
+    else:
+        max_witness_value = first.max_witness_value
+        max_witness_index = first.max_witness_index
+
+    return LevelStats(
+        level=first.level,
+        count=first.count + second.count,
+        count_above_threshold=(
+            first.count_above_threshold + second.count_above_threshold),
+        count_pruned=first.count_pruned + second.count_pruned,
+        max_witness_value=max_witness_value,
+        max_witness_index=max_witness_index,
+        witness_histogram=tuple(
+            a + b for (a, b) in zip(
+                first.witness_histogram or [0] * len(second.witness_histogram),
+                second.witness_histogram or [0] * len(first.witness_histogram))
+        ),
+        seconds=first.seconds + second.seconds,
+    )
+
+
+def merge_all_level_stats(
+        level_stats: Iterable[LevelStats],
+        into: Optional[Dict[int, LevelStats]] = None) -> Dict[int, LevelStats]:
+    '''Merge statistics by level, optionally into existing statistics.'''
+    merged = dict(into) if into is not None else {}
+    for stats in level_stats:
+        if stats.level in merged:
+            merged[stats.level] = merge_level_stats(merged[stats.level], stats)
+        else:
+            merged[stats.level] = stats
+    return merged
+
@@ -0,0 +1,98 @@
+'''
+A one-off script that migrates a postgres database created before the columns
+and indexes in postgres_database.MIGRATED_COLUMNS and MIGRATED_INDEXES, which
+initialize_schema refuses to add itself.
+
+Adding the id column rewrites the whole divisor sums table, and enforcing
+that n is unique scans it for duplicates, both under an exclusive lock, so
+stop the workers and generators before running it. It then fills the summary,
+witness records and query columns for the rows stored before them.
+'''
+
+from riemann.postgres_database import PostgresDivisorDb
+from riemann.postgres_database import unmigrated_schema
+
+
+def migrate(db: PostgresDivisorDb) -> None:
+    cursor = db.connection.cursor()
+    cursor.execute("SELECT to_regclass('riemanndivisorsums') IS NOT NULL;")
+    if cursor.fetchone()[0]:
+        cursor.execute('''
+        ALTER TABLE RiemannDivisorSums
+        ADD COLUMN IF NOT EXISTS log_n double precision,
+        ADD COLUMN IF NOT EXISTS level INTEGER;
+        ''')
+        # id orders rows by insertion, for incremental and parallel exports
+        cursor.execute('''
+        ALTER TABLE RiemannDivisorSums
+        ADD COLUMN IF NOT EXISTS id BIGSERIAL;
+        ''')
+        # n is the natural key of the divisor sums. Duplicates stored before
+        # it was enforced are dropped, keeping one copy.
+        if 'index riemanndivisorsums_n' in unmigrated_schema(cursor):
+            cursor.execute('''
+            DELETE FROM RiemannDivisorSums a
+            USING RiemannDivisorSums b
+            WHERE a.n = b.n AND a.ctid > b.ctid;
+            ''')
+            cursor.execute('''
+            CREATE UNIQUE INDEX RiemannDivisorSums_n
+            ON RiemannDivisorSums (n);
+            ''')
+    cursor.execute('''
+    ALTER TABLE IF EXISTS SearchMetadata
+    ADD COLUMN IF NOT EXISTS speculative_claims INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS storage_policy TEXT,
+    ADD COLUMN IF NOT EXISTS claim_token BIGINT NOT NULL DEFAULT 0;
+    ''')
+    db.connection.commit()
+    db.initialize_schema()
+
+    # Populate the summary and witness records for rows stored before them
+    cursor = db.connection.cursor()
+    cursor.execute('''
+    UPDATE DivisorSumSummary
+    SET
+      largest_computed_n = largest.n,
+      largest_computed_n_divisor_sum = largest.divisor_sum,
+      largest_computed_n_witness_value = largest.witness_value
+    FROM (
+        SELECT n, divisor_sum, witness_value
+        FROM RiemannDivisorSums
+        ORDER BY n DESC
+        LIMIT 1
+    ) AS largest
+    WHERE largest_computed_n IS NULL;
+    ''')
+    cursor.execute('''
+    INSERT INTO WitnessRecords (n, divisor_sum, witness_value)
+    SELECT n, divisor_sum, witness_value
+    FROM (
+        SELECT
+          n,
+          divisor_sum,
+          witness_value,
+          max(witness_value) OVER (
+            ORDER BY n ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+          ) AS previous_max
+        FROM RiemannDivisorSums
+    ) AS s
+    WHERE
+      (previous_max IS NULL OR witness_value > previous_max)
+      AND NOT EXISTS (SELECT 1 FROM WitnessRecords);
+    ''')
+    db.connection.commit()
+    print(f"Backfilled {db.backfill_query_columns()} rows")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Migrate a database created before the current schema')
+    parser.add_argument('data_source_name', type=str, nargs='?',
+                        help='The psycopg data_source_name string')
+    args = parser.parse_args()
+
+    db = PostgresDivisorDb(data_source_name=args.data_source_name)
+    migrate(db)
+    db.connection.close()
@@ -1,12 +1,36 @@
+from collections import defaultdict
 from dataclasses import replace
+from datetime import datetime
+from datetime import timedelta
+from typing import Dict
 from typing import Iterable
 from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+import time
 
 import psycopg2.extras
+import psycopg2.sql
+from gmpy2 import log
 from gmpy2 import mpz
 from riemann.database import DivisorDb
+from riemann.database import witness_record_candidates
+from riemann.level_stats import block_level_stats
+from riemann.level_stats import count_pruned
+from riemann.level_stats import merge_all_level_stats
+from riemann.search_archive import adjacent_range_keys
+from riemann.search_archive import deserialize_archived_range
+from riemann.search_archive import merge_archived_ranges
+from riemann.search_archive import next_search_index
+from riemann.search_archive import search_index_order
+from riemann.search_archive import serialize_range_blocks
+from riemann.superabundant import prime_factor_count
+from riemann.types import ArchivedSearchRange
 from riemann.types import deserialize_search_index
+from riemann.types import LevelStats
 from riemann.types import RiemannDivisorSum
+from riemann.types import SearchIndex
 from riemann.types import SearchBlockState
 from riemann.types import SearchMetadata
 from riemann.types import SummaryStats
@@ -15,6 +39,47 @@ from riemann.types import hash_divisor_sums
 DEFAULT_DATA_SOURCE_NAME = 'dbname=divisor'
 
 
+# The columns the divisor sums table can be partitioned by, with the default
+# width of the range of each partition.
+PARTITION_WIDTHS = dict(level=10, log_n=10)
+
+
+# The columns and indexes of the schema that tables created before them lack,
+# until riemann.migrate_postgres_schema is run.
+MIGRATED_COLUMNS = [
+    ('riemanndivisorsums', 'log_n'),
+    ('riemanndivisorsums', 'level'),
+    ('riemanndivisorsums', 'id'),
+    ('searchmetadata', 'speculative_claims'),
+    ('searchmetadata', 'storage_policy'),
+    ('searchmetadata', 'claim_token'),
+]
+MIGRATED_INDEXES = ['riemanndivisorsums_n']
+
+
+def unmigrated_schema(cursor) -> List[str]:
+    '''The migrated columns and indexes missing from the existing tables.'''
+    cursor.execute('''
+        SELECT table_name, column_name
+        FROM information_schema.columns
+        WHERE table_schema = current_schema();
+    ''')
+    columns = set(cursor.fetchall())
+    cursor.execute('''
+        SELECT indexname FROM pg_indexes
+        WHERE schemaname = current_schema();
+    ''')
+    indexes = {row[0] for row in cursor.fetchall()}
+    tables = {table for (table, _) in columns}
+    return [
+        f"{table}.{column}" for (table, column) in MIGRATED_COLUMNS
+        if table in tables and (table, column) not in columns
+    ] + [
+        f"index {index}" for index in MIGRATED_INDEXES
+        if 'riemanndivisorsums' in tables and index not in indexes
+    ]
+
+
 class PostgresDivisorDb(DivisorDb):
     '''A database implementation using postgres.'''
 
@@ -28,25 +93,90 @@ class PostgresDivisorDb(DivisorDb):
         else:
             self.connection = psycopg2.connect(data_source_name)
 
-    def initialize_schema(self):
+        # the partitioning of the divisor sums table, loaded when first needed
+        self.partitioning: Optional[Tuple[str, int]] = None
+        self.partitioning_loaded = False
+        # the lower bounds of partitions known to exist
+        self.partitions: Set[int] = set()
+
+    def initialize_schema(self,
+                          partition_by: Optional[str] = None,
+                          partition_width: Optional[int] = None):
+        '''
+        Create the schema, idempotently. This only creates what is missing,
+        and raises ValueError if existing tables predate columns or indexes
+        that riemann.migrate_postgres_schema adds, since adding them rewrites
+        or scans the whole divisor sums table.
+
+        If partition_by is set and the divisor sums table does not exist yet,
+        it is created partitioned by ranges of partition_width of the
+        partition_by column, either level or log_n. Partitions are created as
+        finished blocks need them. Superabundant searches are best partitioned
+        by level, and exhaustive searches by log_n, i.e., by ranges of the
+        magnitude of n.
+        '''
+        if partition_by is not None and partition_by not in PARTITION_WIDTHS:
+            raise ValueError(f"Cannot partition by {partition_by}")
+
         cursor = self.connection.cursor()
         cursor.execute('''
         CREATE EXTENSION IF NOT EXISTS pgmp;
         ''')
         cursor.execute('''
-        CREATE TYPE SearchBlockState AS ENUM (
-          'NOT_STARTED',
-          'IN_PROGRESS',
-          'FINISHED',
-          'FAILED'
-        );
+        DO $$ BEGIN
+            CREATE TYPE SearchBlockState AS ENUM (
+              'NOT_STARTED',
+              'IN_PROGRESS',
+              'FINISHED',
+              'FAILED'
+            );
+        EXCEPTION
+            WHEN duplicate_object THEN null;
+        END $$;
         ''')
         cursor.execute('''
+        CREATE TABLE IF NOT EXISTS DivisorSumPartitioning (
+            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            partition_column TEXT,
+            partition_width INTEGER
+        );''')
+        cursor.execute("SELECT to_regclass('riemanndivisorsums') IS NOT NULL;")
+        divisor_sums_exist = cursor.fetchone()[0]
+        if partition_by is not None and not divisor_sums_exist:
+            cursor.execute(f'''
+            CREATE TABLE RiemannDivisorSums (
+                id BIGSERIAL,
+                n mpz NOT NULL,
+                divisor_sum mpz,
+                witness_value double precision,
+                log_n double precision NOT NULL,
+                level INTEGER NOT NULL
+            ) PARTITION BY RANGE ({partition_by});''')
+            # A unique index on a partitioned table must include the partition
+            # column, which is a function of n, so n is still unique.
+            cursor.execute(f'''
+            CREATE UNIQUE INDEX RiemannDivisorSums_n
+            ON RiemannDivisorSums ({partition_by}, n);
+            ''')
+            cursor.execute('''
+            INSERT INTO DivisorSumPartitioning (partition_column, partition_width)
+            VALUES (%s, %s);
+            ''', (partition_by, partition_width or PARTITION_WIDTHS[partition_by]))
+            divisor_sums_exist = True
+        cursor.execute('''
         CREATE TABLE IF NOT EXISTS RiemannDivisorSums (
+            id BIGSERIAL,
             n mpz,
             divisor_sum mpz,
-            witness_value double precision
+            witness_value double precision,
+            log_n double precision,
+            level INTEGER
         );''')
+        if not divisor_sums_exist:
+            cursor.execute('''
+            CREATE UNIQUE INDEX RiemannDivisorSums_n
+            ON RiemannDivisorSums (n);
+            ''')
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS SearchMetadata (
             creation_time timestamp,
@@ -57,12 +187,98 @@ class PostgresDivisorDb(DivisorDb):
             starting_search_index TEXT,
             ending_search_index TEXT,
             block_hash CHAR(64),
+            speculative_claims INTEGER NOT NULL DEFAULT 0,
+            storage_policy TEXT,
+            claim_token BIGINT NOT NULL DEFAULT 0,
             UNIQUE (
                 search_index_type,
                 starting_search_index,
                 ending_search_index
             )
         );''')
+        unmigrated = unmigrated_schema(cursor)
+        if unmigrated:
+            self.connection.rollback()
+            raise ValueError(
+                f"The schema predates {', '.join(unmigrated)}. Stop the "
+                "workers and run python -m riemann.migrate_postgres_schema")
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS RiemannDivisorSums_id
+        ON RiemannDivisorSums (id);
+        ''')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS RiemannDivisorSums_witness_value
+        ON RiemannDivisorSums (witness_value);
+        ''')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS RiemannDivisorSums_log_n
+        ON RiemannDivisorSums (log_n);
+        ''')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS RiemannDivisorSums_level_witness_value
+        ON RiemannDivisorSums (level, witness_value);
+        ''')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS SearchMetadata_claimable_creation_time
+        ON SearchMetadata (search_index_type, creation_time)
+        WHERE state = 'NOT_STARTED' OR state = 'FAILED';
+        ''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS SearchGenerationWatermark (
+            search_index_type TEXT PRIMARY KEY,
+            next_search_index TEXT
+        );''')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS SearchMetadata_finished_end_time
+        ON SearchMetadata (search_index_type, end_time)
+        WHERE state = 'FINISHED';
+        ''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS SearchMetadataArchive (
+            search_index_type TEXT,
+            starting_search_index TEXT,
+            ending_search_index TEXT,
+            next_search_index TEXT,
+            block_count INTEGER,
+            blocks TEXT,
+            last_end_time timestamp,
+            PRIMARY KEY (search_index_type, starting_search_index)
+        );''')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS SearchMetadataArchive_next_search_index
+        ON SearchMetadataArchive (search_index_type, next_search_index);
+        ''')
+        # The summary table has a single row
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS DivisorSumSummary (
+            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            largest_computed_n mpz,
+            largest_computed_n_divisor_sum mpz,
+            largest_computed_n_witness_value double precision
+        );''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS WitnessRecords (
+            n mpz PRIMARY KEY,
+            divisor_sum mpz,
+            witness_value double precision
+        );''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS LevelStats (
+            search_index_type TEXT,
+            level INTEGER,
+            count BIGINT,
+            count_above_threshold BIGINT,
+            count_pruned BIGINT NOT NULL DEFAULT 0,
+            max_witness_value double precision,
+            max_witness_index BIGINT,
+            witness_histogram BIGINT[],
+            seconds double precision,
+            PRIMARY KEY (search_index_type, level)
+        );''')
+        cursor.execute('''
+        INSERT INTO DivisorSumSummary (id) VALUES (TRUE)
+        ON CONFLICT (id) DO NOTHING;
+        ''')
         self.connection.commit()
 
     def convert_records(self, rows):
@@ -84,9 +300,19 @@ class PostgresDivisorDb(DivisorDb):
                 start_time=row[5],
                 end_time=row[6],
                 block_hash=row[7],
+                # only some queries select the storage policy and claim token
+                storage_policy=row[8] if len(row) > 8 else None,
+                claim_token=row[9] if len(row) > 9 else None,
             ) for row in rows
         ]
 
+    def serialize_key(self, metadata):
+        return (
+            metadata.search_index_type,
+            metadata.starting_search_index.serialize(),
+            metadata.ending_search_index.serialize(),
+        )
+
     def load(self) -> Iterable[RiemannDivisorSum]:
         cursor = self.connection.cursor("load_divisor_sums")
         cursor.itersize = 1000000
@@ -112,7 +338,9 @@ class PostgresDivisorDb(DivisorDb):
               creation_time,
               start_time,
               end_time,
-              block_hash
+              block_hash,
+              storage_policy,
+              claim_token
             FROM SearchMetadata
             ORDER BY creation_time asc;
         ''')
@@ -120,39 +348,430 @@ class PostgresDivisorDb(DivisorDb):
             return []
         return self.convert_metadatas(cursor.fetchall())
 
+    def load_finished_search_blocks(
+            self,
+            search_index_type: str,
+            count: int) -> List[SearchMetadata]:
+        cursor = self.connection.cursor()
+        cursor.execute('''
+            SELECT
+              starting_search_index,
+              ending_search_index,
+              search_index_type,
+              state,
+              creation_time,
+              start_time,
+              end_time,
+              block_hash,
+              storage_policy,
+              claim_token
+            FROM SearchMetadata
+            WHERE
+              search_index_type = %s
+              AND state = 'FINISHED'
+            ORDER BY end_time DESC
+            LIMIT %s;
+        ''', (search_index_type, count))
+        return self.convert_metadatas(cursor.fetchall())
+
     def summarize(self) -> SummaryStats:
         cursor = self.connection.cursor()
         cursor.execute('''
             SELECT
-                max(n) as largest_computed_n,
-                max(witness_value) as largest_witness_value
-            FROM RiemannDivisorSums;
+              largest_computed_n,
+              largest_computed_n_divisor_sum,
+              largest_computed_n_witness_value
+            FROM DivisorSumSummary;
         ''')
+        largest_n_rows = self.convert_records(
+            row for row in cursor.fetchall() if row[0] is not None)
 
-        max_n, max_witness = cursor.fetchone()
-        if max_n is None or max_witness is None:
+        # the first record with the largest witness value, which is the last
+        # record, even if rows that are no longer records were not removed
+        cursor.execute('''
+            SELECT n, divisor_sum, witness_value
+            FROM WitnessRecords
+            ORDER BY witness_value DESC, n ASC
+            LIMIT 1;
+        ''')
+        largest_witness_rows = self.convert_records(cursor.fetchall())
+        self.connection.commit()
+
+        if not largest_n_rows or not largest_witness_rows:
             raise ValueError("No data!")
 
+        return SummaryStats(largest_computed_n=largest_n_rows[0],
+                            largest_witness_value=largest_witness_rows[0])
+
+    def load_top_witness_values(
+            self,
+            count: int,
+            level: Optional[int] = None) -> List[RiemannDivisorSum]:
+        cursor = self.connection.cursor()
+        if level is None:
+            cursor.execute('''
+                SELECT n, divisor_sum, witness_value
+                FROM RiemannDivisorSums
+                ORDER BY witness_value DESC
+                LIMIT %s;
+            ''', (count,))
+        else:
+            cursor.execute('''
+                SELECT n, divisor_sum, witness_value
+                FROM RiemannDivisorSums
+                WHERE level = %s
+                ORDER BY witness_value DESC
+                LIMIT %s;
+            ''', (level, count))
+        records = self.convert_records(cursor.fetchall())
+        self.connection.commit()
+        return records
+
+    def load_log_n_range(
+            self,
+            min_log_n: float,
+            max_log_n: float) -> List[RiemannDivisorSum]:
+        cursor = self.connection.cursor()
         cursor.execute('''
-            SELECT
-                n, divisor_sum, witness_value
+            SELECT n, divisor_sum, witness_value
             FROM RiemannDivisorSums
-            WHERE
-                n = '%s'::mpz
-                OR witness_value = %s
-            ;
-        ''' % (max_n, max_witness))
+            WHERE log_n >= %s AND log_n < %s
+            ORDER BY log_n ASC;
+        ''', (min_log_n, max_log_n))
+        records = self.convert_records(cursor.fetchall())
+        self.connection.commit()
+        return records
+
+    def load_above_witness_value(
+            self, min_witness_value: float) -> List[RiemannDivisorSum]:
+        cursor = self.connection.cursor()
+        cursor.execute('''
+            SELECT n, divisor_sum, witness_value
+            FROM RiemannDivisorSums
+            WHERE witness_value >= %s
+            ORDER BY n ASC;
+        ''', (min_witness_value,))
+        records = self.convert_records(cursor.fetchall())
+        self.connection.commit()
+        return records
+
+    def load_partitioning(self, cursor) -> Optional[Tuple[str, int]]:
+        '''The column and width the divisor sums are partitioned by, if any.'''
+        if not self.partitioning_loaded:
+            # the table is missing if the schema predates partitioning
+            cursor.execute(
+                "SELECT to_regclass('divisorsumpartitioning') IS NOT NULL;")
+            row = None
+            if cursor.fetchone()[0]:
+                cursor.execute('''
+                    SELECT partition_column, partition_width
+                    FROM DivisorSumPartitioning;
+                ''')
+                row = cursor.fetchone()
+            self.partitioning = (row[0], row[1]) if row is not None else None
+            self.partitioning_loaded = True
+        return self.partitioning
+
+    def create_partitions(self, values: Iterable[float]) -> None:
+        '''
+        Create the partitions of the divisor sums table that the given values
+        of its partition column fall in, if the table is partitioned.
+
+        Each partition is created in its own transaction, which must not be
+        called with one open. Concurrent creators are serialized by an
+        advisory lock, since CREATE TABLE IF NOT EXISTS can still fail when
+        another transaction creates the same table.
+        '''
+        cursor = self.connection.cursor()
+        partitioning = self.load_partitioning(cursor)
+        self.connection.commit()
+        if partitioning is None:
+            return
+        (column, width) = partitioning
+        lowers = set(int(value // width) * width for value in values)
+        for lower in sorted(lowers - self.partitions):
+            name = f'riemanndivisorsums_{column}_{lower:06d}'
+            cursor.execute(
+                "SELECT pg_advisory_xact_lock(hashtext('RiemannDivisorSums'));")
+            cursor.execute('SELECT to_regclass(%s) IS NULL;', (name,))
+            if cursor.fetchone()[0]:
+                cursor.execute(f'''
+                CREATE TABLE {name}
+                PARTITION OF RiemannDivisorSums
+                FOR VALUES FROM ({lower}) TO ({lower + width});
+                ''')
+            # releases the lock
+            self.connection.commit()
+            self.partitions.add(lower)
+
+    def load_divisor_sum_partitions(self) -> List[Tuple[str, str]]:
+        '''The name and bounds of each partition of the divisor sums table.'''
+        cursor = self.connection.cursor()
+        cursor.execute('''
+            SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'riemanndivisorsums'::regclass
+            ORDER BY c.relname;
+        ''')
+        partitions = [(row[0], row[1]) for row in cursor.fetchall()]
+        self.connection.commit()
+        return partitions
+
+    def detach_divisor_sum_partition(self, name: str) -> None:
+        '''
+        Detach a partition of the divisor sums table, leaving it as a table of
+        its own that can be archived or dropped. Its divisor sums are no longer
+        loaded or queried, but remain counted in the summary and records.
+        '''
+        cursor = self.connection.cursor()
+        cursor.execute(
+            psycopg2.sql.SQL(
+                'ALTER TABLE RiemannDivisorSums DETACH PARTITION {};'
+            ).format(psycopg2.sql.Identifier(name)))
+        self.connection.commit()
+
+    def backfill_query_columns(self, batch_size: int = 10000) -> int:
+        '''
+        Compute log_n and level for rows stored before those columns existed,
+        as part of riemann.migrate_postgres_schema. Returns the number of rows
+        updated.
+        '''
+        updated = 0
+        while True:
+            cursor = self.connection.cursor()
+            cursor.execute('''
+                SELECT DISTINCT n
+                FROM RiemannDivisorSums
+                WHERE log_n IS NULL
+                LIMIT %s;
+            ''', (batch_size,))
+            ns = [mpz(row[0]) for row in cursor.fetchall()]
+            if not ns:
+                self.connection.commit()
+                return updated
+
+            psycopg2.extras.execute_values(cur=cursor, sql='''
+                UPDATE RiemannDivisorSums
+                SET log_n = v.log_n, level = v.level
+                FROM (VALUES %s) AS v(n, log_n, level)
+                WHERE RiemannDivisorSums.n = v.n::mpz;
+            ''', argslist=[
+                ("%s" % n, float(log(n)), prime_factor_count(n)) for n in ns
+            ], page_size=len(ns))
+            updated += cursor.rowcount
+            self.connection.commit()
 
+    def load_witness_records(self) -> List[RiemannDivisorSum]:
+        cursor = self.connection.cursor()
+        cursor.execute('''
+            SELECT n, divisor_sum, witness_value
+            FROM WitnessRecords
+            ORDER BY n ASC;
+        ''')
         records = self.convert_records(cursor.fetchall())
-        largest_n_record = [r for r in records if r.n == mpz(max_n)][0]
-        largest_witness_record = [
-            r for r in records if r.witness_value == max_witness
-        ][0]
+        self.connection.commit()
+        # drop rows that a concurrent finish made no longer records
+        return witness_record_candidates(records)
 
-        return SummaryStats(largest_computed_n=largest_n_record,
-                            largest_witness_value=largest_witness_record)
+    def max_divisor_sum_id(self, poll_seconds: float = 0.1) -> int:
+        cursor = self.connection.cursor()
+        cursor.execute('SELECT max(id) FROM RiemannDivisorSums;')
+        max_id = cursor.fetchone()[0] or 0
+        # A transaction still in progress may have taken a smaller id from
+        # the sequence, and commit it after max_id. It took the id before
+        # max_id was read, and after updating SearchMetadata, so it has an
+        # xid in progress in a snapshot taken now. Once every one of those
+        # has ended, no row with an id up to max_id can be stored.
+        cursor.execute('SELECT pg_current_snapshot()::text;')
+        snapshot = cursor.fetchone()[0]
+        self.connection.commit()
+        while True:
+            cursor.execute('''
+                SELECT count(*)
+                FROM unnest(pg_snapshot_xip(%s::pg_snapshot)) AS xid
+                WHERE pg_xact_status(xid) = 'in progress';
+            ''', (snapshot,))
+            in_progress = cursor.fetchone()[0]
+            self.connection.commit()
+            if not in_progress:
+                return max_id
+            time.sleep(poll_seconds)
+
+    def load_log_n_and_witness_values(
+            self,
+            after_id: int,
+            through_id: int) -> List[Tuple[float, float]]:
+        cursor = self.connection.cursor()
+        cursor.execute('''
+            SELECT
+              log_n,
+              witness_value,
+              CASE WHEN log_n IS NULL THEN n END
+            FROM RiemannDivisorSums
+            WHERE id > %s AND id <= %s
+            ORDER BY id ASC;
+        ''', (after_id, through_id))
+        # log_n is only missing for rows that were never backfilled
+        values = [
+            (log_n if n is None else float(log(mpz(n))), witness_value)
+            for (log_n, witness_value, n) in cursor.fetchall()
+        ]
+        self.connection.commit()
+        return values
 
-    def insert_search_blocks(self, blocks: List[SearchMetadata]) -> None:
+    def load_level_stats(self, search_index_type: str) -> List[LevelStats]:
+        cursor = self.connection.cursor()
+        cursor.execute('''
+            SELECT
+              level,
+              count,
+              count_above_threshold,
+              max_witness_value,
+              max_witness_index,
+              witness_histogram,
+              seconds,
+              count_pruned
+            FROM LevelStats
+            WHERE search_index_type = %s
+            ORDER BY level ASC;
+        ''', (search_index_type,))
+        rows = cursor.fetchall()
+        self.connection.commit()
+        return [
+            LevelStats(
+                level=row[0],
+                count=row[1],
+                count_above_threshold=row[2],
+                max_witness_value=row[3],
+                max_witness_index=row[4],
+                witness_histogram=tuple(row[5]),
+                seconds=row[6],
+                count_pruned=row[7],
+            ) for row in rows
+        ]
+
+    def update_level_stats(
+            self,
+            cursor,
+            finished_blocks: List[Tuple[
+                SearchMetadata, List[RiemannDivisorSum], List[RiemannDivisorSum]]]
+    ) -> None:
+        '''
+        Merge the level statistics of newly finished blocks, each given with
+        all of its divisor sums and those stored, into the LevelStats table,
+        as part of the caller's transaction.
+        '''
+        merged: Dict[str, Dict[int, LevelStats]] = defaultdict(dict)
+        for (metadata, divisor_sums, stored) in finished_blocks:
+            merged[metadata.search_index_type] = merge_all_level_stats(
+                count_pruned(
+                    block_level_stats(
+                        metadata, divisor_sums, self.threshold_witness_value),
+                    metadata, stored),
+                into=merged[metadata.search_index_type])
+
+        # Rows are upserted in key order, so concurrent finishes lock them in
+        # the same order and cannot deadlock.
+        arglist = sorted(
+            (
+                search_index_type,
+                stats.level,
+                stats.count,
+                stats.count_above_threshold,
+                stats.count_pruned,
+                stats.max_witness_value,
+                stats.max_witness_index,
+                list(stats.witness_histogram),
+                stats.seconds,
+            )
+            for (search_index_type, stats_by_level) in merged.items()
+            for stats in stats_by_level.values()
+        )
+        if not arglist:
+            return
+
+        psycopg2.extras.execute_values(cur=cursor, sql='''
+        INSERT INTO LevelStats (
+            search_index_type,
+            level,
+            count,
+            count_above_threshold,
+            count_pruned,
+            max_witness_value,
+            max_witness_index,
+            witness_histogram,
+            seconds
+        )
+        VALUES %s
+        ON CONFLICT (search_index_type, level) DO UPDATE SET
+          count = LevelStats.count + EXCLUDED.count,
+          count_above_threshold = (
+            LevelStats.count_above_threshold + EXCLUDED.count_above_threshold),
+          count_pruned = LevelStats.count_pruned + EXCLUDED.count_pruned,
+          max_witness_index = CASE
+            WHEN EXCLUDED.max_witness_value > LevelStats.max_witness_value
+            THEN EXCLUDED.max_witness_index
+            ELSE LevelStats.max_witness_index END,
+          max_witness_value = GREATEST(
+            LevelStats.max_witness_value, EXCLUDED.max_witness_value),
+          witness_histogram = ARRAY(
+            SELECT coalesce(a, 0) + coalesce(b, 0)
+            FROM unnest(LevelStats.witness_histogram, EXCLUDED.witness_histogram)
+              AS h(a, b)
+          ),
+          seconds = LevelStats.seconds + EXCLUDED.seconds;
+        ''', argslist=arglist)
+
+    def update_witness_records(
+            self, cursor, divisor_sums: List[RiemannDivisorSum]) -> None:
+        '''
+        Insert the newly stored divisor sums that are witness value records,
+        as part of the caller's transaction.
+
+        Nothing is locked, so concurrent finishes can each insert a record
+        that the other's makes no longer a record. Rows are never deleted;
+        load_witness_records drops the ones that are no longer records.
+        '''
+        for record in witness_record_candidates(divisor_sums):
+            n = "%s" % record.n
+            witness_value = float(record.witness_value)
+            cursor.execute('''
+                INSERT INTO WitnessRecords (n, divisor_sum, witness_value)
+                SELECT %s::mpz, %s::mpz, %s
+                WHERE NOT EXISTS (
+                  SELECT 1 FROM WitnessRecords
+                  WHERE n <= %s::mpz AND witness_value >= %s
+                )
+                ON CONFLICT (n) DO NOTHING;
+            ''', (n, "%s" % record.divisor_sum, witness_value,
+                  n, witness_value))
+
+    def update_summary(self, cursor, divisor_sums: List[RiemannDivisorSum]):
+        '''
+        Raise the largest computed n in the summary to the largest of the newly
+        stored divisor sums, as part of the caller's transaction. The update
+        is a single conditional statement, so it only locks the summary row
+        when it raises it, and callers run it just before committing.
+        '''
+        if not divisor_sums:
+            return
+
+        largest = max(divisor_sums, key=lambda d: d.n)
+        cursor.execute('''
+            UPDATE DivisorSumSummary
+            SET
+              largest_computed_n = %s::mpz,
+              largest_computed_n_divisor_sum = %s::mpz,
+              largest_computed_n_witness_value = %s
+            WHERE largest_computed_n IS NULL OR largest_computed_n < %s::mpz;
+        ''', ("%s" % largest.n, "%s" % largest.divisor_sum,
+              float(largest.witness_value), "%s" % largest.n))
+
+    def insert_search_blocks(
+            self,
+            blocks: List[SearchMetadata],
+            next_search_index: Optional[SearchIndex] = None) -> None:
         cursor = self.connection.cursor()
         query = '''
         INSERT INTO
@@ -187,19 +806,64 @@ class PostgresDivisorDb(DivisorDb):
                                        sql=query,
                                        argslist=arglist,
                                        template=template)
+
+        if next_search_index is not None:
+            cursor.execute('''
+            INSERT INTO
+                SearchGenerationWatermark(search_index_type, next_search_index)
+                VALUES (%s, %s)
+            ON CONFLICT (search_index_type)
+            DO UPDATE SET next_search_index = EXCLUDED.next_search_index;
+            ''', (
+                next_search_index.__class__.__name__,
+                next_search_index.serialize()))
+        self.connection.commit()
+
+    def load_next_search_index(
+            self, search_index_type: str) -> Optional[SearchIndex]:
+        cursor = self.connection.cursor()
+        cursor.execute('''
+            SELECT next_search_index
+            FROM SearchGenerationWatermark
+            WHERE search_index_type = %s;
+        ''', (search_index_type,))
+        row = cursor.fetchone()
+        self.connection.commit()
+        if row is None:
+            return None
+        return deserialize_search_index(search_index_type, row[0])
+
+    def count_eligible_search_blocks(self, search_index_type: str) -> int:
+        cursor = self.connection.cursor()
+        cursor.execute('''
+            SELECT count(*)
+            FROM SearchMetadata
+            WHERE
+              search_index_type = %s
+              AND (state = 'NOT_STARTED' OR state = 'FAILED');
+        ''', (search_index_type,))
+        count = cursor.fetchone()[0]
         self.connection.commit()
+        return count
 
     def claim_next_search_block(
             self, search_index_type: str) -> SearchMetadata:
+        return self.claim_next_search_blocks(search_index_type, 1)[0]
+
+    def claim_next_search_blocks(
+            self,
+            search_index_type: str,
+            count: int) -> List[SearchMetadata]:
         cursor = self.connection.cursor()
-        # FOR UPDATE locks the row for the duration of the query.
+        # FOR UPDATE locks the rows for the duration of the query.
         # Cf. https://stackoverflow.com/q/11532550/438830
         # and test_multiple_processors_no_duplicates
         cursor.execute('''
             UPDATE SearchMetadata
             SET
               start_time = NOW(),
-              state = 'IN_PROGRESS'
+              state = 'IN_PROGRESS',
+              claim_token = SearchMetadata.claim_token + 1
             FROM (
                 SELECT
                     search_index_type,
@@ -207,10 +871,10 @@ class PostgresDivisorDb(DivisorDb):
                     ending_search_index
                 FROM SearchMetadata
                 WHERE
-                  search_index_type='%s'
+                  search_index_type = %s
                   AND (state = 'NOT_STARTED' OR state = 'FAILED')
                 ORDER BY creation_time ASC
-                LIMIT 1
+                LIMIT %s
                 FOR UPDATE
             ) as m
             WHERE
@@ -222,12 +886,76 @@ class PostgresDivisorDb(DivisorDb):
               SearchMetadata.ending_search_index,
               SearchMetadata.search_index_type,
               SearchMetadata.start_time,
-              SearchMetadata.state
+              SearchMetadata.state,
+              SearchMetadata.creation_time,
+              SearchMetadata.claim_token
             ;
-        ''' % search_index_type)
+        ''', (search_index_type, count))
 
         if cursor.rowcount <= 0:
             raise ValueError('No legal search block to claim')
+        rows = cursor.fetchall()
+        self.connection.commit()
+
+        # RETURNING does not preserve the order of the subquery
+        rows.sort(key=lambda row: row[5])
+        return [
+            SearchMetadata(
+                starting_search_index=deserialize_search_index(
+                    search_index_type, row[0]),
+                ending_search_index=deserialize_search_index(
+                    search_index_type, row[1]),
+                search_index_type=row[2],
+                start_time=row[3],
+                # indexing [ ] is Python's "name to enum" lookup
+                state=SearchBlockState[row[4]],
+                creation_time=row[5],
+                claim_token=row[6],
+            ) for row in rows
+        ]
+
+    def claim_speculative_search_block(
+            self,
+            search_index_type: str,
+            running_for: timedelta,
+            max_copies: int = 1) -> SearchMetadata:
+        cursor = self.connection.cursor()
+        cursor.execute('''
+            UPDATE SearchMetadata
+            SET
+              speculative_claims = SearchMetadata.speculative_claims + 1
+            FROM (
+                SELECT
+                    search_index_type,
+                    starting_search_index,
+                    ending_search_index
+                FROM SearchMetadata
+                WHERE
+                  search_index_type = %s
+                  AND state = 'IN_PROGRESS'
+                  AND start_time < NOW() - %s
+                  AND speculative_claims < %s
+                ORDER BY start_time ASC
+                LIMIT 1
+                FOR UPDATE
+            ) as m
+            WHERE
+              SearchMetadata.search_index_type = m.search_index_type
+              AND SearchMetadata.starting_search_index = m.starting_search_index
+              AND SearchMetadata.ending_search_index = m.ending_search_index
+            RETURNING
+              SearchMetadata.starting_search_index,
+              SearchMetadata.ending_search_index,
+              SearchMetadata.search_index_type,
+              SearchMetadata.start_time,
+              SearchMetadata.state,
+              SearchMetadata.creation_time,
+              SearchMetadata.claim_token
+            ;
+        ''', (search_index_type, running_for, max_copies))
+
+        if cursor.rowcount <= 0:
+            raise ValueError('No search block to speculatively claim')
         row = cursor.fetchone()
         self.connection.commit()
 
@@ -240,58 +968,187 @@ class PostgresDivisorDb(DivisorDb):
             start_time=row[3],
             # indexing [ ] is Python's "name to enum" lookup
             state=SearchBlockState[row[4]],
+            creation_time=row[5],
+            claim_token=row[6],
         )
 
     def finish_search_block(self,
                             metadata: SearchMetadata,
                             divisor_sums: List[RiemannDivisorSum]) -> None:
+        self.finish_search_blocks([(metadata, divisor_sums)])
+
+    def finish_search_blocks(
+            self,
+            finished_blocks: List[Tuple[SearchMetadata, List[RiemannDivisorSum]]]
+    ) -> None:
+        # summarize commits, so the record is loaded before the transaction
+        to_store = self.divisor_sums_to_store(finished_blocks)
+        # Partitions are created before the transaction, so it does not hold
+        # the lock on the parent table that creating one takes.
+        partitioning = self.load_partitioning(self.connection.cursor())
+        if partitioning is not None:
+            self.create_partitions([
+                float(log(d.n)) if partitioning[0] == 'log_n'
+                else prime_factor_count(d.n)
+                for block_sums in to_store for d in block_sums])
+        storage_policy = self.get_storage_policy().version()
         cursor = self.connection.cursor()
-        block_hash = hash_divisor_sums(divisor_sums)
-        metadata = replace(metadata, block_hash=block_hash)
+        hashed_blocks = [
+            (replace(metadata, block_hash=(
+                metadata.block_hash or hash_divisor_sums(divisor_sums))),
+             divisor_sums)
+            for (metadata, divisor_sums) in finished_blocks
+        ]
+
         query = '''
         UPDATE SearchMetadata
         SET
           end_time = NOW(),
           state = 'FINISHED',
-          block_hash = %s
+          block_hash = v.block_hash,
+          storage_policy = v.storage_policy
+        FROM (VALUES %s) AS v(
+          block_hash,
+          storage_policy,
+          search_index_type,
+          starting_search_index,
+          ending_search_index,
+          claim_token
+        )
         WHERE
-          search_index_type = %s
-          AND starting_search_index = %s
-          AND ending_search_index = %s
-          AND state = 'IN_PROGRESS'
+          SearchMetadata.search_index_type = v.search_index_type
+          AND SearchMetadata.starting_search_index = v.starting_search_index
+          AND SearchMetadata.ending_search_index = v.ending_search_index
+          AND SearchMetadata.state = 'IN_PROGRESS'
+          AND (v.claim_token IS NULL
+               OR SearchMetadata.claim_token = v.claim_token)
+        RETURNING
+          SearchMetadata.search_index_type,
+          SearchMetadata.starting_search_index,
+          SearchMetadata.ending_search_index
         ;
         '''
-
-        cursor.execute(
-            cursor.mogrify(query, (
+        metadata_arglist = [
+            (
                 metadata.block_hash,
+                storage_policy,
                 metadata.search_index_type,
                 metadata.starting_search_index.serialize(),
-                metadata.ending_search_index.serialize())))
-
-        if cursor.rowcount <= 0:
-            self.connection.rollback()
-            raise ValueError(
-                f"The block was not found or not IN_PROGRESS! "
-                f"metadata={metadata}")
+                metadata.ending_search_index.serialize(),
+                metadata.claim_token,
+            )
+            for (metadata, _) in hashed_blocks
+        ]
+        finished_keys = set(psycopg2.extras.execute_values(
+            cur=cursor,
+            sql=query,
+            argslist=metadata_arglist,
+            # the cast types a column of NULL claim tokens
+            template="(%s, %s, %s, %s, %s, %s::bigint)",
+            page_size=max(1, len(metadata_arglist)),
+            fetch=True))
 
         query = '''
         INSERT INTO
-            RiemannDivisorSums(n, divisor_sum, witness_value)
-            VALUES %s;
+            RiemannDivisorSums(n, divisor_sum, witness_value, log_n, level)
+            VALUES %s
+        ON CONFLICT DO NOTHING;
         '''
-        template = "(%s::mpz, %s::mpz, %s)"
+        template = "(%s::mpz, %s::mpz, %s, %s, %s)"
+        stored_sums = [
+            d
+            for ((metadata, _), block_sums) in zip(hashed_blocks, to_store)
+            if self.serialize_key(metadata) in finished_keys
+            for d in block_sums
+        ]
         arglist = [
-            ("%s" % d.n, "%s" % d.divisor_sum, float(d.witness_value))
-            for d in divisor_sums
-            if d.witness_value > self.threshold_witness_value
+            ("%s" % d.n, "%s" % d.divisor_sum, float(d.witness_value),
+             float(log(d.n)), prime_factor_count(d.n))
+            for d in stored_sums
         ]
-
         psycopg2.extras.execute_values(cur=cursor,
                                        sql=query,
                                        argslist=arglist,
                                        template=template)
+        self.update_witness_records(cursor, stored_sums)
+        # statistics are computed from the blocks as given, since a hash
+        # computed here does not mean the divisor sums were filtered
+        self.update_level_stats(cursor, [
+            (metadata, divisor_sums, block_sums)
+            for ((metadata, divisor_sums), block_sums) in zip(
+                finished_blocks, to_store)
+            if self.serialize_key(metadata) in finished_keys
+        ])
+        self.update_summary(cursor, stored_sums)
+        self.connection.commit()
+
+        rejected = [
+            metadata for (metadata, _) in hashed_blocks
+            if self.serialize_key(metadata) not in finished_keys
+        ]
+        if not rejected:
+            return
+
+        # A block that was already finished with the same hash, e.g., by a
+        # speculative copy, is not an error.
+        cursor.execute('''
+            SELECT
+              search_index_type,
+              starting_search_index,
+              ending_search_index,
+              state,
+              block_hash,
+              claim_token
+            FROM SearchMetadata
+            WHERE
+              (search_index_type, starting_search_index, ending_search_index)
+              IN %s;
+        ''', (tuple(self.serialize_key(metadata) for metadata in rejected),))
+        stored = {tuple(row[:3]): row[3:] for row in cursor.fetchall()}
+        self.connection.commit()
+
+        errors = []
+        for metadata in rejected:
+            state, block_hash, claim_token = stored.get(
+                self.serialize_key(metadata), (None, None, None))
+            if state == 'FINISHED' and block_hash == metadata.block_hash:
+                continue
+            elif state == 'FINISHED':
+                errors.append(
+                    f"The block was already finished with a different hash! "
+                    f"stored={block_hash} metadata={metadata}")
+            elif state == 'IN_PROGRESS':
+                errors.append(
+                    f"The block was claimed again since! "
+                    f"stored={claim_token} metadata={metadata}")
+            else:
+                errors.append(
+                    f"The block was not found or not IN_PROGRESS! "
+                    f"metadata={metadata}")
+        if errors:
+            raise ValueError('\n'.join(errors))
+
+    def renew_claim(self, metadata: SearchMetadata) -> SearchMetadata:
+        cursor = self.connection.cursor()
+        cursor.execute('''
+        UPDATE SearchMetadata
+        SET
+          start_time = NOW()
+        WHERE
+          search_index_type = %s
+          AND starting_search_index = %s
+          AND ending_search_index = %s
+          AND state = 'IN_PROGRESS'
+          AND (%s::bigint IS NULL OR claim_token = %s)
+        RETURNING start_time;
+        ''', self.serialize_key(metadata) + (
+            metadata.claim_token, metadata.claim_token))
+        row = cursor.fetchone()
         self.connection.commit()
+        if row is None:
+            raise ValueError(
+                f"The block is no longer claimed! metadata={metadata}")
+        return replace(metadata, start_time=row[0])
 
     def mark_block_as_failed(self, metadata: SearchMetadata) -> None:
         cursor = self.connection.cursor()
@@ -303,6 +1160,8 @@ class PostgresDivisorDb(DivisorDb):
           search_index_type = %s
           AND starting_search_index = %s
           AND ending_search_index = %s
+          AND state = 'IN_PROGRESS'
+          AND (%s::bigint IS NULL OR claim_token = %s)
         ;
         '''
 
@@ -310,19 +1169,152 @@ class PostgresDivisorDb(DivisorDb):
             cursor.mogrify(query, (
                 metadata.search_index_type,
                 metadata.starting_search_index.serialize(),
-                metadata.ending_search_index.serialize())))
+                metadata.ending_search_index.serialize(),
+                metadata.claim_token,
+                metadata.claim_token)))
         self.connection.commit()
 
+    def compact_finished_search_blocks(
+            self,
+            search_index_type: str,
+            finished_before: datetime,
+            max_blocks: int = 10000) -> int:
+        if self.load_next_search_index(search_index_type) is None:
+            return 0
+
+        cursor = self.connection.cursor()
+        cursor.execute('''
+            SELECT
+              starting_search_index,
+              ending_search_index,
+              search_index_type,
+              state,
+              creation_time,
+              start_time,
+              end_time,
+              block_hash,
+              storage_policy
+            FROM SearchMetadata
+            WHERE
+              search_index_type = %s
+              AND state = 'FINISHED'
+              AND end_time < %s
+            ORDER BY end_time ASC
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED;
+        ''', (search_index_type, finished_before, max_blocks))
+        blocks = self.convert_metadatas(cursor.fetchall())
+        if not blocks:
+            self.connection.commit()
+            return 0
+
+        (followed_by, starting_at) = adjacent_range_keys(blocks)
+        cursor.execute('''
+            SELECT starting_search_index, blocks, last_end_time
+            FROM SearchMetadataArchive
+            WHERE
+              search_index_type = %s
+              AND (
+                next_search_index = ANY(%s)
+                OR starting_search_index = ANY(%s)
+              )
+            FOR UPDATE;
+        ''', (
+            search_index_type,
+            [index.serialize() for index in followed_by],
+            [index.serialize() for index in starting_at]))
+        candidates = [
+            deserialize_archived_range(search_index_type, row[0], row[1], row[2])
+            for row in cursor.fetchall()
+        ]
+        (removed, added) = merge_archived_ranges(candidates, blocks)
+
+        psycopg2.extras.execute_values(
+            cur=cursor,
+            sql='''
+            DELETE FROM SearchMetadata
+            USING (VALUES %s) AS v(
+              search_index_type,
+              starting_search_index,
+              ending_search_index
+            )
+            WHERE
+              SearchMetadata.search_index_type = v.search_index_type
+              AND SearchMetadata.starting_search_index = v.starting_search_index
+              AND SearchMetadata.ending_search_index = v.ending_search_index;
+            ''',
+            argslist=[self.serialize_key(block) for block in blocks])
+        cursor.execute('''
+            DELETE FROM SearchMetadataArchive
+            WHERE search_index_type = %s AND starting_search_index = ANY(%s);
+        ''', (
+            search_index_type,
+            [r.starting_search_index.serialize() for r in removed]))
+        psycopg2.extras.execute_values(
+            cur=cursor,
+            sql='''
+            INSERT INTO SearchMetadataArchive (
+              search_index_type,
+              starting_search_index,
+              ending_search_index,
+              next_search_index,
+              block_count,
+              blocks,
+              last_end_time
+            )
+            VALUES %s;
+            ''',
+            argslist=[
+                (
+                    search_index_type,
+                    r.starting_search_index.serialize(),
+                    r.ending_search_index.serialize(),
+                    next_search_index(r.ending_search_index).serialize(),
+                    len(r),
+                    serialize_range_blocks(r),
+                    r.last_end_time,
+                )
+                for r in added
+            ])
+        self.connection.commit()
+        return len(blocks)
+
+    def load_archived_search_ranges(
+            self, search_index_type: str) -> List[ArchivedSearchRange]:
+        cursor = self.connection.cursor()
+        cursor.execute('''
+            SELECT starting_search_index, blocks, last_end_time
+            FROM SearchMetadataArchive
+            WHERE search_index_type = %s;
+        ''', (search_index_type,))
+        return sorted(
+            (
+                deserialize_archived_range(
+                    search_index_type, row[0], row[1], row[2])
+                for row in cursor.fetchall()
+            ),
+            key=lambda r: search_index_order(r.starting_search_index))
+
 
 if __name__ == "__main__":
-    import sys
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Initialize the schema')
     # dsn is a string that specifies the database name
     # and any additional config,
     # e.g., 'dbname=divisor'
-    data_source_name = None
-    if len(sys.argv) == 2:
-        data_source_name = sys.argv[1]
+    parser.add_argument('data_source_name', type=str, nargs='?',
+                        help='The psycopg data_source_name string')
+    parser.add_argument('--partition_by', type=str,
+                        choices=sorted(PARTITION_WIDTHS),
+                        help='If set, and the divisor sums table does not '
+                             'exist yet, partition it by this column')
+    parser.add_argument('--partition_width', type=int,
+                        help='The width of the range of each partition')
+    args = parser.parse_args()
 
-    db = PostgresDivisorDb(data_source_name=data_source_name)
-    db.initialize_schema()
+    db = PostgresDivisorDb(data_source_name=args.data_source_name)
+    db.initialize_schema(
+        partition_by=args.partition_by,
+        partition_width=args.partition_width)
     db.connection.close()
@@ -2,23 +2,65 @@
 A job that repeatedly attempts to claim search blocks, computes their divisor
 sums, and stores them in the database.
 '''
+from dataclasses import replace
 from datetime import datetime
+from datetime import timedelta
+from typing import Optional
+import sqlite3
 import time
 
+import psycopg2
+from riemann import batching_agent
+from riemann.columnar_store import ColumnarStoreWriter
 from riemann.database import DivisorDb
+from riemann.journal import JournalingDivisorDb
+from riemann.journal import check_lease_duration
+from riemann.level_stats import compute_level_stats
 from riemann.postgres_database import PostgresDivisorDb
 from riemann.search_strategy import search_strategy_by_name
 from riemann.search_strategy import SearchStrategy
+from riemann.sqlite_database import SqliteDivisorDb
+from riemann.storage_policy import FixedThresholdPolicy
+from riemann.storage_policy import StoragePolicy
+from riemann.storage_policy import storage_policy_from_spec
+from riemann.types import SearchMetadata
 
 
 def claim_and_compute_one_block(
         divisorDb: DivisorDb,
-        search_strategy: SearchStrategy) -> None:
-    '''Claim and compute a single search block.'''
+        search_strategy: SearchStrategy,
+        speculate_after: Optional[timedelta] = None,
+        columnar_store: Optional[ColumnarStoreWriter] = None,
+        storage_policy: Optional[StoragePolicy] = None) -> None:
+    '''
+    Claim and compute a single search block.
+
+    If speculate_after is set and no block can be claimed, compute a copy of
+    a block that has been in progress for at least that long instead.
+
+    If columnar_store is set, the divisor sums selected by storage_policy
+    (by default, those above the database's default threshold) are also
+    appended to it. The running record is not known here, so this is a
+    superset of what a record_delta policy stores. A block computed more than
+    once, e.g., speculatively, is appended each time, and the chunk index
+    records the block so readers can tell. Errors appending to it are
+    reported, not raised.
+    '''
     start = datetime.now()
+    speculative = False
 
     try:
         block = divisorDb.claim_next_search_block(search_strategy.index_name())
+    except ValueError as e:
+        if speculate_after is None:
+            print(
+                f"Failed to claim search block.\n"
+                f"Error was: {e}"
+            )
+            raise e
+        block = claim_speculative_block(
+            divisorDb, search_strategy, speculate_after)
+        speculative = True
     except Exception as e:
         print(
             f"Failed to claim search block.\n"
@@ -27,16 +69,39 @@ def claim_and_compute_one_block(
         raise e
 
     try:
+        compute_start = datetime.now()
         divisor_sums = search_strategy.process_block(block)
+        block = replace(block, level_stats=compute_level_stats(
+            block,
+            divisor_sums,
+            # a batching agent's proxy only forwards methods
+            DivisorDb.threshold_witness_value,
+            seconds=(datetime.now() - compute_start).total_seconds()))
         divisorDb.finish_search_block(block, divisor_sums)
     except Exception as e:
         print(
             f"Failed to process or finish search block.\n"
             f"Error was: {e}"
         )
-        divisorDb.mark_block_as_failed(block)
+        # a failed speculative copy says nothing about the original claim
+        if not speculative:
+            divisorDb.mark_block_as_failed(block)
         raise e
 
+    if columnar_store is not None:
+        policy = storage_policy or FixedThresholdPolicy(
+            DivisorDb.threshold_witness_value)
+        # The block is already finished, so an error here is not a failure
+        # to process it, and the store can be rebuilt from the database.
+        try:
+            columnar_store.append(
+                policy.select(block, divisor_sums, None), block)
+        except Exception as e:
+            print(
+                f"Failed to append to the columnar store.\n"
+                f"Error was: {e}"
+            )
+
     end = datetime.now()
     print(
         f"Computed and saved ["
@@ -46,19 +111,50 @@ def claim_and_compute_one_block(
     )
 
 
+def claim_speculative_block(
+        divisorDb: DivisorDb,
+        search_strategy: SearchStrategy,
+        speculate_after: timedelta) -> SearchMetadata:
+    try:
+        block = divisorDb.claim_speculative_search_block(
+            search_strategy.index_name(), running_for=speculate_after)
+    except ValueError as e:
+        print(
+            f"Failed to claim search block, "
+            f"or to speculatively claim a copy of one.\n"
+            f"Error was: {e}"
+        )
+        raise e
+
+    print(
+        f"Speculatively computing a copy of ["
+        f"{block.starting_search_index.serialize()}, "
+        f"{block.ending_search_index.serialize()}], "
+        f"in progress since {block.start_time}"
+    )
+    return block
+
+
 def main(
         divisorDb: DivisorDb,
-        search_strategy: SearchStrategy) -> None:
+        search_strategy: SearchStrategy,
+        speculate_after: Optional[timedelta] = None,
+        columnar_store: Optional[ColumnarStoreWriter] = None,
+        storage_policy: Optional[StoragePolicy] = None) -> None:
     '''Repeatedly look for search blocks to process.'''
     failure_count = 0
     while True:
         try:
-            claim_and_compute_one_block(divisorDb, search_strategy)
+            claim_and_compute_one_block(
+                divisorDb, search_strategy, speculate_after, columnar_store,
+                storage_policy)
             failure_count = 0
         except ValueError as e:
             failure_count += 1
             if failure_count > 7:
                 print(f"Failed {failure_count} times, quitting.")
+                if columnar_store is not None:
+                    columnar_store.flush()
                 return
 
             sleep_seconds = 1 + 2**failure_count
@@ -71,14 +167,100 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--data_source_name', type=str,
                         help='The psycopg data_source_name string')
+    parser.add_argument('--sqlite_path', type=str,
+                        help='If set, use the sqlite database in this file '
+                             'instead of postgres')
     parser.add_argument('--search_strategy_name', type=str,
                         choices=['ExhaustiveSearchStrategy',
                                  'SuperabundantSearchStrategy'],
                         default='SuperabundantSearchStrategy',
                         help='The search strategy name')
+    parser.add_argument('--agent_address', type=str,
+                        help='If set, connect to the batching agent serving '
+                             'this Unix socket instead of to postgres')
+    parser.add_argument('--agent_authkey', type=str,
+                        default=batching_agent.DEFAULT_AUTHKEY,
+                        help='The key used to authenticate with the agent')
+
+    parser.add_argument('--speculate_after_minutes', type=int,
+                        help='If set, when there are no blocks to claim, '
+                             'compute a copy of the oldest block that has been '
+                             'in progress for at least this many minutes')
+    parser.add_argument('--journal_dir', type=str,
+                        help='If set, journal finished blocks in this '
+                             'directory so that computation continues while '
+                             'the database is unavailable')
+    parser.add_argument('--lease_size', type=int, default=8,
+                        help='The number of blocks to lease at a time when '
+                             'journaling')
+    parser.add_argument('--expected_block_minutes', type=float,
+                        help='If set, check that a lease of blocks taking '
+                             'this long each can be computed through an '
+                             'outage before the blocks go stale')
+    parser.add_argument('--stale_threshold_hours', type=float, default=2,
+                        help='The stale threshold of cleanup_stale_blocks, '
+                             'used to check the lease size')
+    parser.add_argument('--columnar_store_dir', type=str,
+                        help='If set, also append stored divisor sums to a '
+                             'columnar store in this directory')
+    parser.add_argument('--storage_policy', type=str,
+                        help='If set, the policy deciding which divisor sums '
+                             'are stored, one of fixed:<witness value>, '
+                             'record_delta:<delta> or top_k_per_level:<k>. '
+                             'When using an agent, set it on the agent too.')
 
     args = parser.parse_args()
-    db = PostgresDivisorDb(data_source_name=args.data_source_name)
+    if args.journal_dir and args.expected_block_minutes is not None:
+        try:
+            check_lease_duration(
+                args.lease_size,
+                timedelta(minutes=args.expected_block_minutes),
+                timedelta(hours=args.stale_threshold_hours))
+        except ValueError as e:
+            parser.error(str(e))
+    storage_policy = None
+    if args.storage_policy:
+        storage_policy = storage_policy_from_spec(args.storage_policy)
+
+    def connect() -> DivisorDb:
+        if args.agent_address:
+            return batching_agent.connect(
+                args.agent_address, args.agent_authkey)
+        connected: DivisorDb
+        if args.sqlite_path:
+            connected = SqliteDivisorDb(args.sqlite_path)
+        else:
+            connected = PostgresDivisorDb(
+                data_source_name=args.data_source_name)
+        connected.storage_policy = storage_policy
+        return connected
+
+    db: DivisorDb
+    if args.journal_dir:
+        db = JournalingDivisorDb(
+            connect,
+            args.journal_dir,
+            lease_size=args.lease_size,
+            unavailable_errors=(
+                OSError,
+                EOFError,
+                psycopg2.OperationalError,
+                psycopg2.InterfaceError,
+                sqlite3.OperationalError,
+            ),
+        )
+        db.storage_policy = storage_policy
+    else:
+        db = connect()
     search_strategy_name = args.search_strategy_name
     search_strategy = search_strategy_by_name(search_strategy_name)()
-    main(db, search_strategy)
+    speculate_after = None
+    if args.speculate_after_minutes is not None:
+        speculate_after = timedelta(minutes=args.speculate_after_minutes)
+    columnar_store = None
+    if args.columnar_store_dir:
+        columnar_store = ColumnarStoreWriter(args.columnar_store_dir)
+    main(db, search_strategy,
+         speculate_after=speculate_after,
+         columnar_store=columnar_store,
+         storage_policy=storage_policy)
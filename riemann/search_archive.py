@@ -0,0 +1,189 @@
+'''
+Compaction of long-finished search blocks into an archive of ranges.
+
+Every claim and sweep works against the search blocks table, so finished
+blocks are moved out of it once they are old enough, into an archive of
+contiguous ranges. Each range keeps the end, hash and storage policy of every
+block in it, and ranges are merged as the gaps between them are archived.
+'''
+from typing import List
+from typing import Tuple
+import json
+
+from riemann.superabundant import cached_count_partitions_of_n
+from riemann.types import ArchivedSearchRange
+from riemann.types import ExhaustiveSearchIndex
+from riemann.types import SearchBlockState
+from riemann.types import SearchIndex
+from riemann.types import SearchMetadata
+from riemann.types import SuperabundantEnumerationIndex
+from riemann.types import deserialize_search_index
+
+# Ranges are rewritten when merged, so they are kept from growing unboundedly.
+MAX_BLOCKS_PER_RANGE = 10000
+
+
+def next_search_index(index: SearchIndex) -> SearchIndex:
+    '''The search index right after index.'''
+    if isinstance(index, ExhaustiveSearchIndex):
+        return ExhaustiveSearchIndex(n=index.n + 1)
+    if isinstance(index, SuperabundantEnumerationIndex):
+        if index.index_in_level + 1 < cached_count_partitions_of_n(index.level):
+            return SuperabundantEnumerationIndex(
+                level=index.level, index_in_level=index.index_in_level + 1)
+        return SuperabundantEnumerationIndex(
+            level=index.level + 1, index_in_level=0)
+    raise ValueError(f"Unknown search index {index}")
+
+
+def search_index_order(index: SearchIndex) -> Tuple[int, ...]:
+    '''A sort key putting search indices in search order.'''
+    if isinstance(index, ExhaustiveSearchIndex):
+        return (index.n,)
+    if isinstance(index, SuperabundantEnumerationIndex):
+        return (index.level, index.index_in_level)
+    raise ValueError(f"Unknown search index {index}")
+
+
+def archived_range_of_block(block: SearchMetadata) -> ArchivedSearchRange:
+    return ArchivedSearchRange(
+        search_index_type=block.search_index_type,
+        starting_search_index=block.starting_search_index,
+        ending_search_index=block.ending_search_index,
+        block_ending_search_indices=(block.ending_search_index,),
+        block_hashes=(block.block_hash,),
+        block_storage_policies=(block.storage_policy,),
+        last_end_time=block.end_time,
+    )
+
+
+def concatenate_ranges(
+        first: ArchivedSearchRange,
+        second: ArchivedSearchRange) -> ArchivedSearchRange:
+    '''Concatenate two ranges, where second starts right after first ends.'''
+    end_times = [
+        t for t in [first.last_end_time, second.last_end_time] if t is not None
+    ]
+    return ArchivedSearchRange(
+        search_index_type=first.search_index_type,
+        starting_search_index=first.starting_search_index,
+        ending_search_index=second.ending_search_index,
+        block_ending_search_indices=(
+            first.block_ending_search_indices
+            + second.block_ending_search_indices),
+        block_hashes=first.block_hashes + second.block_hashes,
+        block_storage_policies=(
+            first.block_storage_policies + second.block_storage_policies),
+        last_end_time=max(end_times) if end_times else None,
+    )
+
+
+def adjacent_range_keys(
+        blocks: List[SearchMetadata]
+) -> Tuple[List[SearchIndex], List[SearchIndex]]:
+    '''
+    Return the keys of the archived ranges that may be merged with blocks:
+    the search indices that a range must be followed by, i.e., the blocks'
+    starts, and those that a range must start at, i.e., the indices after the
+    blocks' ends.
+    '''
+    return (
+        [block.starting_search_index for block in blocks],
+        [next_search_index(block.ending_search_index) for block in blocks],
+    )
+
+
+def merge_archived_ranges(
+        archived: List[ArchivedSearchRange],
+        blocks: List[SearchMetadata],
+        max_blocks_per_range: int = MAX_BLOCKS_PER_RANGE
+) -> Tuple[List[ArchivedSearchRange], List[ArchivedSearchRange]]:
+    '''
+    Merge finished blocks into the archived ranges they are contiguous with.
+
+    Returns the archived ranges to remove, and the ranges to add in their
+    place, which together contain every block. Archived ranges that are not
+    merged with any block are left as they are.
+    '''
+    items = sorted(
+        [(r, True) for r in archived] +
+        [(archived_range_of_block(b), False) for b in blocks],
+        key=lambda item: search_index_order(item[0].starting_search_index))
+
+    # each group is the merged range, the archived ranges in it, and whether
+    # it contains a block
+    groups: List[Tuple[ArchivedSearchRange, List[ArchivedSearchRange], bool]] = []
+    for (item, is_archived) in items:
+        if groups:
+            (merged, sources, has_block) = groups[-1]
+            if (next_search_index(merged.ending_search_index)
+                    == item.starting_search_index
+                    and len(merged) + len(item) <= max_blocks_per_range):
+                groups[-1] = (
+                    concatenate_ranges(merged, item),
+                    sources + [item] if is_archived else sources,
+                    has_block or not is_archived,
+                )
+                continue
+        groups.append(
+            (item, [item] if is_archived else [], not is_archived))
+
+    removed = []
+    added = []
+    for (merged, sources, has_block) in groups:
+        if has_block:
+            removed.extend(sources)
+            added.append(merged)
+    return (removed, added)
+
+
+def serialize_range_blocks(archived_range: ArchivedSearchRange) -> str:
+    '''Serialize the blocks of a range as a JSON list of [end, hash, policy].'''
+    return json.dumps([
+        [end.serialize(), block_hash, storage_policy]
+        for (end, block_hash, storage_policy) in zip(
+            archived_range.block_ending_search_indices,
+            archived_range.block_hashes,
+            archived_range.block_storage_policies)
+    ])
+
+
+def deserialize_archived_range(
+        search_index_type: str,
+        starting_search_index: str,
+        blocks: str,
+        last_end_time=None) -> ArchivedSearchRange:
+    rows = json.loads(blocks)
+    ends = tuple(
+        deserialize_search_index(search_index_type, row[0]) for row in rows)
+    return ArchivedSearchRange(
+        search_index_type=search_index_type,
+        starting_search_index=deserialize_search_index(
+            search_index_type, starting_search_index),
+        ending_search_index=ends[-1],
+        block_ending_search_indices=ends,
+        block_hashes=tuple(row[1] for row in rows),
+        block_storage_policies=tuple(row[2] for row in rows),
+        last_end_time=last_end_time,
+    )
+
+
+def expand_archived_range(
+        archived_range: ArchivedSearchRange) -> List[SearchMetadata]:
+    '''Recover the finished blocks of a range, without their times.'''
+    blocks = []
+    start = archived_range.starting_search_index
+    for (end, block_hash, storage_policy) in zip(
+            archived_range.block_ending_search_indices,
+            archived_range.block_hashes,
+            archived_range.block_storage_policies):
+        blocks.append(SearchMetadata(
+            search_index_type=archived_range.search_index_type,
+            starting_search_index=start,
+            ending_search_index=end,
+            state=SearchBlockState.FINISHED,
+            block_hash=block_hash,
+            storage_policy=storage_policy,
+        ))
+        start = next_search_index(end)
+    return blocks
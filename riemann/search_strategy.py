@@ -31,6 +31,11 @@ class SearchStrategy(ABC, Generic[SearchIndexT]):
         '''Reset the search strategy to search from a given state.'''
         pass
 
+    @abstractmethod
+    def search_index(self) -> SearchIndexT:
+        '''The first search index of the next generated search block.'''
+        pass
+
     @abstractmethod
     def generate_search_blocks(
             self, count: int, batch_size: int) -> List[SearchMetadata[SearchIndexT]]:
@@ -80,6 +85,9 @@ class ExhaustiveSearchStrategy(SearchStrategy[ExhaustiveSearchIndex]):
         self._search_index = search_index
         return self
 
+    def search_index(self) -> ExhaustiveSearchIndex:
+        return self._search_index
+
     def generate_search_blocks(
             self, count: int, batch_size: int) -> List[SearchMetadata[ExhaustiveSearchIndex]]:
         start = self._search_index.n
@@ -93,6 +101,7 @@ class ExhaustiveSearchStrategy(SearchStrategy[ExhaustiveSearchIndex]):
                 ending_search_index=ending_index,
                 search_index_type=self.index_name(),
             ))
+        self._search_index = ExhaustiveSearchIndex(n=start)
         return blocks
 
     def process_block(
@@ -134,6 +143,13 @@ class SuperabundantSearchStrategy(
         self.__maybe_reset_current_level__()
         return self
 
+    def search_index(self) -> SuperabundantEnumerationIndex:
+        return self._search_index
+
+    def remaining_in_level(self) -> int:
+        '''The number of search indices left in the current level.'''
+        return len(self.current_level) - self._search_index.index_in_level
+
     def generate_search_blocks(
             self, count: int, batch_size: int) -> List[SearchMetadata[SuperabundantEnumerationIndex]]:
         return [self.generate_next_block(batch_size) for i in range(count)]
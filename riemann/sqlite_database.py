@@ -0,0 +1,895 @@
+'''
+A DivisorDb stored in a single SQLite file, for running without a database
+server.
+
+The file is opened in WAL mode, so several local worker processes can share
+it, and every write happens in a single IMMEDIATE transaction, so concurrent
+claims never hand out the same block.
+'''
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from datetime import timedelta
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+import json
+import sqlite3
+
+from dataclasses import replace
+from gmpy2 import log
+from gmpy2 import mpz
+from riemann.database import DivisorDb
+from riemann.database import witness_record_candidates
+from riemann.level_stats import block_level_stats
+from riemann.level_stats import count_pruned
+from riemann.level_stats import merge_all_level_stats
+from riemann.search_archive import adjacent_range_keys
+from riemann.search_archive import deserialize_archived_range
+from riemann.search_archive import merge_archived_ranges
+from riemann.search_archive import next_search_index
+from riemann.search_archive import search_index_order
+from riemann.search_archive import serialize_range_blocks
+from riemann.superabundant import prime_factor_count
+from riemann.types import ArchivedSearchRange
+from riemann.types import deserialize_search_index
+from riemann.types import LevelStats
+from riemann.types import RiemannDivisorSum
+from riemann.types import SearchIndex
+from riemann.types import SearchBlockState
+from riemann.types import SearchMetadata
+from riemann.types import SummaryStats
+from riemann.types import hash_divisor_sums
+
+DEFAULT_PATH = 'divisor.sqlite'
+
+METADATA_COLUMNS = '''
+  starting_search_index,
+  ending_search_index,
+  search_index_type,
+  state,
+  creation_time,
+  start_time,
+  end_time,
+  block_hash,
+  storage_policy,
+  claim_token
+'''
+
+
+def serialize_mpz(value: int) -> bytes:
+    '''
+    Serialize a nonnegative integer as big-endian bytes, prefixed by the byte
+    length. SQLite compares blobs bytewise, so serialized integers sort
+    numerically.
+    '''
+    value = int(value)
+    length = (value.bit_length() + 7) // 8
+    return length.to_bytes(2, 'big') + value.to_bytes(length, 'big')
+
+
+def deserialize_mpz(data: bytes) -> mpz:
+    return mpz(int.from_bytes(data[2:], 'big'))
+
+
+def serialize_datetime(value: Optional[datetime]) -> Optional[str]:
+    # A fixed width keeps the text sorted in time order
+    return value.isoformat(timespec='microseconds') if value is not None else None
+
+
+def deserialize_datetime(value: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value is not None else None
+
+
+class SqliteDivisorDb(DivisorDb):
+    '''A database implementation using sqlite.'''
+
+    def __init__(self, path: str = DEFAULT_PATH, timeout_seconds: float = 60):
+        '''Open the database file, creating it if necessary.'''
+        self.path = path
+        # isolation_level=None leaves transactions to be managed explicitly
+        self.connection = sqlite3.connect(
+            path, timeout=timeout_seconds, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL;')
+        self.connection.execute('PRAGMA synchronous=NORMAL;')
+
+    @contextmanager
+    def write_transaction(self) -> Iterator[sqlite3.Cursor]:
+        '''
+        Run a transaction that holds the write lock from the start, so that
+        concurrent read-then-write transactions cannot deadlock. The
+        transaction is committed on success and rolled back on any exception,
+        so that a failed write does not keep holding the lock.
+        '''
+        cursor = self.connection.cursor()
+        cursor.execute('BEGIN IMMEDIATE;')
+        try:
+            yield cursor
+        except BaseException:
+            cursor.execute('ROLLBACK;')
+            raise
+        cursor.execute('COMMIT;')
+
+    def initialize_schema(self):
+        with self.write_transaction() as cursor:
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS RiemannDivisorSums (
+                n BLOB NOT NULL,
+                divisor_sum BLOB,
+                witness_value REAL,
+                log_n REAL NOT NULL,
+                level INTEGER NOT NULL
+            );''')
+            # n is the natural key of the divisor sums
+            cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS RiemannDivisorSums_n
+            ON RiemannDivisorSums (n);
+            ''')
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS RiemannDivisorSums_witness_value
+            ON RiemannDivisorSums (witness_value);
+            ''')
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS RiemannDivisorSums_log_n
+            ON RiemannDivisorSums (log_n);
+            ''')
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS RiemannDivisorSums_level_witness_value
+            ON RiemannDivisorSums (level, witness_value);
+            ''')
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS SearchMetadata (
+                creation_time TEXT,
+                start_time TEXT,
+                end_time TEXT,
+                search_index_type TEXT,
+                state TEXT CHECK (state IN (
+                  'NOT_STARTED', 'IN_PROGRESS', 'FINISHED', 'FAILED')),
+                starting_search_index TEXT,
+                ending_search_index TEXT,
+                block_hash TEXT,
+                speculative_claims INTEGER NOT NULL DEFAULT 0,
+                storage_policy TEXT,
+                claim_token INTEGER NOT NULL DEFAULT 0,
+                UNIQUE (
+                    search_index_type,
+                    starting_search_index,
+                    ending_search_index
+                )
+            );''')
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS SearchMetadata_claimable_creation_time
+            ON SearchMetadata (search_index_type, creation_time)
+            WHERE state = 'NOT_STARTED' OR state = 'FAILED';
+            ''')
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS SearchMetadata_finished_end_time
+            ON SearchMetadata (search_index_type, end_time)
+            WHERE state = 'FINISHED';
+            ''')
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS SearchGenerationWatermark (
+                search_index_type TEXT PRIMARY KEY,
+                next_search_index TEXT
+            );''')
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS SearchMetadataArchive (
+                search_index_type TEXT,
+                starting_search_index TEXT,
+                ending_search_index TEXT,
+                next_search_index TEXT,
+                block_count INTEGER,
+                blocks TEXT,
+                last_end_time TEXT,
+                PRIMARY KEY (search_index_type, starting_search_index)
+            );''')
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS SearchMetadataArchive_next_search_index
+            ON SearchMetadataArchive (search_index_type, next_search_index);
+            ''')
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS DivisorSumSummary (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                largest_computed_n BLOB,
+                largest_computed_n_divisor_sum BLOB,
+                largest_computed_n_witness_value REAL
+            );''')
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS WitnessRecords (
+                n BLOB PRIMARY KEY,
+                divisor_sum BLOB,
+                witness_value REAL
+            );''')
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS LevelStats (
+                search_index_type TEXT,
+                level INTEGER,
+                count INTEGER,
+                count_above_threshold INTEGER,
+                count_pruned INTEGER NOT NULL DEFAULT 0,
+                max_witness_value REAL,
+                max_witness_index INTEGER,
+                witness_histogram TEXT,
+                seconds REAL,
+                PRIMARY KEY (search_index_type, level)
+            );''')
+            cursor.execute('''
+            INSERT OR IGNORE INTO DivisorSumSummary (id) VALUES (1);
+            ''')
+
+    def convert_metadatas(self, rows):
+        return [
+            SearchMetadata(
+                starting_search_index=deserialize_search_index(row[2], row[0]),
+                ending_search_index=deserialize_search_index(row[2], row[1]),
+                search_index_type=row[2],
+                # indexing [ ] is Python's "name to enum" lookup
+                state=SearchBlockState[row[3]],
+                creation_time=deserialize_datetime(row[4]),
+                start_time=deserialize_datetime(row[5]),
+                end_time=deserialize_datetime(row[6]),
+                block_hash=row[7],
+                storage_policy=row[8],
+                claim_token=row[9],
+            ) for row in rows
+        ]
+
+    def serialize_key(self, metadata):
+        return (
+            metadata.search_index_type,
+            metadata.starting_search_index.serialize(),
+            metadata.ending_search_index.serialize(),
+        )
+
+    def load(self) -> Iterable[RiemannDivisorSum]:
+        cursor = self.connection.cursor()
+        cursor.execute('''
+            SELECT n, divisor_sum, witness_value
+            FROM RiemannDivisorSums;
+        ''')
+        for row in cursor:
+            yield RiemannDivisorSum(
+                n=deserialize_mpz(row[0]),
+                divisor_sum=deserialize_mpz(row[1]),
+                witness_value=row[2]
+            )
+
+    def load_metadata(self) -> List[SearchMetadata]:
+        cursor = self.connection.cursor()
+        cursor.execute(f'''
+            SELECT {METADATA_COLUMNS}
+            FROM SearchMetadata
+            ORDER BY creation_time asc;
+        ''')
+        return self.convert_metadatas(cursor.fetchall())
+
+    def load_finished_search_blocks(
+            self,
+            search_index_type: str,
+            count: int) -> List[SearchMetadata]:
+        cursor = self.connection.cursor()
+        cursor.execute(f'''
+            SELECT {METADATA_COLUMNS}
+            FROM SearchMetadata
+            WHERE
+              search_index_type = ?
+              AND state = 'FINISHED'
+            ORDER BY end_time DESC
+            LIMIT ?;
+        ''', (search_index_type, count))
+        return self.convert_metadatas(cursor.fetchall())
+
+    def convert_records(self, rows):
+        return [
+            RiemannDivisorSum(n=deserialize_mpz(row[0]),
+                              divisor_sum=deserialize_mpz(row[1]),
+                              witness_value=row[2]) for row in rows
+        ]
+
+    def summarize(self) -> SummaryStats:
+        cursor = self.connection.cursor()
+        cursor.execute('''
+            SELECT
+              largest_computed_n,
+              largest_computed_n_divisor_sum,
+              largest_computed_n_witness_value
+            FROM DivisorSumSummary
+            WHERE largest_computed_n IS NOT NULL;
+        ''')
+        largest_n_rows = self.convert_records(cursor.fetchall())
+
+        # the largest witness value is always the last record
+        cursor.execute('''
+            SELECT n, divisor_sum, witness_value
+            FROM WitnessRecords
+            ORDER BY n DESC
+            LIMIT 1;
+        ''')
+        largest_witness_rows = self.convert_records(cursor.fetchall())
+
+        if not largest_n_rows or not largest_witness_rows:
+            raise ValueError("No data!")
+
+        return SummaryStats(largest_computed_n=largest_n_rows[0],
+                            largest_witness_value=largest_witness_rows[0])
+
+    def load_top_witness_values(
+            self,
+            count: int,
+            level: Optional[int] = None) -> List[RiemannDivisorSum]:
+        cursor = self.connection.cursor()
+        if level is None:
+            cursor.execute('''
+                SELECT n, divisor_sum, witness_value
+                FROM RiemannDivisorSums
+                ORDER BY witness_value DESC
+                LIMIT ?;
+            ''', (count,))
+        else:
+            cursor.execute('''
+                SELECT n, divisor_sum, witness_value
+                FROM RiemannDivisorSums
+                WHERE level = ?
+                ORDER BY witness_value DESC
+                LIMIT ?;
+            ''', (level, count))
+        return self.convert_records(cursor.fetchall())
+
+    def load_log_n_range(
+            self,
+            min_log_n: float,
+            max_log_n: float) -> List[RiemannDivisorSum]:
+        cursor = self.connection.cursor()
+        cursor.execute('''
+            SELECT n, divisor_sum, witness_value
+            FROM RiemannDivisorSums
+            WHERE log_n >= ? AND log_n < ?
+            ORDER BY log_n ASC;
+        ''', (min_log_n, max_log_n))
+        return self.convert_records(cursor.fetchall())
+
+    def load_above_witness_value(
+            self, min_witness_value: float) -> List[RiemannDivisorSum]:
+        cursor = self.connection.cursor()
+        cursor.execute('''
+            SELECT n, divisor_sum, witness_value
+            FROM RiemannDivisorSums
+            WHERE witness_value >= ?
+            ORDER BY n ASC;
+        ''', (min_witness_value,))
+        return self.convert_records(cursor.fetchall())
+
+    def max_divisor_sum_id(self) -> int:
+        # rowids increase as rows are inserted, since none are deleted
+        cursor = self.connection.cursor()
+        cursor.execute('SELECT max(rowid) FROM RiemannDivisorSums;')
+        return cursor.fetchone()[0] or 0
+
+    def load_log_n_and_witness_values(
+            self,
+            after_id: int,
+            through_id: int) -> List[Tuple[float, float]]:
+        cursor = self.connection.cursor()
+        cursor.execute('''
+            SELECT log_n, witness_value
+            FROM RiemannDivisorSums
+            WHERE rowid > ? AND rowid <= ?
+            ORDER BY rowid ASC;
+        ''', (after_id, through_id))
+        return cursor.fetchall()
+
+    def load_witness_records(self) -> List[RiemannDivisorSum]:
+        cursor = self.connection.cursor()
+        cursor.execute('''
+            SELECT n, divisor_sum, witness_value
+            FROM WitnessRecords
+            ORDER BY n ASC;
+        ''')
+        return self.convert_records(cursor.fetchall())
+
+    def load_level_stats(self, search_index_type: str) -> List[LevelStats]:
+        cursor = self.connection.cursor()
+        cursor.execute('''
+            SELECT
+              level,
+              count,
+              count_above_threshold,
+              max_witness_value,
+              max_witness_index,
+              witness_histogram,
+              seconds,
+              count_pruned
+            FROM LevelStats
+            WHERE search_index_type = ?
+            ORDER BY level ASC;
+        ''', (search_index_type,))
+        return [
+            LevelStats(
+                level=row[0],
+                count=row[1],
+                count_above_threshold=row[2],
+                max_witness_value=row[3],
+                max_witness_index=row[4],
+                witness_histogram=tuple(json.loads(row[5])),
+                seconds=row[6],
+                count_pruned=row[7],
+            ) for row in cursor.fetchall()
+        ]
+
+    def update_level_stats(
+            self,
+            cursor: sqlite3.Cursor,
+            finished_blocks: List[Tuple[
+                SearchMetadata, List[RiemannDivisorSum], List[RiemannDivisorSum]]]
+    ) -> None:
+        '''
+        Merge the level statistics of newly finished blocks, each given with
+        all of its divisor sums and those stored, into the LevelStats table,
+        as part of the caller's write transaction.
+        '''
+        merged: Dict[str, Dict[int, LevelStats]] = defaultdict(dict)
+        for (metadata, divisor_sums, stored) in finished_blocks:
+            merged[metadata.search_index_type] = merge_all_level_stats(
+                count_pruned(
+                    block_level_stats(
+                        metadata, divisor_sums, self.threshold_witness_value),
+                    metadata, stored),
+                into=merged[metadata.search_index_type])
+
+        for (search_index_type, stats_by_level) in merged.items():
+            existing = {
+                stats.level: stats
+                for stats in self.load_level_stats(search_index_type)
+                if stats.level in stats_by_level
+            }
+            for stats in merge_all_level_stats(
+                    stats_by_level.values(), into=existing).values():
+                cursor.execute('''
+                    INSERT OR REPLACE INTO LevelStats (
+                        search_index_type,
+                        level,
+                        count,
+                        count_above_threshold,
+                        max_witness_value,
+                        max_witness_index,
+                        witness_histogram,
+                        seconds,
+                        count_pruned
+                    )
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);
+                ''', (
+                    search_index_type,
+                    stats.level,
+                    stats.count,
+                    stats.count_above_threshold,
+                    stats.max_witness_value,
+                    stats.max_witness_index,
+                    json.dumps(stats.witness_histogram),
+                    stats.seconds,
+                    stats.count_pruned,
+                ))
+
+    def update_summary(self,
+                       cursor: sqlite3.Cursor,
+                       divisor_sums: List[RiemannDivisorSum]) -> None:
+        '''
+        Update the summary and witness records with newly stored divisor sums,
+        as part of the caller's write transaction.
+        '''
+        if not divisor_sums:
+            return
+
+        largest = max(divisor_sums, key=lambda d: d.n)
+        cursor.execute('''
+            UPDATE DivisorSumSummary
+            SET
+              largest_computed_n = ?,
+              largest_computed_n_divisor_sum = ?,
+              largest_computed_n_witness_value = ?
+            WHERE largest_computed_n IS NULL OR largest_computed_n < ?;
+        ''', (serialize_mpz(largest.n), serialize_mpz(largest.divisor_sum),
+              float(largest.witness_value), serialize_mpz(largest.n)))
+
+        for record in witness_record_candidates(divisor_sums):
+            n = serialize_mpz(record.n)
+            witness_value = float(record.witness_value)
+            cursor.execute('''
+                SELECT EXISTS (
+                  SELECT 1 FROM WitnessRecords
+                  WHERE n <= ? AND witness_value >= ?
+                );
+            ''', (n, witness_value))
+            if cursor.fetchone()[0]:
+                continue
+            cursor.execute('''
+                DELETE FROM WitnessRecords
+                WHERE n >= ? AND witness_value <= ?;
+            ''', (n, witness_value))
+            cursor.execute('''
+                INSERT INTO WitnessRecords (n, divisor_sum, witness_value)
+                VALUES (?, ?, ?);
+            ''', (n, serialize_mpz(record.divisor_sum), witness_value))
+
+    def insert_search_blocks(
+            self,
+            blocks: List[SearchMetadata],
+            next_search_index: Optional[SearchIndex] = None) -> None:
+        with self.write_transaction() as cursor:
+            try:
+                cursor.executemany('''
+                INSERT INTO
+                    SearchMetadata(
+                      creation_time,
+                      start_time,
+                      end_time,
+                      search_index_type,
+                      state,
+                      starting_search_index,
+                      ending_search_index,
+                      block_hash
+                    )
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+                ''', [
+                    (
+                        serialize_datetime(block.creation_time),
+                        serialize_datetime(block.start_time),
+                        serialize_datetime(block.end_time),
+                        block.search_index_type,
+                        SearchBlockState.NOT_STARTED.name,
+                        block.starting_search_index.serialize(),
+                        block.ending_search_index.serialize(),
+                        block.block_hash
+                    )
+                    for block in blocks
+                ])
+
+                if next_search_index is not None:
+                    cursor.execute('''
+                    INSERT INTO
+                        SearchGenerationWatermark(search_index_type, next_search_index)
+                        VALUES (?, ?)
+                    ON CONFLICT (search_index_type)
+                    DO UPDATE SET next_search_index = excluded.next_search_index;
+                    ''', (
+                        next_search_index.__class__.__name__,
+                        next_search_index.serialize()))
+            except sqlite3.IntegrityError as e:
+                raise ValueError(f"PK violation: {e}")
+
+    def load_next_search_index(
+            self, search_index_type: str) -> Optional[SearchIndex]:
+        cursor = self.connection.cursor()
+        cursor.execute('''
+            SELECT next_search_index
+            FROM SearchGenerationWatermark
+            WHERE search_index_type = ?;
+        ''', (search_index_type,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return deserialize_search_index(search_index_type, row[0])
+
+    def count_eligible_search_blocks(self, search_index_type: str) -> int:
+        cursor = self.connection.cursor()
+        cursor.execute('''
+            SELECT count(*)
+            FROM SearchMetadata
+            WHERE
+              search_index_type = ?
+              AND (state = 'NOT_STARTED' OR state = 'FAILED');
+        ''', (search_index_type,))
+        return cursor.fetchone()[0]
+
+    def claim_next_search_block(
+            self, search_index_type: str) -> SearchMetadata:
+        return self.claim_next_search_blocks(search_index_type, 1)[0]
+
+    def claim_next_search_blocks(
+            self,
+            search_index_type: str,
+            count: int) -> List[SearchMetadata]:
+        with self.write_transaction() as cursor:
+            cursor.execute(f'''
+                UPDATE SearchMetadata
+                SET
+                  start_time = ?,
+                  state = 'IN_PROGRESS',
+                  claim_token = claim_token + 1
+                WHERE rowid IN (
+                    SELECT rowid
+                    FROM SearchMetadata
+                    WHERE
+                      search_index_type = ?
+                      AND (state = 'NOT_STARTED' OR state = 'FAILED')
+                    ORDER BY creation_time ASC
+                    LIMIT ?
+                )
+                RETURNING {METADATA_COLUMNS};
+            ''', (serialize_datetime(datetime.now()), search_index_type, count))
+            rows = cursor.fetchall()
+
+        if not rows:
+            raise ValueError('No legal search block to claim')
+        # RETURNING does not preserve the order of the subquery
+        return sorted(self.convert_metadatas(rows),
+                      key=lambda block: block.creation_time)
+
+    def claim_speculative_search_block(
+            self,
+            search_index_type: str,
+            running_for: timedelta,
+            max_copies: int = 1) -> SearchMetadata:
+        with self.write_transaction() as cursor:
+            cursor.execute(f'''
+                UPDATE SearchMetadata
+                SET
+                  speculative_claims = speculative_claims + 1
+                WHERE rowid IN (
+                    SELECT rowid
+                    FROM SearchMetadata
+                    WHERE
+                      search_index_type = ?
+                      AND state = 'IN_PROGRESS'
+                      AND start_time < ?
+                      AND speculative_claims < ?
+                    ORDER BY start_time ASC
+                    LIMIT 1
+                )
+                RETURNING {METADATA_COLUMNS};
+            ''', (
+                search_index_type,
+                serialize_datetime(datetime.now() - running_for),
+                max_copies))
+            rows = cursor.fetchall()
+
+        if not rows:
+            raise ValueError('No search block to speculatively claim')
+        return self.convert_metadatas(rows)[0]
+
+    def finish_search_block(self,
+                            metadata: SearchMetadata,
+                            divisor_sums: List[RiemannDivisorSum]) -> None:
+        self.finish_search_blocks([(metadata, divisor_sums)])
+
+    def finish_search_blocks(
+            self,
+            finished_blocks: List[Tuple[SearchMetadata, List[RiemannDivisorSum]]]
+    ) -> None:
+        hashed_blocks = [
+            (replace(metadata, block_hash=(
+                metadata.block_hash or hash_divisor_sums(divisor_sums))),
+             divisor_sums)
+            for (metadata, divisor_sums) in finished_blocks
+        ]
+        end_time = serialize_datetime(datetime.now())
+        storage_policy = self.get_storage_policy().version()
+        to_store = self.divisor_sums_to_store(finished_blocks)
+
+        errors = []
+        stored_sums = []
+        finished = []
+        with self.write_transaction() as cursor:
+            for ((metadata, _), given, block_sums) in zip(
+                    hashed_blocks, finished_blocks, to_store):
+                key = self.serialize_key(metadata)
+                cursor.execute('''
+                    UPDATE SearchMetadata
+                    SET
+                      end_time = ?,
+                      state = 'FINISHED',
+                      block_hash = ?,
+                      storage_policy = ?
+                    WHERE
+                      search_index_type = ?
+                      AND starting_search_index = ?
+                      AND ending_search_index = ?
+                      AND state = 'IN_PROGRESS'
+                      AND (? IS NULL OR claim_token = ?);
+                ''', (end_time, metadata.block_hash, storage_policy) + key + (
+                    metadata.claim_token, metadata.claim_token))
+
+                if cursor.rowcount > 0:
+                    cursor.executemany('''
+                        INSERT INTO
+                            RiemannDivisorSums(
+                              n, divisor_sum, witness_value, log_n, level)
+                            VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT (n) DO NOTHING;
+                    ''', [
+                        (serialize_mpz(d.n), serialize_mpz(d.divisor_sum),
+                         float(d.witness_value), float(log(d.n)),
+                         prime_factor_count(d.n))
+                        for d in block_sums
+                    ])
+                    stored_sums.extend(block_sums)
+                    finished.append(given + (block_sums,))
+                    continue
+
+                # A block that was already finished with the same hash, e.g., by
+                # a speculative copy, is not an error.
+                cursor.execute('''
+                    SELECT state, block_hash, claim_token
+                    FROM SearchMetadata
+                    WHERE
+                      search_index_type = ?
+                      AND starting_search_index = ?
+                      AND ending_search_index = ?;
+                ''', key)
+                state, block_hash, claim_token = (
+                    cursor.fetchone() or (None, None, None))
+                if state == 'FINISHED' and block_hash == metadata.block_hash:
+                    continue
+                elif state == 'FINISHED':
+                    errors.append(
+                        f"The block was already finished with a different hash! "
+                        f"stored={block_hash} metadata={metadata}")
+                elif state == 'IN_PROGRESS':
+                    errors.append(
+                        f"The block was claimed again since! "
+                        f"stored={claim_token} metadata={metadata}")
+                else:
+                    errors.append(
+                        f"The block was not found or not IN_PROGRESS! "
+                        f"metadata={metadata}")
+            self.update_summary(cursor, stored_sums)
+            self.update_level_stats(cursor, finished)
+
+        if errors:
+            raise ValueError('\n'.join(errors))
+
+    def renew_claim(self, metadata: SearchMetadata) -> SearchMetadata:
+        start_time = datetime.now()
+        with self.write_transaction() as cursor:
+            cursor.execute('''
+            UPDATE SearchMetadata
+            SET
+              start_time = ?
+            WHERE
+              search_index_type = ?
+              AND starting_search_index = ?
+              AND ending_search_index = ?
+              AND state = 'IN_PROGRESS'
+              AND (? IS NULL OR claim_token = ?)
+            ;
+            ''', (serialize_datetime(start_time),) + self.serialize_key(
+                metadata) + (metadata.claim_token, metadata.claim_token))
+            renewed = cursor.rowcount
+        if not renewed:
+            raise ValueError(
+                f"The block is no longer claimed! metadata={metadata}")
+        return replace(metadata, start_time=start_time)
+
+    def mark_block_as_failed(self, metadata: SearchMetadata) -> None:
+        with self.write_transaction() as cursor:
+            cursor.execute('''
+            UPDATE SearchMetadata
+            SET
+              state = 'FAILED'
+            WHERE
+              search_index_type = ?
+              AND starting_search_index = ?
+              AND ending_search_index = ?
+              AND state = 'IN_PROGRESS'
+              AND (? IS NULL OR claim_token = ?)
+            ;
+            ''', self.serialize_key(metadata) + (
+                metadata.claim_token, metadata.claim_token))
+
+    def compact_finished_search_blocks(
+            self,
+            search_index_type: str,
+            finished_before: datetime,
+            max_blocks: int = 10000) -> int:
+        with self.write_transaction() as cursor:
+            cursor.execute('''
+                SELECT 1
+                FROM SearchGenerationWatermark
+                WHERE search_index_type = ?;
+            ''', (search_index_type,))
+            if cursor.fetchone() is None:
+                return 0
+
+            cursor.execute(f'''
+                SELECT {METADATA_COLUMNS}
+                FROM SearchMetadata
+                WHERE
+                  search_index_type = ?
+                  AND state = 'FINISHED'
+                  AND end_time < ?
+                ORDER BY end_time ASC
+                LIMIT ?;
+            ''', (search_index_type, serialize_datetime(finished_before), max_blocks))
+            blocks = self.convert_metadatas(cursor.fetchall())
+            if not blocks:
+                return 0
+
+            (followed_by, starting_at) = adjacent_range_keys(blocks)
+            cursor.execute('''
+                SELECT starting_search_index, blocks, last_end_time
+                FROM SearchMetadataArchive
+                WHERE
+                  search_index_type = ?
+                  AND (
+                    next_search_index IN (SELECT value FROM json_each(?))
+                    OR starting_search_index IN (SELECT value FROM json_each(?))
+                  );
+            ''', (
+                search_index_type,
+                json.dumps([index.serialize() for index in followed_by]),
+                json.dumps([index.serialize() for index in starting_at])))
+            candidates = [
+                deserialize_archived_range(
+                    search_index_type, row[0], row[1], deserialize_datetime(row[2]))
+                for row in cursor.fetchall()
+            ]
+            (removed, added) = merge_archived_ranges(candidates, blocks)
+
+            cursor.executemany('''
+                DELETE FROM SearchMetadata
+                WHERE
+                  search_index_type = ?
+                  AND starting_search_index = ?
+                  AND ending_search_index = ?;
+            ''', [self.serialize_key(block) for block in blocks])
+            cursor.executemany('''
+                DELETE FROM SearchMetadataArchive
+                WHERE search_index_type = ? AND starting_search_index = ?;
+            ''', [
+                (search_index_type, r.starting_search_index.serialize())
+                for r in removed
+            ])
+            cursor.executemany('''
+                INSERT INTO SearchMetadataArchive (
+                  search_index_type,
+                  starting_search_index,
+                  ending_search_index,
+                  next_search_index,
+                  block_count,
+                  blocks,
+                  last_end_time
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?);
+            ''', [
+                (
+                    search_index_type,
+                    r.starting_search_index.serialize(),
+                    r.ending_search_index.serialize(),
+                    next_search_index(r.ending_search_index).serialize(),
+                    len(r),
+                    serialize_range_blocks(r),
+                    serialize_datetime(r.last_end_time),
+                )
+                for r in added
+            ])
+        return len(blocks)
+
+    def load_archived_search_ranges(
+            self, search_index_type: str) -> List[ArchivedSearchRange]:
+        cursor = self.connection.cursor()
+        cursor.execute('''
+            SELECT starting_search_index, blocks, last_end_time
+            FROM SearchMetadataArchive
+            WHERE search_index_type = ?;
+        ''', (search_index_type,))
+        return sorted(
+            (
+                deserialize_archived_range(
+                    search_index_type, row[0], row[1],
+                    deserialize_datetime(row[2]))
+                for row in cursor.fetchall()
+            ),
+            key=lambda r: search_index_order(r.starting_search_index))
+
+
+if __name__ == "__main__":
+    import sys
+    path = DEFAULT_PATH
+    if len(sys.argv) == 2:
+        path = sys.argv[1]
+
+    db = SqliteDivisorDb(path)
+    db.initialize_schema()
+    db.connection.close()
@@ -0,0 +1,157 @@
+'''
+Policies deciding which computed divisor sums are worth storing.
+
+A policy is consulted when a search block is finished, and its version (a
+spec string that parses back into the same policy) is stored with the block,
+so it is known which divisor sums of each block were kept.
+
+The supported specs are
+
+    fixed:<witness value>           store witness values above a fixed cutoff
+    record_delta:<delta>            store witness values within delta of the
+                                    running record
+    top_k_per_level:<k>             store the witness values among the k
+                                    largest stored at their level
+'''
+from abc import ABC
+from abc import abstractmethod
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+import heapq
+
+from riemann.level_stats import row_levels
+from riemann.types import RiemannDivisorSum
+from riemann.types import SearchMetadata
+
+
+# The stored witness value of a level below which a divisor sum of that level
+# is not worth storing, or None if there is none.
+LevelCutoff = Callable[[int], Optional[float]]
+
+
+class StoragePolicy(ABC):
+    # Whether select needs the largest stored witness value.
+    uses_record = False
+    # If set, select needs the witness value of this rank among those stored
+    # at each level, as a level cutoff.
+    level_cutoff_rank: Optional[int] = None
+
+    @abstractmethod
+    def version(self) -> str:
+        '''The spec string of this policy.'''
+        pass
+
+    @abstractmethod
+    def select(
+            self,
+            block: SearchMetadata,
+            divisor_sums: List[RiemannDivisorSum],
+            record_witness_value: Optional[float],
+            level_cutoff: Optional[LevelCutoff] = None
+    ) -> List[RiemannDivisorSum]:
+        '''
+        Select the divisor sums of a block to store, in their original order.
+
+        record_witness_value is the largest witness value stored before the
+        block was finished, or None if it is not known. Likewise,
+        level_cutoff gives the witness value of rank level_cutoff_rank stored
+        at a level, or is None if it is not known.
+        '''
+        pass
+
+
+class FixedThresholdPolicy(StoragePolicy):
+    def __init__(self, threshold_witness_value: float):
+        self.threshold_witness_value = threshold_witness_value
+
+    def version(self) -> str:
+        return f"fixed:{self.threshold_witness_value}"
+
+    def select(self, block, divisor_sums, record_witness_value,
+               level_cutoff=None):
+        return [
+            d for d in divisor_sums
+            if d.witness_value > self.threshold_witness_value
+        ]
+
+
+class RecordDeltaPolicy(StoragePolicy):
+    '''
+    Store the witness values within delta of the running record, including
+    records set by the block itself. Without a known record, the block's own
+    largest witness value is used, which keeps a superset of the divisor sums
+    that would be kept with the record known.
+    '''
+    uses_record = True
+
+    def __init__(self, delta: float):
+        self.delta = delta
+
+    def version(self) -> str:
+        return f"record_delta:{self.delta}"
+
+    def select(self, block, divisor_sums, record_witness_value,
+               level_cutoff=None):
+        witness_values = [float(d.witness_value) for d in divisor_sums]
+        if record_witness_value is not None:
+            witness_values.append(record_witness_value)
+        if not witness_values:
+            return []
+        threshold = max(witness_values) - self.delta
+        return [d for d in divisor_sums if d.witness_value >= threshold]
+
+
+class TopKPerLevelPolicy(StoragePolicy):
+    '''
+    Store the witness values that are among the k largest of their level,
+    among those already stored and those of the block. Within a block, ties
+    are broken in favor of the smaller n, so the selection is deterministic,
+    and a witness value tied with the k-th stored one is not stored.
+
+    Stored divisor sums are never removed, so a level keeps every divisor sum
+    that was among its k largest when its block finished. Without the
+    stored witness values, the k largest of each level of the block are
+    kept, which is a superset of those kept with them known.
+    '''
+
+    def __init__(self, k: int):
+        self.k = k
+        self.level_cutoff_rank = k
+
+    def version(self) -> str:
+        return f"top_k_per_level:{self.k}"
+
+    def select(self, block, divisor_sums, record_witness_value,
+               level_cutoff=None):
+        by_level: Dict[int, List[int]] = {}
+        for (row, level) in enumerate(row_levels(block, divisor_sums)):
+            by_level.setdefault(level, []).append(row)
+
+        selected = []
+        for (level, rows) in by_level.items():
+            top_rows = heapq.nlargest(
+                self.k, rows,
+                key=lambda row: (divisor_sums[row].witness_value,
+                                 -divisor_sums[row].n))
+            cutoff = level_cutoff(level) if level_cutoff is not None else None
+            selected.extend(
+                row for row in top_rows
+                if cutoff is None or divisor_sums[row].witness_value > cutoff)
+        return [divisor_sums[row] for row in sorted(selected)]
+
+
+def storage_policy_from_spec(spec: str) -> StoragePolicy:
+    '''Parse a policy from its spec string, as returned by version().'''
+    (name, _, value) = spec.partition(':')
+    try:
+        if name == 'fixed':
+            return FixedThresholdPolicy(float(value))
+        if name == 'record_delta':
+            return RecordDeltaPolicy(float(value))
+        if name == 'top_k_per_level':
+            return TopKPerLevelPolicy(int(value))
+    except ValueError:
+        pass
+    raise ValueError(f"Invalid storage policy spec: {spec}")
@@ -1,12 +1,12 @@
-from collections import defaultdict
+from functools import lru_cache
 from functools import reduce
-from typing import Dict
 from typing import List
 from typing import Tuple
 
-from gmpy2 import divexact
 from gmpy2 import log
 from gmpy2 import mpz
+from gmpy2 import next_prime
+from gmpy2 import remove
 from numba import njit
 from riemann.primes import primes
 from riemann.types import Partition
@@ -111,6 +111,12 @@ def count_partitions_of_n(n: int) -> int:
     return count
 
 
+@lru_cache(maxsize=None)
+def cached_count_partitions_of_n(n: int) -> int:
+    '''Compute the number of partitions of n, once per n.'''
+    return count_partitions_of_n(n)
+
+
 @njit
 def partition_to_prime_factorization(
         partition: Partition) -> PrimeFactorization:
@@ -119,12 +125,33 @@ def partition_to_prime_factorization(
 
 def factorize(n: mpz, primes: List[int]) -> PrimeFactorization:
     assert n > 0
-    factorization: Dict[int, int] = defaultdict(int)
+    n = mpz(n)
+    exponents: List[int] = []
     for p in primes:
-        while n % p == 0:
-            factorization[p] += 1
-            n = divexact(n, p)
-    return [(k, factorization[k]) for k in primes]
+        # the remaining primes cannot divide 1
+        if n == 1:
+            break
+        n, exponent = remove(n, p)
+        exponents.append(exponent)
+    exponents.extend([0] * (len(primes) - len(exponents)))
+    return list(zip(primes, exponents))
+
+
+def prime_factor_count(n: int) -> int:
+    '''
+    Count the prime factors of a positive integer, with multiplicity. For a
+    number enumerated by the superabundant search, this is its level.
+    '''
+    n = mpz(n)
+    count = 0
+    p = mpz(2)
+    while p * p <= n:
+        n, exponent = remove(n, p)
+        count += exponent
+        p = next_prime(p)
+    if n > 1:
+        count += 1
+    return count
 
 
 def prime_factor_divisor_sum(prime_factors: PrimeFactorization) -> int:
@@ -162,7 +189,7 @@ class CachedPartitionsOfN:
         self.n = n
         self.cache = None
         self.max_cache_size = max_cache_size
-        self.len = count_partitions_of_n(n=n)
+        self.len = cached_count_partitions_of_n(n)
 
     def _update_cache_starting_at(self, index):
         self.cache = dict(partitions_of_n(
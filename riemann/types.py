@@ -33,6 +33,31 @@ class SummaryStats:
     largest_witness_value: RiemannDivisorSum
 
 
+@dataclass(frozen=True)
+class LevelStats:
+    '''
+    Statistics about the divisor sums computed at one level of a search,
+    which are merged as search blocks are finished. Exhaustive searches have
+    no levels, so their statistics are kept by the integer part of log n,
+    without a max_witness_index.
+
+    count_pruned counts the divisor sums that were computed but not stored,
+    e.g., because the storage policy screened them out.
+
+    witness_histogram[i] counts the witness values w with
+    WITNESS_HISTOGRAM_EDGES[i] <= w < WITNESS_HISTOGRAM_EDGES[i+1], where the
+    first and last bins are unbounded.
+    '''
+    level: int
+    count: int = 0
+    count_above_threshold: int = 0
+    count_pruned: int = 0
+    max_witness_value: float = 0
+    max_witness_index: int = 0
+    witness_histogram: Tuple[int, ...] = ()
+    seconds: float = 0
+
+
 class SearchIndex(ABC):
     @abstractmethod
     def serialize(self) -> str:
@@ -127,9 +152,51 @@ class SearchMetadata(Generic[SearchIndexT]):
     '''
     block_hash: Optional[str] = None
 
+    '''
+    Statistics about the divisor sums of this block, per level. The field may
+    be None if they have not been computed.
+    '''
+    level_stats: Optional[Tuple[LevelStats, ...]] = None
+
+    '''
+    The version of the storage policy that selected which of this block's
+    divisor sums were stored. The field is None until the block is finished.
+    '''
+    storage_policy: Optional[str] = None
+
+    '''
+    A fencing token identifying the claim that handed out this block, which
+    increases each time the block is claimed. A finish or failure carrying a
+    token is only accepted while the block is still held by that claim, so a
+    worker whose block was marked stale and claimed again cannot overwrite
+    the new claim. Speculative copies share the token of the claim they copy.
+    The field is None for blocks that were not returned by a claim.
+    '''
+    claim_token: Optional[int] = None
+
     def key(self):
         return (
             self.search_index_type,
             self.starting_search_index,
             self.ending_search_index,
         )
+
+
+@dataclass(frozen=True)
+class ArchivedSearchRange:
+    '''
+    A range of contiguous finished search blocks, compacted into one record.
+    The i-th block of the range ends at block_ending_search_indices[i], and
+    was finished with block_hashes[i] under block_storage_policies[i]. Each
+    block starts right after the previous one ends.
+    '''
+    search_index_type: str
+    starting_search_index: SearchIndex
+    ending_search_index: SearchIndex
+    block_ending_search_indices: Tuple[SearchIndex, ...]
+    block_hashes: Tuple[Optional[str], ...]
+    block_storage_policies: Tuple[Optional[str], ...]
+    last_end_time: Optional[datetime] = None
+
+    def __len__(self) -> int:
+        return len(self.block_ending_search_indices)
@@ -0,0 +1,150 @@
+from multiprocessing import Process
+import time
+
+from riemann import batching_agent
+from riemann.batching_agent import BatchingDivisorDb
+from riemann.in_memory_database import InMemoryDivisorDb
+from riemann.types import ExhaustiveSearchIndex
+from riemann.types import RiemannDivisorSum
+from riemann.types import SearchBlockState
+from riemann.types import SearchMetadata
+
+
+def populate_search_blocks(db, count=10):
+    db.insert_search_blocks([
+        SearchMetadata(
+            search_index_type='ExhaustiveSearchIndex',
+            starting_search_index=ExhaustiveSearchIndex(n=i),
+            ending_search_index=ExhaustiveSearchIndex(n=i+1))
+        for i in range(1, 2 * count, 2)])
+
+
+def count_in_state(db, state):
+    return len([x for x in db.load_metadata() if x.state == state])
+
+
+def test_claims_are_prefetched_in_batches():
+    underlying = InMemoryDivisorDb()
+    populate_search_blocks(underlying)
+    db = BatchingDivisorDb(underlying, claim_batch_size=4)
+
+    first = db.claim_next_search_block('ExhaustiveSearchIndex')
+    assert count_in_state(underlying, SearchBlockState.IN_PROGRESS) == 4
+
+    rest = [db.claim_next_search_block('ExhaustiveSearchIndex')
+            for i in range(3)]
+    assert count_in_state(underlying, SearchBlockState.IN_PROGRESS) == 4
+    assert len(set(b.key() for b in [first] + rest)) == 4
+
+    db.claim_next_search_block('ExhaustiveSearchIndex')
+    assert count_in_state(underlying, SearchBlockState.IN_PROGRESS) == 8
+
+
+def test_finishes_are_buffered_until_batch_is_full():
+    underlying = InMemoryDivisorDb()
+    populate_search_blocks(underlying)
+    db = BatchingDivisorDb(
+        underlying, finish_batch_size=3, flush_period_seconds=1000)
+
+    for i in range(2):
+        block = db.claim_next_search_block('ExhaustiveSearchIndex')
+        db.finish_search_block(block, [
+            RiemannDivisorSum(n=i+10, divisor_sum=1, witness_value=2)])
+    assert count_in_state(underlying, SearchBlockState.FINISHED) == 0
+
+    block = db.claim_next_search_block('ExhaustiveSearchIndex')
+    db.finish_search_block(block, [
+        RiemannDivisorSum(n=12, divisor_sum=1, witness_value=2)])
+    assert count_in_state(underlying, SearchBlockState.FINISHED) == 3
+    assert len(list(underlying.load())) == 3
+
+
+def test_reads_flush_pending_finishes():
+    underlying = InMemoryDivisorDb()
+    populate_search_blocks(underlying)
+    db = BatchingDivisorDb(
+        underlying, finish_batch_size=100, flush_period_seconds=1000)
+
+    block = db.claim_next_search_block('ExhaustiveSearchIndex')
+    records = [RiemannDivisorSum(n=10, divisor_sum=1, witness_value=2)]
+    db.finish_search_block(block, records)
+
+    assert db.summarize().largest_witness_value == records[0]
+
+
+class FailingDivisorDb(InMemoryDivisorDb):
+    '''Fails to finish blocks a given number of times, like a lost connection.'''
+
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+
+    def finish_search_blocks(self, finished_blocks):
+        if self.failures > 0:
+            self.failures -= 1
+            raise RuntimeError('connection lost')
+        super().finish_search_blocks(finished_blocks)
+
+
+def test_failed_flush_keeps_finished_blocks():
+    underlying = FailingDivisorDb(failures=2)
+    populate_search_blocks(underlying)
+    reconnects = []
+
+    def reconnect():
+        reconnects.append(1)
+        return underlying
+
+    db = BatchingDivisorDb(
+        underlying, finish_batch_size=1, flush_period_seconds=1000,
+        reconnect=reconnect)
+
+    for i in range(3):
+        block = db.claim_next_search_block('ExhaustiveSearchIndex')
+        db.finish_search_block(block, [
+            RiemannDivisorSum(n=i+10, divisor_sum=1, witness_value=2)])
+    # the first write failed, and the rest wait for the backoff
+    assert count_in_state(underlying, SearchBlockState.FINISHED) == 0
+    assert len(db.finished) == 3
+    assert db.backoff_seconds == 1
+
+    db.retry_time = 0
+    db.flush_with_backoff()
+    assert db.backoff_seconds == 2
+    db.retry_time = 0
+    db.flush_with_backoff()
+    assert db.backoff_seconds == 0
+
+    assert count_in_state(underlying, SearchBlockState.FINISHED) == 3
+    assert len(list(underlying.load())) == 3
+    assert len(reconnects) == 2
+
+
+def test_serve_over_unix_socket(tmp_path):
+    address = str(tmp_path / 'agent.sock')
+    underlying = InMemoryDivisorDb()
+    populate_search_blocks(underlying)
+
+    def run_agent():
+        batching_agent.serve(
+            BatchingDivisorDb(underlying, finish_batch_size=1),
+            address=address)
+
+    agent = Process(target=run_agent)
+    agent.start()
+    try:
+        for i in range(50):
+            try:
+                db = batching_agent.connect(address)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                time.sleep(0.1)
+
+        block = db.claim_next_search_block('ExhaustiveSearchIndex')
+        assert block.state == SearchBlockState.IN_PROGRESS
+        records = [RiemannDivisorSum(n=10, divisor_sum=1, witness_value=2)]
+        db.finish_search_block(block, records)
+        assert db.summarize().largest_witness_value == records[0]
+    finally:
+        agent.terminate()
+        agent.join()
@@ -0,0 +1,193 @@
+from datetime import datetime
+from datetime import timedelta
+import pytest
+
+from riemann.block_sizing import BlockCostModel
+from riemann.block_sizing import choose_block_size
+from riemann.block_sizing import fit_cost_model
+from riemann.block_sizing import generate_timed_search_blocks
+from riemann.search_strategy import SuperabundantSearchStrategy
+from riemann.types import LevelStats
+from riemann.types import SearchBlockState
+from riemann.types import SearchMetadata
+from riemann.types import SuperabundantEnumerationIndex
+
+
+def finished_block(level, start, end, seconds):
+    start_time = datetime(2021, 1, 1)
+    return SearchMetadata(
+        starting_search_index=SuperabundantEnumerationIndex(
+            level=level, index_in_level=start),
+        ending_search_index=SuperabundantEnumerationIndex(
+            level=level, index_in_level=end),
+        state=SearchBlockState.FINISHED,
+        start_time=start_time,
+        end_time=start_time + timedelta(seconds=seconds),
+    )
+
+
+def test_fit_cost_model_per_level():
+    model = fit_cost_model([
+        LevelStats(level=40, count=400, seconds=60),
+        LevelStats(level=41, count=100, seconds=20),
+        LevelStats(level=42, count=100),
+    ])
+    assert model.seconds_per_index == {40: 60 / 400, 41: 20 / 100}
+    assert model.block_overhead_seconds == 0
+
+
+def test_fit_cost_model_block_overhead_beyond_compute_time():
+    level_stats = [LevelStats(level=40, count=400, seconds=40)]
+    model = fit_cost_model(level_stats, [
+        finished_block(level=40, start=0, end=99, seconds=15),
+        finished_block(level=40, start=100, end=399, seconds=32),
+        finished_block(level=40, start=400, end=499, seconds=11),
+        # unmeasured levels are ignored
+        finished_block(level=41, start=0, end=99, seconds=1000),
+    ])
+    assert model.block_overhead_seconds == pytest.approx(2)
+
+
+def test_fit_cost_model_ignores_blocks_spanning_levels():
+    block = SearchMetadata(
+        starting_search_index=SuperabundantEnumerationIndex(
+            level=40, index_in_level=5),
+        ending_search_index=SuperabundantEnumerationIndex(
+            level=41, index_in_level=5),
+        start_time=datetime(2021, 1, 1),
+        end_time=datetime(2021, 1, 2),
+    )
+    level_stats = [
+        LevelStats(level=40, count=1, seconds=1),
+        LevelStats(level=41, count=1, seconds=1),
+    ]
+    assert fit_cost_model(level_stats, [block]).block_overhead_seconds == 0
+
+
+def test_estimate_extrapolates_growth():
+    model = BlockCostModel(seconds_per_index={10: 1.0, 20: 2.0})
+    assert model.estimate(10) == 1.0
+    assert model.estimate(30) == pytest.approx(4.0)
+    assert BlockCostModel(seconds_per_index={}).estimate(10) is None
+    assert BlockCostModel(seconds_per_index={10: 3.0}).estimate(50) == 3.0
+
+
+def test_choose_block_size_for_target_duration():
+    assert choose_block_size(
+        seconds_per_index=0.01,
+        target_seconds=100,
+        remaining_in_level=100000,
+        min_block_size=1,
+        max_block_size=1000000) == 10000
+
+
+def test_choose_block_size_clamped():
+    assert choose_block_size(
+        seconds_per_index=0.01,
+        target_seconds=100,
+        remaining_in_level=100000,
+        min_block_size=1,
+        max_block_size=500) == 500
+
+
+def test_choose_block_size_stops_at_level_boundary():
+    assert choose_block_size(
+        seconds_per_index=0.01,
+        target_seconds=100,
+        remaining_in_level=3000,
+        min_block_size=1,
+        max_block_size=1000000) == 3000
+
+
+def test_choose_block_size_straddles_level_boundary_when_cheaper():
+    kwargs = dict(
+        seconds_per_index=0.01,
+        target_seconds=100,
+        remaining_in_level=3000,
+        min_block_size=1,
+        max_block_size=1000000,
+        block_overhead_seconds=30)
+    # 7000 indices at the next level take 0.7s past their estimate
+    assert choose_block_size(next_seconds_per_index=0.0101, **kwargs) == 10000
+    # or 70s, more than a block's overhead
+    assert choose_block_size(next_seconds_per_index=0.02, **kwargs) == 3000
+
+
+def test_choose_block_size_absorbs_tail_when_cheaper():
+    kwargs = dict(
+        seconds_per_index=0.01,
+        target_seconds=100,
+        remaining_in_level=11000,
+        min_block_size=1,
+        max_block_size=1000000)
+    # absorbing the tail takes 10s past the target, while the next block
+    # takes 9000 * 0.0001 = 0.9s past its estimate
+    assert choose_block_size(next_seconds_per_index=0.0101, **kwargs) == 10000
+    assert choose_block_size(next_seconds_per_index=0.02, **kwargs) == 11000
+
+
+def test_choose_block_size_absorbs_tail_only_up_to_max():
+    assert choose_block_size(
+        seconds_per_index=0.01,
+        target_seconds=100,
+        remaining_in_level=10500,
+        min_block_size=1,
+        max_block_size=10000) == 10000
+    assert choose_block_size(
+        seconds_per_index=0.01,
+        target_seconds=100,
+        remaining_in_level=10500,
+        min_block_size=1,
+        max_block_size=20000) == 10500
+
+
+def test_choose_block_size_absorbs_small_tail():
+    assert choose_block_size(
+        seconds_per_index=0.01,
+        target_seconds=100,
+        remaining_in_level=11000,
+        min_block_size=1,
+        max_block_size=1000000) == 11000
+
+
+def test_generate_timed_search_blocks_default_size_stops_at_level():
+    # level 10 has 42 partitions
+    search = SuperabundantSearchStrategy().starting_from(
+        SuperabundantEnumerationIndex(level=10, index_in_level=0))
+    blocks = generate_timed_search_blocks(
+        search,
+        count=2,
+        cost_model=BlockCostModel(seconds_per_index={}),
+        target_seconds=8,
+        default_block_size=30,
+        min_block_size=1,
+        max_block_size=1000)
+
+    assert [(b.starting_search_index.level, b.ending_search_index.level)
+            for b in blocks] == [(10, 10), (10, 10)]
+    assert blocks[1].ending_search_index.index_in_level == 41
+
+
+def test_generate_timed_search_blocks_never_straddle_levels():
+    search = SuperabundantSearchStrategy().starting_from(
+        SuperabundantEnumerationIndex(level=10, index_in_level=0))
+    model = BlockCostModel(seconds_per_index={10: 1.0, 11: 1.0, 12: 1.0})
+    blocks = generate_timed_search_blocks(
+        search,
+        count=10,
+        cost_model=model,
+        target_seconds=8,
+        default_block_size=1000,
+        min_block_size=1,
+        max_block_size=1000)
+
+    for block in blocks:
+        assert (block.starting_search_index.level ==
+                block.ending_search_index.level)
+    for (block, next_block) in zip(blocks, blocks[1:]):
+        end = block.ending_search_index
+        start = next_block.starting_search_index
+        assert (start == SuperabundantEnumerationIndex(
+            level=end.level, index_in_level=end.index_in_level + 1)
+            or start == SuperabundantEnumerationIndex(
+                level=end.level + 1, index_in_level=0))
@@ -0,0 +1,170 @@
+from gmpy2 import mpz
+import numpy as np
+import pytest
+
+from riemann.columnar_store import ColumnarStoreWriter
+from riemann.columnar_store import level_runs
+from riemann.columnar_store import load_chunks
+from riemann.columnar_store import load_exponent_matrix
+from riemann.columnar_store import load_level
+from riemann.columnar_store import prime_exponents
+from riemann.columnar_store import rebuild
+from riemann.columnar_store import summarize
+from riemann.in_memory_database import InMemoryDivisorDb
+from riemann.superabundant import compute_riemann_divisor_sum
+from riemann.superabundant import partition_to_prime_factorization
+from riemann.superabundant import partitions_of_n
+from riemann.types import ExhaustiveSearchIndex
+from riemann.types import RiemannDivisorSum
+from riemann.types import SearchMetadata
+
+
+def divisor_sums_at_level(level):
+    return [
+        compute_riemann_divisor_sum(partition_to_prime_factorization(p))
+        for (_, p) in partitions_of_n(level)
+    ]
+
+
+def test_prime_exponents():
+    assert prime_exponents(mpz(2)**3 * 5 * 7**2) == ([3, 0, 1, 2], 1)
+    assert prime_exponents(1) == ([], 1)
+
+
+def test_prime_exponents_leaves_cofactor():
+    assert prime_exponents(mpz(7927) * 6) == ([1, 1], 7927)
+    assert prime_exponents(mpz(2)**300 * 3) == ([0, 1], 2**300)
+
+
+def test_round_trip_not_fully_factored(tmp_path):
+    divisor_sums = [
+        RiemannDivisorSum(n=n, divisor_sum=s, witness_value=1.5)
+        for (n, s) in [
+            (mpz(7927) * 6, 12 * 7928),
+            (mpz(7927)**2, 1 + 7927 + 7927**2),
+            (mpz(2)**300 * 3, (mpz(2)**301 - 1) * 4),
+            (mpz(12), 28),
+        ]]
+    writer = ColumnarStoreWriter(str(tmp_path), writer_id='test')
+    writer.append(divisor_sums)
+    writer.flush()
+
+    [chunk] = list(load_chunks(str(tmp_path)))
+    assert [chunk.divisor_sum(row) for row in range(4)] == divisor_sums
+    assert chunk.index['levels'] == [[3, 0, 1], [2, 1, 2], [301, 2, 3],
+                                     [3, 3, 4]]
+
+
+def test_rebuild_writes_a_new_store(tmp_path):
+    divisor_sums = divisor_sums_at_level(6)
+    directory = str(tmp_path / 'store')
+    rebuild(divisor_sums, directory, rows_per_chunk=5)
+    assert sum(len(chunk) for chunk in load_chunks(directory)) == 11
+
+    with pytest.raises(ValueError):
+        rebuild(divisor_sums, directory)
+    assert sum(len(chunk) for chunk in load_chunks(directory)) == 11
+
+
+def test_level_runs():
+    assert level_runs([3, 3, 4, 4, 4, 3]) == [(3, 0, 2), (4, 2, 5), (3, 5, 6)]
+
+
+def test_round_trip(tmp_path):
+    divisor_sums = divisor_sums_at_level(6) + divisor_sums_at_level(7)
+    writer = ColumnarStoreWriter(str(tmp_path), writer_id='test')
+    writer.append(divisor_sums)
+    writer.flush()
+
+    [chunk] = list(load_chunks(str(tmp_path)))
+    assert isinstance(chunk.log_n, np.memmap)
+    assert len(chunk) == len(divisor_sums)
+    for (row, expected) in enumerate(divisor_sums):
+        assert chunk.divisor_sum(row).approx_equal(expected)
+
+
+def test_chunks_split_by_rows_and_by_restart(tmp_path):
+    writer = ColumnarStoreWriter(
+        str(tmp_path), writer_id='test', rows_per_chunk=10)
+    writer.append(divisor_sums_at_level(6))
+    writer.append(divisor_sums_at_level(7))
+    writer.flush()
+    # a restarted writer continues numbering its chunks
+    writer = ColumnarStoreWriter(str(tmp_path), writer_id='test')
+    writer.append(divisor_sums_at_level(5))
+    writer.flush()
+
+    assert [len(chunk) for chunk in load_chunks(str(tmp_path))] == [11, 15, 7]
+
+
+def test_load_exponent_matrix(tmp_path):
+    divisor_sums = divisor_sums_at_level(6) + divisor_sums_at_level(7)
+    writer = ColumnarStoreWriter(
+        str(tmp_path), writer_id='test', rows_per_chunk=10)
+    writer.append(divisor_sums)
+    writer.flush()
+
+    matrix = load_exponent_matrix(str(tmp_path))
+    dense = matrix.to_dense()
+    for (row, divisor_sum) in enumerate(divisor_sums):
+        (exponents, _) = prime_exponents(divisor_sum.n)
+        assert list(dense[row, :len(exponents)]) == exponents
+        assert matrix.num_distinct_prime_factors()[row] == len(
+            [e for e in exponents if e])
+    assert list(matrix.num_prime_factors()) == [6] * 11 + [7] * 15
+
+    above = load_exponent_matrix(str(tmp_path), min_witness_value=1.5)
+    assert 0 < len(above) < len(matrix)
+    assert list(above.witness_value) == [
+        d.witness_value for d in divisor_sums if d.witness_value >= 1.5]
+    assert list(above.num_prime_factors()) == [
+        sum(prime_exponents(d.n)[0]) for d in divisor_sums
+        if d.witness_value >= 1.5]
+
+
+def test_load_level(tmp_path):
+    writer = ColumnarStoreWriter(str(tmp_path), writer_id='test')
+    writer.append(divisor_sums_at_level(6))
+    writer.append(divisor_sums_at_level(7))
+    writer.append(divisor_sums_at_level(6))
+    writer.flush()
+
+    (log_n, witness_value) = load_level(str(tmp_path), 6)
+    expected = [float(d.witness_value) for d in divisor_sums_at_level(6)]
+    assert list(witness_value) == pytest.approx(expected * 2)
+    assert len(load_level(str(tmp_path), 8)[0]) == 0
+
+
+def test_records_blocks(tmp_path):
+    block = SearchMetadata(
+        search_index_type='ExhaustiveSearchIndex',
+        starting_search_index=ExhaustiveSearchIndex(n=1),
+        ending_search_index=ExhaustiveSearchIndex(n=10))
+    writer = ColumnarStoreWriter(str(tmp_path), writer_id='test')
+    writer.append(divisor_sums_at_level(3), block)
+    writer.flush()
+
+    [chunk] = list(load_chunks(str(tmp_path)))
+    assert chunk.index['blocks'] == [['ExhaustiveSearchIndex', '1', '10', 0, 3]]
+
+
+def test_summarize_matches_database(tmp_path):
+    divisor_sums = divisor_sums_at_level(8) + divisor_sums_at_level(9)
+    db = InMemoryDivisorDb()
+    for d in divisor_sums:
+        db.store(d)
+    writer = ColumnarStoreWriter(
+        str(tmp_path), writer_id='test', rows_per_chunk=10)
+    writer.append(divisor_sums)
+    writer.flush()
+
+    expected = db.summarize()
+    actual = summarize(str(tmp_path))
+    assert actual.largest_computed_n.approx_equal(expected.largest_computed_n)
+    assert actual.largest_witness_value.approx_equal(
+        expected.largest_witness_value)
+
+
+def test_summarize_empty(tmp_path):
+    with pytest.raises(ValueError):
+        summarize(str(tmp_path))
@@ -0,0 +1,68 @@
+from gmpy2 import log
+from gmpy2 import mpz
+import io
+import numpy as np
+
+from riemann.cumulative_max import cumulative_max_changes
+from riemann.cumulative_max import windows
+from riemann.cumulative_max import witness_record_points
+from riemann.cumulative_max import write_points
+from riemann.in_memory_database import InMemoryDivisorDb
+from riemann.types import ExhaustiveSearchIndex
+from riemann.types import RiemannDivisorSum
+from riemann.types import SearchMetadata
+
+
+def naive_changes(log_n, witness_value, min_log_n, sample_every):
+    points = []
+    the_max = None
+    i = 0
+    for (x, w) in zip(log_n, witness_value):
+        if x <= min_log_n:
+            continue
+        if the_max is None or w > the_max:
+            the_max = w
+            points.append((x, w, the_max))
+        elif i % sample_every == 0:
+            points.append((x, w, the_max))
+        i += 1
+    return points
+
+
+def test_cumulative_max_changes_matches_naive():
+    rng = np.random.default_rng(2)
+    log_n = np.sort(rng.uniform(0, 20, 5000))
+    witness_value = rng.uniform(1, 2, 5000) + log_n / 100
+    points = list(cumulative_max_changes(
+        windows(log_n, witness_value, window_rows=333),
+        min_log_n=5, sample_every=100))
+
+    actual = [
+        point for columns in points for point in zip(*columns)
+    ]
+    assert actual == naive_changes(log_n, witness_value, 5, 100)
+
+
+def test_witness_record_points():
+    db = InMemoryDivisorDb()
+    db.insert_search_blocks([
+        SearchMetadata(
+            search_index_type='ExhaustiveSearchIndex',
+            starting_search_index=ExhaustiveSearchIndex(n=1),
+            ending_search_index=ExhaustiveSearchIndex(n=2))])
+    block = db.claim_next_search_block(
+        search_index_type='ExhaustiveSearchIndex')
+    db.finish_search_block(block, [
+        RiemannDivisorSum(n=mpz(10), divisor_sum=1, witness_value=2),
+        RiemannDivisorSum(n=mpz(12), divisor_sum=1, witness_value=1.9),
+        RiemannDivisorSum(n=mpz(14), divisor_sum=1, witness_value=3),
+    ])
+
+    (log_n, witness_value, maxes) = witness_record_points(db)
+    assert list(log_n) == [float(log(10)), float(log(14))]
+    assert list(maxes) == [2, 3]
+
+    output = io.StringIO()
+    assert write_points([(log_n, witness_value, maxes)], output) == 2
+    assert output.getvalue().splitlines()[1] == (
+        '2.3025850930,2.0000000000,2.0000000000')
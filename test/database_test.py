@@ -1,18 +1,32 @@
 from dataclasses import replace
 from datetime import datetime
+from datetime import timedelta
 from gmpy2 import mpz
+from multiprocessing import Pool
+import os
 import pytest
+import shutil
+import tempfile
 import testing.postgresql
+from threading import Thread
 
 from riemann.database import DivisorDb
 from riemann.in_memory_database import InMemoryDivisorDb
+from riemann.migrate_postgres_schema import migrate
 from riemann.postgres_database import PostgresDivisorDb
+from riemann.search_strategy import SuperabundantSearchStrategy
+from riemann.sqlite_database import SqliteDivisorDb
+from riemann.sqlite_database import deserialize_mpz
+from riemann.sqlite_database import serialize_mpz
+from riemann.storage_policy import RecordDeltaPolicy
+from riemann.storage_policy import TopKPerLevelPolicy
 from riemann.types import ExhaustiveSearchIndex
 from riemann.types import RiemannDivisorSum
 from riemann.types import SearchBlockState
 from riemann.types import SearchMetadata
 from riemann.types import SummaryStats
 from riemann.types import SuperabundantEnumerationIndex
+from riemann.types import hash_divisor_sums
 
 
 def noop_teardown():
@@ -33,6 +47,14 @@ def createPostgresDb():
     return db
 
 
+def createSqliteDb():
+    tmp_dir = tempfile.mkdtemp()
+    db = SqliteDivisorDb(os.path.join(tmp_dir, 'divisor.sqlite'))
+    db.initialize_schema()
+    db.teardown = lambda: shutil.rmtree(tmp_dir)
+    return db
+
+
 @pytest.fixture
 def db(request):
     db = request.param()
@@ -43,6 +65,7 @@ def db(request):
 DATABASES = [
     createInMemoryDb,
     createPostgresDb,
+    createSqliteDb,
 ]
 
 
@@ -83,6 +106,43 @@ class TestDatabase:
             db.claim_next_search_block(
                 search_index_type='ExhaustiveSearchIndex')
 
+    def test_next_search_index_initially_missing(self, db):
+        assert db.load_next_search_index('ExhaustiveSearchIndex') is None
+
+    def test_insert_search_blocks_stores_next_search_index(self, db):
+        self.populate_search_blocks(db)
+        assert db.load_next_search_index('ExhaustiveSearchIndex') is None
+
+        db.insert_search_blocks([
+            SearchMetadata(
+                search_index_type='SuperabundantEnumerationIndex',
+                starting_search_index=SuperabundantEnumerationIndex(
+                    level=3, index_in_level=0),
+                ending_search_index=SuperabundantEnumerationIndex(
+                    level=3, index_in_level=2))
+        ], next_search_index=SuperabundantEnumerationIndex(
+            level=4, index_in_level=0))
+        db.insert_search_blocks([], next_search_index=SuperabundantEnumerationIndex(
+            level=4, index_in_level=3))
+
+        assert db.load_next_search_index(
+            'SuperabundantEnumerationIndex') == SuperabundantEnumerationIndex(
+                level=4, index_in_level=3)
+        assert db.load_next_search_index('ExhaustiveSearchIndex') is None
+
+    def test_count_eligible_search_blocks(self, db):
+        self.populate_search_blocks(db)
+        assert db.count_eligible_search_blocks('ExhaustiveSearchIndex') == 5
+        assert db.count_eligible_search_blocks(
+            'SuperabundantEnumerationIndex') == 0
+
+        block = db.claim_next_search_block(
+            search_index_type='ExhaustiveSearchIndex')
+        assert db.count_eligible_search_blocks('ExhaustiveSearchIndex') == 4
+
+        db.mark_block_as_failed(block)
+        assert db.count_eligible_search_blocks('ExhaustiveSearchIndex') == 5
+
     def test_claim_search_block_timestamp_updated(self, db):
         metadata = SearchMetadata(
             search_index_type='ExhaustiveSearchIndex',
@@ -119,6 +179,47 @@ class TestDatabase:
             search_index_type='ExhaustiveSearchIndex')
         assert block.starting_search_index != next_block.starting_search_index
 
+    def test_claim_search_blocks_in_batch(self, db):
+        self.populate_search_blocks(db)
+        blocks = db.claim_next_search_blocks(
+            search_index_type='ExhaustiveSearchIndex', count=3)
+        assert len(blocks) == 3
+        assert len(set(block.key() for block in blocks)) == 3
+        assert all(b.state == SearchBlockState.IN_PROGRESS for b in blocks)
+
+        # only two blocks remain
+        blocks = db.claim_next_search_blocks(
+            search_index_type='ExhaustiveSearchIndex', count=3)
+        assert len(blocks) == 2
+
+        with pytest.raises(ValueError):
+            db.claim_next_search_blocks(
+                search_index_type='ExhaustiveSearchIndex', count=3)
+
+    def test_finish_search_blocks_in_batch(self, db):
+        self.populate_search_blocks(db)
+        blocks = db.claim_next_search_blocks(
+            search_index_type='ExhaustiveSearchIndex', count=2)
+
+        db.finish_search_blocks([
+            (blocks[0], [
+                RiemannDivisorSum(n=1, divisor_sum=1, witness_value=1),
+                RiemannDivisorSum(n=2, divisor_sum=2, witness_value=2),
+            ]),
+            (blocks[1], [
+                RiemannDivisorSum(n=3, divisor_sum=3, witness_value=3),
+            ]),
+        ])
+
+        stored = sorted(d.n for d in db.load())
+        assert stored == [2, 3]
+        finished = [
+            x for x in db.load_metadata()
+            if x.state == SearchBlockState.FINISHED
+        ]
+        assert len(finished) == 2
+        assert all(x.block_hash is not None for x in finished)
+
     def test_finish_search_block_timestamp_updated(self, db):
         self.populate_search_blocks(db)
         block = db.claim_next_search_block(
@@ -159,6 +260,49 @@ class TestDatabase:
         assert len(stored) == 1
         assert stored[0].n == 2
 
+    def test_finish_search_block_twice_is_idempotent(self, db):
+        self.populate_search_blocks(db)
+        block = db.claim_next_search_block(
+            search_index_type='ExhaustiveSearchIndex')
+        records = [RiemannDivisorSum(n=2, divisor_sum=2, witness_value=2)]
+        db.finish_search_block(block, records)
+        db.finish_search_block(block, records)
+        assert len(list(db.load())) == 1
+
+    def test_finish_search_block_twice_with_different_hash_fails(self, db):
+        self.populate_search_blocks(db)
+        block = db.claim_next_search_block(
+            search_index_type='ExhaustiveSearchIndex')
+        db.finish_search_block(
+            block, [RiemannDivisorSum(n=2, divisor_sum=2, witness_value=2)])
+
+        with pytest.raises(ValueError):
+            db.finish_search_block(
+                block, [RiemannDivisorSum(n=2, divisor_sum=3, witness_value=3)])
+        assert len(list(db.load())) == 1
+
+    def test_finish_unclaimed_search_block_fails(self, db):
+        self.populate_search_blocks(db)
+        block = db.load_metadata()[0]
+        with pytest.raises(ValueError):
+            db.finish_search_block(
+                block, [RiemannDivisorSum(n=2, divisor_sum=2, witness_value=2)])
+        assert len(list(db.load())) == 0
+
+    def test_finish_search_block_precomputed_hash(self, db):
+        self.populate_search_blocks(db)
+        block = db.claim_next_search_block(
+            search_index_type='ExhaustiveSearchIndex')
+        block = replace(block, block_hash='a' * 64)
+        db.finish_search_block(
+            block, [RiemannDivisorSum(n=2, divisor_sum=2, witness_value=2)])
+
+        metadata = [
+            x for x in db.load_metadata()
+            if x.state == SearchBlockState.FINISHED
+        ][0]
+        assert metadata.block_hash == 'a' * 64
+
     def test_finish_search_block_hash_updated(self, db):
         self.populate_search_blocks(db)
         block = db.claim_next_search_block(
@@ -191,6 +335,22 @@ class TestDatabase:
         assert len(stored) == 1
         assert stored[0].n == 2
 
+    def test_load_finished_search_blocks(self, db):
+        self.populate_search_blocks(db)
+        for i in range(3):
+            block = db.claim_next_search_block(
+                search_index_type='ExhaustiveSearchIndex')
+            db.finish_search_block(block, [])
+            last_finished = block
+
+        finished = db.load_finished_search_blocks(
+            search_index_type='ExhaustiveSearchIndex', count=2)
+        assert len(finished) == 2
+        assert finished[0].key() == last_finished.key()
+        assert all(x.state == SearchBlockState.FINISHED for x in finished)
+        assert db.load_finished_search_blocks(
+            search_index_type='SuperabundantEnumerationIndex', count=2) == []
+
     def test_mark_in_progress_as_failed(self, db):
         self.populate_search_blocks(db)
         block = db.claim_next_search_block(
@@ -203,6 +363,363 @@ class TestDatabase:
         ][0]
         assert metadata.state == SearchBlockState.FAILED
 
+    def test_failed_block_can_be_claimed_again(self, db):
+        self.populate_search_blocks(db)
+        block = db.claim_next_search_block(
+            search_index_type='ExhaustiveSearchIndex')
+        db.mark_block_as_failed(block)
+        assert db.count_eligible_search_blocks('ExhaustiveSearchIndex') == 5
+
+        claimed = [
+            db.claim_next_search_block(
+                search_index_type='ExhaustiveSearchIndex')
+            for i in range(5)
+        ]
+        assert block.key() in [x.key() for x in claimed]
+
+    def test_claim_respects_search_index_type(self, db):
+        self.populate_search_blocks(db)
+        with pytest.raises(ValueError):
+            db.claim_next_search_block(
+                search_index_type='SuperabundantEnumerationIndex')
+
+    def test_mark_finished_as_failed_does_nothing(self, db):
+        self.populate_search_blocks(db)
+        block = db.claim_next_search_block(
+            search_index_type='ExhaustiveSearchIndex')
+        db.finish_search_block(block, [])
+
+        db.mark_block_as_failed(block)
+        metadata = [
+            x for x in db.load_metadata()
+            if x.starting_search_index == block.starting_search_index
+        ][0]
+        assert metadata.state == SearchBlockState.FINISHED
+
+    def test_mark_not_started_as_failed_does_nothing(self, db):
+        self.populate_search_blocks(db)
+        block = db.load_metadata()[0]
+
+        db.mark_block_as_failed(block)
+        [stored] = [b for b in db.load_metadata() if b.key() == block.key()]
+        assert stored.state == SearchBlockState.NOT_STARTED
+        assert db.count_eligible_search_blocks('ExhaustiveSearchIndex') == 5
+
+    def test_claim_speculative_search_block(self, db):
+        self.populate_search_blocks(db)
+        block = db.claim_next_search_block(
+            search_index_type='ExhaustiveSearchIndex')
+
+        with pytest.raises(ValueError):
+            db.claim_speculative_search_block(
+                search_index_type='ExhaustiveSearchIndex',
+                running_for=timedelta(hours=1))
+
+        copy = db.claim_speculative_search_block(
+            search_index_type='ExhaustiveSearchIndex',
+            running_for=timedelta(seconds=0))
+        assert copy.key() == block.key()
+        assert copy.state == SearchBlockState.IN_PROGRESS
+
+        # only one copy is handed out by default
+        with pytest.raises(ValueError):
+            db.claim_speculative_search_block(
+                search_index_type='ExhaustiveSearchIndex',
+                running_for=timedelta(seconds=0))
+
+    def test_first_speculative_finish_wins(self, db):
+        self.populate_search_blocks(db)
+        block = db.claim_next_search_block(
+            search_index_type='ExhaustiveSearchIndex')
+        copy = db.claim_speculative_search_block(
+            search_index_type='ExhaustiveSearchIndex',
+            running_for=timedelta(seconds=0))
+        records = [RiemannDivisorSum(n=2, divisor_sum=2, witness_value=2)]
+
+        db.finish_search_block(copy, records)
+        db.finish_search_block(block, records)
+        assert len(list(db.load())) == 1
+
+    def test_stale_claim_is_fenced(self, db):
+        self.populate_search_blocks(db)
+        stale = db.claim_next_search_block(
+            search_index_type='ExhaustiveSearchIndex')
+        db.mark_block_as_failed(stale)
+        fresh = db.claim_next_search_block(
+            search_index_type='ExhaustiveSearchIndex')
+        assert fresh.key() == stale.key()
+        assert fresh.claim_token > stale.claim_token
+
+        records = [RiemannDivisorSum(n=mpz(2), divisor_sum=3, witness_value=2)]
+        with pytest.raises(ValueError):
+            db.finish_search_block(stale, records)
+        db.mark_block_as_failed(stale)
+        assert len(list(db.load())) == 0
+
+        db.finish_search_block(fresh, records)
+        assert len(list(db.load())) == 1
+
+    def test_renew_claim(self, db):
+        self.populate_search_blocks(db)
+        stale = db.claim_next_search_block(
+            search_index_type='ExhaustiveSearchIndex')
+        renewed = db.renew_claim(stale)
+        assert renewed.start_time >= stale.start_time
+        assert renewed.claim_token == stale.claim_token
+        [stored] = [b for b in db.load_metadata() if b.key() == stale.key()]
+        assert stored.start_time == renewed.start_time
+
+        db.mark_block_as_failed(stale)
+        with pytest.raises(ValueError):
+            db.renew_claim(stale)
+        db.claim_next_search_block(search_index_type='ExhaustiveSearchIndex')
+        with pytest.raises(ValueError):
+            db.renew_claim(stale)
+
+    def test_divisor_sums_are_stored_once(self, db):
+        self.populate_search_blocks(db)
+        blocks = [
+            db.claim_next_search_block(
+                search_index_type='ExhaustiveSearchIndex')
+            for i in range(2)
+        ]
+        records = [RiemannDivisorSum(n=mpz(2), divisor_sum=3, witness_value=2)]
+        db.finish_search_block(blocks[0], records)
+        db.finish_search_block(blocks[1], records)
+        assert len(list(db.load())) == 1
+
+    def test_load_log_n_and_witness_values_by_id(self, db):
+        self.populate_search_blocks(db)
+        assert db.max_divisor_sum_id() == 0
+        blocks = [
+            db.claim_next_search_block(
+                search_index_type='ExhaustiveSearchIndex')
+            for i in range(2)
+        ]
+        db.finish_search_block(blocks[0], [
+            RiemannDivisorSum(n=mpz(10), divisor_sum=1, witness_value=2),
+            RiemannDivisorSum(n=mpz(12), divisor_sum=1, witness_value=1.9),
+        ])
+        first_id = db.max_divisor_sum_id()
+        db.finish_search_block(blocks[1], [
+            RiemannDivisorSum(n=mpz(14), divisor_sum=1, witness_value=3),
+        ])
+
+        assert db.load_log_n_and_witness_values(
+            first_id, db.max_divisor_sum_id()) == [(pytest.approx(2.639057), 3)]
+        assert [
+            witness_value for (_, witness_value) in
+            db.load_log_n_and_witness_values(0, db.max_divisor_sum_id())
+        ] == [2, 1.9, 3]
+
+    def test_witness_records(self, db):
+        self.populate_search_blocks(db)
+        blocks = [
+            db.claim_next_search_block(
+                search_index_type='ExhaustiveSearchIndex')
+            for i in range(3)
+        ]
+        assert db.load_witness_records() == []
+
+        db.finish_search_block(blocks[0], [
+            RiemannDivisorSum(n=mpz(10), divisor_sum=1, witness_value=2),
+            RiemannDivisorSum(n=mpz(12), divisor_sum=1, witness_value=1.9),
+            RiemannDivisorSum(n=mpz(14), divisor_sum=1, witness_value=3),
+        ])
+        db.finish_search_block(blocks[1], [
+            RiemannDivisorSum(n=mpz(2)**70, divisor_sum=1, witness_value=2.5),
+            RiemannDivisorSum(n=mpz(2)**71, divisor_sum=1, witness_value=4),
+        ])
+        # finished out of order, superseding the record at n=14
+        db.finish_search_block(blocks[2], [
+            RiemannDivisorSum(n=mpz(11), divisor_sum=1, witness_value=3.5),
+        ])
+
+        assert [(r.n, r.witness_value) for r in db.load_witness_records()] == [
+            (10, 2), (11, 3.5), (mpz(2)**71, 4)]
+        summary = db.summarize()
+        assert summary.largest_computed_n.n == mpz(2)**71
+        assert summary.largest_witness_value.witness_value == 4
+
+    def test_level_stats(self, db):
+        db.insert_search_blocks([
+            SearchMetadata(
+                starting_search_index=SuperabundantEnumerationIndex(
+                    level=5, index_in_level=0),
+                ending_search_index=SuperabundantEnumerationIndex(
+                    level=5, index_in_level=3)),
+            SearchMetadata(
+                starting_search_index=SuperabundantEnumerationIndex(
+                    level=5, index_in_level=4),
+                ending_search_index=SuperabundantEnumerationIndex(
+                    level=6, index_in_level=1)),
+        ])
+        assert db.load_level_stats('SuperabundantEnumerationIndex') == []
+        for i in range(2):
+            block = db.claim_next_search_block(
+                search_index_type='SuperabundantEnumerationIndex')
+            db.finish_search_block(
+                block, SuperabundantSearchStrategy().process_block(block))
+
+        stats = db.load_level_stats('SuperabundantEnumerationIndex')
+        assert [(s.level, s.count) for s in stats] == [(5, 7), (6, 2)]
+        assert sum(stats[0].witness_histogram) == 7
+        assert sum(s.count_pruned for s in stats) == 9 - len(list(db.load()))
+        assert db.load_level_stats('ExhaustiveSearchIndex') == []
+
+    def populate_divisor_sums(self, db):
+        self.populate_search_blocks(db)
+        block = db.claim_next_search_block(
+            search_index_type='ExhaustiveSearchIndex')
+        records = [
+            RiemannDivisorSum(n=mpz(2), divisor_sum=3, witness_value=1.8),
+            RiemannDivisorSum(n=mpz(4), divisor_sum=7, witness_value=1.9),
+            RiemannDivisorSum(n=mpz(6), divisor_sum=12, witness_value=1.85),
+            RiemannDivisorSum(n=mpz(2)**80, divisor_sum=1, witness_value=1.78),
+        ]
+        db.finish_search_block(block, records)
+        return records
+
+    def test_load_top_witness_values(self, db):
+        records = self.populate_divisor_sums(db)
+        assert db.load_top_witness_values(2) == [records[1], records[2]]
+        assert db.load_top_witness_values(10, level=1) == [records[0]]
+        assert db.load_top_witness_values(10, level=80) == [records[3]]
+        assert db.load_top_witness_values(10, level=3) == []
+
+    def test_load_log_n_range(self, db):
+        records = self.populate_divisor_sums(db)
+        assert db.load_log_n_range(1, 2) == [records[1], records[2]]
+        assert db.load_log_n_range(0, 1) == [records[0]]
+        assert db.load_log_n_range(2, 50) == []
+
+    def test_load_above_witness_value(self, db):
+        records = self.populate_divisor_sums(db)
+        assert db.load_above_witness_value(1.85) == [records[1], records[2]]
+        assert db.load_above_witness_value(2) == []
+
+    def test_record_delta_storage_policy(self, db):
+        db.storage_policy = RecordDeltaPolicy(0.1)
+        self.populate_search_blocks(db)
+        blocks = [
+            db.claim_next_search_block(
+                search_index_type='ExhaustiveSearchIndex')
+            for i in range(2)
+        ]
+        db.finish_search_block(blocks[0], [
+            RiemannDivisorSum(n=mpz(2), divisor_sum=1, witness_value=1.5),
+            RiemannDivisorSum(n=mpz(3), divisor_sum=1, witness_value=1.95),
+            RiemannDivisorSum(n=mpz(4), divisor_sum=1, witness_value=2),
+        ])
+        # the record from the first block applies to the second
+        db.finish_search_block(blocks[1], [
+            RiemannDivisorSum(n=mpz(5), divisor_sum=1, witness_value=1.8),
+            RiemannDivisorSum(n=mpz(6), divisor_sum=1, witness_value=1.92),
+        ])
+
+        assert sorted(d.n for d in db.load()) == [3, 4, 6]
+        finished = db.load_finished_search_blocks('ExhaustiveSearchIndex', 2)
+        assert [b.storage_policy for b in finished] == [
+            'record_delta:0.1', 'record_delta:0.1']
+
+    def test_top_k_per_level_storage_policy(self, db):
+        db.storage_policy = TopKPerLevelPolicy(1)
+        self.populate_search_blocks(db)
+        blocks = [
+            db.claim_next_search_block(
+                search_index_type='ExhaustiveSearchIndex')
+            for i in range(2)
+        ]
+        # 2, 3 and 5 are at level 1, and 4 and 6 at level 2
+        db.finish_search_block(blocks[0], [
+            RiemannDivisorSum(n=mpz(2), divisor_sum=1, witness_value=1.5),
+            RiemannDivisorSum(n=mpz(3), divisor_sum=1, witness_value=1.9),
+            RiemannDivisorSum(n=mpz(4), divisor_sum=1, witness_value=1.6),
+        ])
+        # the top witness values stored at each level apply to the second
+        db.finish_search_block(blocks[1], [
+            RiemannDivisorSum(n=mpz(5), divisor_sum=1, witness_value=1.8),
+            RiemannDivisorSum(n=mpz(6), divisor_sum=1, witness_value=1.7),
+        ])
+
+        assert sorted(d.n for d in db.load()) == [3, 4, 6]
+
+    def test_default_storage_policy_version(self, db):
+        self.populate_search_blocks(db)
+        block = db.claim_next_search_block(
+            search_index_type='ExhaustiveSearchIndex')
+        assert block.storage_policy is None
+        db.finish_search_block(block, [])
+
+        [finished] = db.load_finished_search_blocks('ExhaustiveSearchIndex', 1)
+        assert finished.storage_policy == f"fixed:{db.threshold_witness_value}"
+
+    def finish_blocks_and_archive_some(self, db, finished_before):
+        db.insert_search_blocks([
+            SearchMetadata(
+                search_index_type='ExhaustiveSearchIndex',
+                starting_search_index=ExhaustiveSearchIndex(n=i),
+                ending_search_index=ExhaustiveSearchIndex(n=i+1))
+            for i in range(1, 10, 2)
+        ], next_search_index=ExhaustiveSearchIndex(n=11))
+        blocks = [
+            db.claim_next_search_block(
+                search_index_type='ExhaustiveSearchIndex')
+            for i in range(4)
+        ]
+        # leave a gap, so that two ranges are archived
+        for block in [blocks[0], blocks[2], blocks[3]]:
+            db.finish_search_block(block, [])
+        return (blocks, db.compact_finished_search_blocks(
+            'ExhaustiveSearchIndex', finished_before))
+
+    def test_compact_finished_search_blocks(self, db):
+        (blocks, count) = self.finish_blocks_and_archive_some(
+            db, datetime.now() + timedelta(seconds=1))
+        assert count == 3
+        assert [
+            (b.starting_search_index.n, b.state)
+            for b in sorted(
+                db.load_metadata(), key=lambda b: b.starting_search_index.n)
+        ] == [
+            (3, SearchBlockState.IN_PROGRESS),
+            (9, SearchBlockState.NOT_STARTED),
+        ]
+        assert db.load_finished_search_blocks('ExhaustiveSearchIndex', 5) == []
+
+        ranges = db.load_archived_search_ranges('ExhaustiveSearchIndex')
+        assert [
+            (r.starting_search_index.n, r.ending_search_index.n, len(r))
+            for r in ranges
+        ] == [(1, 2, 1), (5, 8, 2)]
+        assert ranges[0].block_hashes == (hash_divisor_sums([]),)
+        assert ranges[0].block_storage_policies == (
+            f"fixed:{db.threshold_witness_value}",)
+
+        # finishing the gap merges the ranges
+        db.finish_search_block(blocks[1], [])
+        assert db.compact_finished_search_blocks(
+            'ExhaustiveSearchIndex', datetime.now() + timedelta(seconds=1)) == 1
+        [merged] = db.load_archived_search_ranges('ExhaustiveSearchIndex')
+        assert (merged.starting_search_index.n, merged.ending_search_index.n,
+                len(merged)) == (1, 8, 4)
+
+    def test_compact_keeps_recent_blocks(self, db):
+        (_, count) = self.finish_blocks_and_archive_some(
+            db, datetime.now() - timedelta(hours=1))
+        assert count == 0
+        assert len(db.load_metadata()) == 5
+        assert db.load_archived_search_ranges('ExhaustiveSearchIndex') == []
+
+    def test_compact_requires_next_search_index(self, db):
+        self.populate_search_blocks(db)
+        block = db.claim_next_search_block(
+            search_index_type='ExhaustiveSearchIndex')
+        db.finish_search_block(block, [])
+        assert db.compact_finished_search_blocks(
+            'ExhaustiveSearchIndex', datetime.now() + timedelta(seconds=1)) == 0
+        assert len(db.load_metadata()) == 5
+
     def test_summarize_empty(self, db):
         with pytest.raises(ValueError):
             db.summarize()
@@ -220,3 +737,235 @@ class TestDatabase:
                                 largest_witness_value=records[1])
 
         assert expected == db.summarize()
+
+
+def test_in_memory_snapshot_and_restore(tmp_path):
+    db = InMemoryDivisorDb()
+    db.insert_search_blocks([
+        SearchMetadata(
+            search_index_type='ExhaustiveSearchIndex',
+            starting_search_index=ExhaustiveSearchIndex(n=i),
+            ending_search_index=ExhaustiveSearchIndex(n=i+1))
+        for i in range(1, 10, 2)])
+    block = db.claim_next_search_block(
+        search_index_type='ExhaustiveSearchIndex')
+    db.finish_search_block(block, [
+        RiemannDivisorSum(n=mpz(2), divisor_sum=mpz(3), witness_value=2)])
+
+    path = str(tmp_path / 'snapshot.pickle')
+    db.snapshot(path)
+    restored = InMemoryDivisorDb.restore(path)
+
+    assert restored.load_metadata() == db.load_metadata()
+    assert restored.summarize() == db.summarize()
+    assert restored.insertion_order == db.insertion_order
+    assert restored.count_eligible_search_blocks('ExhaustiveSearchIndex') == 4
+    claimed = restored.claim_next_search_block(
+        search_index_type='ExhaustiveSearchIndex')
+    assert claimed.key() != block.key()
+
+
+def test_sqlite_serialized_mpz_sorts_numerically():
+    values = [mpz(0), mpz(1), mpz(255), mpz(256), mpz(10)**50, mpz(2)**64 - 1]
+    serialized = [serialize_mpz(x) for x in values]
+    assert [deserialize_mpz(x) for x in serialized] == values
+    assert sorted(serialized) == [serialize_mpz(x) for x in sorted(values)]
+
+
+def claim_all_blocks(path):
+    db = SqliteDivisorDb(path)
+    claimed = []
+    while True:
+        try:
+            claimed.append(db.claim_next_search_block(
+                search_index_type='ExhaustiveSearchIndex').key())
+        except ValueError:
+            return claimed
+
+
+def test_postgres_partitioned_divisor_sums():
+    tmp_postgres = testing.postgresql.Postgresql()
+    try:
+        db = PostgresDivisorDb(data_source_dict=tmp_postgres.dsn())
+        db.initialize_schema(partition_by='log_n', partition_width=20)
+        db.insert_search_blocks([
+            SearchMetadata(
+                search_index_type='ExhaustiveSearchIndex',
+                starting_search_index=ExhaustiveSearchIndex(n=i),
+                ending_search_index=ExhaustiveSearchIndex(n=i+1))
+            for i in range(1, 5, 2)])
+        blocks = [
+            db.claim_next_search_block(
+                search_index_type='ExhaustiveSearchIndex')
+            for i in range(2)
+        ]
+        records = [
+            RiemannDivisorSum(n=mpz(10), divisor_sum=1, witness_value=2),
+            RiemannDivisorSum(n=mpz(2)**70, divisor_sum=1, witness_value=3),
+        ]
+        db.finish_search_block(blocks[0], records)
+        # stored once, even across partitions
+        db.finish_search_block(blocks[1], records)
+        assert len(list(db.load())) == 2
+
+        names = [name for (name, _) in db.load_divisor_sum_partitions()]
+        assert names == [
+            'riemanndivisorsums_log_n_000000',
+            'riemanndivisorsums_log_n_000040',
+        ]
+        db.detach_divisor_sum_partition(names[1])
+        assert [d.n for d in db.load()] == [10]
+    finally:
+        tmp_postgres.stop()
+
+
+def test_postgres_migrate_schema():
+    tmp_postgres = testing.postgresql.Postgresql()
+    try:
+        db = PostgresDivisorDb(data_source_dict=tmp_postgres.dsn())
+        cursor = db.connection.cursor()
+        cursor.execute('''
+        CREATE EXTENSION IF NOT EXISTS pgmp;
+        CREATE TABLE RiemannDivisorSums (
+            n mpz,
+            divisor_sum mpz,
+            witness_value double precision
+        );
+        INSERT INTO RiemannDivisorSums VALUES
+            (4, 7, 1.0), (4, 7, 1.0), (6, 12, 1.5), (8, 15, 1.2);
+        ''')
+        db.connection.commit()
+
+        with pytest.raises(ValueError):
+            db.initialize_schema()
+
+        migrate(db)
+        db.initialize_schema()
+        assert sorted(d.n for d in db.load()) == [4, 6, 8]
+        assert [d.n for d in db.load_witness_records()] == [4, 6]
+        assert db.summarize().largest_computed_n.n == 8
+        assert db.max_divisor_sum_id() >= 3
+    finally:
+        tmp_postgres.stop()
+
+
+def test_postgres_concurrent_partition_creation():
+    tmp_postgres = testing.postgresql.Postgresql()
+    try:
+        db = PostgresDivisorDb(data_source_dict=tmp_postgres.dsn())
+        db.initialize_schema(partition_by='log_n', partition_width=20)
+        errors = []
+
+        def create():
+            try:
+                PostgresDivisorDb(
+                    data_source_dict=tmp_postgres.dsn()).create_partitions(
+                        [5.0, 25.0, 45.0])
+            except Exception as e:
+                errors.append(e)
+
+        threads = [Thread(target=create) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert errors == []
+        assert [name for (name, _) in db.load_divisor_sum_partitions()] == [
+            'riemanndivisorsums_log_n_000000',
+            'riemanndivisorsums_log_n_000020',
+            'riemanndivisorsums_log_n_000040',
+        ]
+    finally:
+        tmp_postgres.stop()
+
+
+def test_postgres_max_divisor_sum_id_waits_for_smaller_ids():
+    tmp_postgres = testing.postgresql.Postgresql()
+    try:
+        db = PostgresDivisorDb(data_source_dict=tmp_postgres.dsn())
+        db.initialize_schema()
+        # a transaction takes an id, then another stores a larger one
+        slow = PostgresDivisorDb(data_source_dict=tmp_postgres.dsn())
+        cursor = slow.connection.cursor()
+        cursor.execute(
+            "UPDATE SearchMetadata SET state = 'FINISHED' WHERE false;")
+        cursor.execute('''
+            INSERT INTO RiemannDivisorSums(n, divisor_sum, witness_value)
+            VALUES (10::mpz, 18::mpz, 1.5);
+        ''')
+        db.insert_search_blocks([
+            SearchMetadata(
+                search_index_type='ExhaustiveSearchIndex',
+                starting_search_index=ExhaustiveSearchIndex(n=12),
+                ending_search_index=ExhaustiveSearchIndex(n=13))])
+        db.finish_search_block(
+            db.claim_next_search_block(
+                search_index_type='ExhaustiveSearchIndex'),
+            [RiemannDivisorSum(n=mpz(12), divisor_sum=28, witness_value=2)])
+
+        max_ids = []
+        waiter = Thread(target=lambda: max_ids.append(
+            PostgresDivisorDb(
+                data_source_dict=tmp_postgres.dsn()).max_divisor_sum_id()))
+        waiter.start()
+        waiter.join(timeout=1)
+        assert waiter.is_alive()
+
+        slow.connection.commit()
+        waiter.join()
+        assert max_ids == [2]
+        assert [
+            witness_value for (_, witness_value) in
+            db.load_log_n_and_witness_values(0, max_ids[0])
+        ] == [1.5, 2]
+    finally:
+        tmp_postgres.stop()
+
+
+def test_sqlite_concurrent_claims_no_duplicates(tmp_path):
+    path = str(tmp_path / 'divisor.sqlite')
+    db = SqliteDivisorDb(path)
+    db.initialize_schema()
+    db.insert_search_blocks([
+        SearchMetadata(
+            search_index_type='ExhaustiveSearchIndex',
+            starting_search_index=ExhaustiveSearchIndex(n=i),
+            ending_search_index=ExhaustiveSearchIndex(n=i))
+        for i in range(1, 201)])
+
+    with Pool(4) as pool:
+        claimed = [
+            key for keys in pool.map(claim_all_blocks, [path] * 4)
+            for key in keys
+        ]
+    assert len(claimed) == 200
+    assert len(set(claimed)) == 200
+
+
+def test_sqlite_failed_write_rolls_back_and_releases_lock(tmp_path):
+    path = str(tmp_path / 'divisor.sqlite')
+    db = SqliteDivisorDb(path, timeout_seconds=1)
+    db.initialize_schema()
+    db.insert_search_blocks([
+        SearchMetadata(
+            search_index_type='ExhaustiveSearchIndex',
+            starting_search_index=ExhaustiveSearchIndex(n=i),
+            ending_search_index=ExhaustiveSearchIndex(n=i))
+        for i in range(1, 3)])
+    block = db.claim_next_search_block('ExhaustiveSearchIndex')
+
+    def fail(cursor, finished):
+        raise RuntimeError('Failing for a test!')
+
+    db.update_level_stats = fail
+    with pytest.raises(RuntimeError):
+        db.finish_search_block(block, [])
+    assert not db.connection.in_transaction
+
+    # the block's finish was rolled back, and both connections can write
+    other = SqliteDivisorDb(path, timeout_seconds=1)
+    assert other.claim_next_search_block('ExhaustiveSearchIndex')
+    db.mark_block_as_failed(block)
+    assert [m.state for m in db.load_metadata()] == [
+        SearchBlockState.FAILED, SearchBlockState.IN_PROGRESS]
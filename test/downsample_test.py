@@ -0,0 +1,74 @@
+import numpy as np
+
+from riemann.downsample import column_limits
+from riemann.downsample import downsample
+from riemann.downsample import histogram2d
+from riemann.downsample import level_histograms
+from riemann.downsample import lttb
+from riemann.downsample import min_max_bins
+from riemann.types import LevelStats
+
+
+def chunks_of(log_n, witness_value, rows):
+    return [(log_n[i:i+rows], witness_value[i:i+rows])
+            for i in range(0, len(log_n), rows)]
+
+
+def test_min_max_bins():
+    log_n = np.array([0.0, 0.5, 1.5, 2.0, 3.9, 4.0])
+    witness_value = np.array([1.0, 2.0, 3.0, 0.5, 1.5, 2.5])
+    (edges, mins, maxes, counts) = min_max_bins(
+        chunks_of(log_n, witness_value, 4), (0.0, 4.0), 4)
+    assert list(edges) == [0, 1, 2, 3, 4]
+    assert list(counts) == [2, 1, 1, 2]
+    assert list(mins) == [1.0, 3.0, 0.5, 1.5]
+    assert list(maxes) == [2.0, 3.0, 0.5, 2.5]
+
+
+def test_histogram2d_matches_numpy():
+    rng = np.random.default_rng(3)
+    log_n = rng.uniform(0, 10, 1000)
+    witness_value = rng.uniform(1, 2, 1000)
+    limits = ((0.0, 10.0), (1.0, 2.0))
+    (counts, _, _) = histogram2d(
+        chunks_of(log_n, witness_value, 300), limits, (5, 4))
+    (expected, _, _) = np.histogram2d(
+        log_n, witness_value, bins=(5, 4), range=limits)
+    assert np.array_equal(counts, expected)
+
+
+def test_lttb_keeps_extremes():
+    x = np.arange(1000.0)
+    y = np.zeros(1000)
+    y[500] = 10
+    indices = lttb(x, y, 10)
+    assert len(indices) == 10
+    assert indices[0] == 0 and indices[-1] == 999
+    assert 500 in indices
+    assert list(indices) == sorted(indices)
+    assert list(lttb(x[:5], y[:5], 10)) == [0, 1, 2, 3, 4]
+
+
+def test_level_histograms():
+    (levels, counts) = level_histograms([
+        LevelStats(level=3, count=2, witness_histogram=(1, 1)),
+        LevelStats(level=4),
+    ])
+    assert list(levels) == [3, 4]
+    assert counts[0, :3].tolist() == [1, 1, 0]
+    assert counts[1].sum() == 0
+
+
+def test_downsample_has_fixed_size():
+    rng = np.random.default_rng(4)
+    log_n = np.sort(rng.uniform(0, 50, 20000))
+    witness_value = rng.uniform(1.6, 1.78, 20000)
+    chunks = chunks_of(log_n, witness_value, 3000)
+    assert column_limits(chunks) == (log_n[0], log_n[-1])
+
+    artifacts = downsample(
+        chunks, bins=100, witness_value_bins=10, line_points=50)
+    assert artifacts['bin_counts'].sum() == 20000
+    assert artifacts['histogram'].shape == (100, 10)
+    assert len(artifacts['cumulative_max_log_n']) <= 50
+    assert artifacts['cumulative_max_witness_value'][-1] == witness_value.max()
@@ -4,6 +4,7 @@ from multiprocessing import Pool
 from multiprocessing import Process
 from pytest_cov.embed import cleanup_on_sigterm
 from typing import List
+from typing import Optional
 import pytest
 import testing.postgresql
 import time
@@ -14,6 +15,7 @@ from riemann import process_search_blocks
 from riemann.database import DivisorDb
 from riemann.postgres_database import PostgresDivisorDb
 from riemann.search_strategy import SearchStrategy
+from riemann.sqlite_database import SqliteDivisorDb
 from riemann.search_strategy import SuperabundantSearchStrategy
 from riemann.types import RiemannDivisorSum
 from riemann.types import SearchBlockState
@@ -25,8 +27,7 @@ from riemann.types import SuperabundantEnumerationIndex
 cleanup_on_sigterm()
 
 
-@pytest.fixture
-def db_factory():
+def postgres_db_factory(tmp_path):
     tmp_postgres = testing.postgresql.Postgresql()
     database = PostgresDivisorDb(data_source_dict=tmp_postgres.dsn())
     database.initialize_schema()
@@ -35,12 +36,28 @@ def db_factory():
     tmp_postgres.stop
 
 
+def sqlite_db_factory(tmp_path):
+    path = str(tmp_path / 'divisor.sqlite')
+    database = SqliteDivisorDb(path)
+    database.initialize_schema()
+    yield lambda: SqliteDivisorDb(path)
+
+
+@pytest.fixture(params=[postgres_db_factory, sqlite_db_factory])
+def db_factory(request, tmp_path):
+    yield from request.param(tmp_path)
+
+
 @dataclass
 class FakeArgs:
     refresh_count: int = 5
     refresh_threshold: int = 3
     block_size: int = 1000
     refresh_period_seconds: int = 3
+    target_block_seconds: Optional[float] = None
+    min_block_size: int = 1000
+    max_block_size: int = 10000000
+    cost_model_sample_size: int = 500
 
 
 def make_processor_test_strategy(process_block_fn):
@@ -51,6 +68,9 @@ def make_processor_test_strategy(process_block_fn):
         def starting_from(self, search_index: SearchIndex) -> SearchStrategy:
             return self
 
+        def search_index(self) -> SearchIndex:
+            raise Exception('Failing for a test!')
+
         def generate_search_blocks(self, count: int, batch_size: int) -> List[SearchMetadata]:
             raise Exception('Failing for a test!')
 
@@ -0,0 +1,79 @@
+from functools import partial
+from gmpy2 import mpz
+import math
+import os
+import pytest
+
+from riemann.export_for_plotting import export_binary_columns
+from riemann.export_for_plotting import id_ranges
+from riemann.export_for_plotting import load_binary_columns
+from riemann.export_for_plotting import load_sorted_binary_columns
+from riemann.export_for_plotting import load_watermark
+from riemann.export_for_plotting import sort_binary_columns
+from riemann.sqlite_database import SqliteDivisorDb
+from riemann.types import ExhaustiveSearchIndex
+from riemann.types import RiemannDivisorSum
+from riemann.types import SearchMetadata
+
+
+def finish_block(db, start, witness_values):
+    db.insert_search_blocks([
+        SearchMetadata(
+            search_index_type='ExhaustiveSearchIndex',
+            starting_search_index=ExhaustiveSearchIndex(n=start),
+            ending_search_index=ExhaustiveSearchIndex(n=start + 1))])
+    block = db.claim_next_search_block(
+        search_index_type='ExhaustiveSearchIndex')
+    db.finish_search_block(block, [
+        RiemannDivisorSum(n=mpz(start + i), divisor_sum=1, witness_value=w)
+        for (i, w) in enumerate(witness_values)
+    ])
+
+
+def test_id_ranges():
+    assert id_ranges(0, 5, 2) == [(0, 2), (2, 4), (4, 5)]
+    assert id_ranges(5, 5, 2) == []
+
+
+def test_export_binary_columns_is_incremental(tmp_path):
+    path = str(tmp_path / 'divisor.sqlite')
+    db = SqliteDivisorDb(path)
+    db.initialize_schema()
+    connect = partial(SqliteDivisorDb, path)
+    directory = str(tmp_path / 'export')
+
+    finish_block(db, 10, [2, 1.8, 1.9])
+    assert export_binary_columns(
+        connect, directory, processes=2, rows_per_range=2) == 3
+    assert load_watermark(directory) == 3
+
+    finish_block(db, 20, [2.5])
+    assert export_binary_columns(
+        connect, directory, processes=2, rows_per_range=2) == 1
+    assert export_binary_columns(connect, directory, processes=2) == 0
+
+    (log_n, witness_value) = load_binary_columns(directory)
+    assert list(witness_value) == [2, 1.8, 1.9, 2.5]
+    assert log_n[-1] == pytest.approx(math.log(20))
+
+    assert sort_binary_columns(directory, max_rows=3) == 4
+    (log_n, witness_value) = load_sorted_binary_columns(directory)
+    assert list(log_n) == sorted(log_n)
+    assert list(witness_value) == [2, 1.8, 1.9, 2.5]
+
+
+def test_export_binary_columns_resumes(tmp_path):
+    path = str(tmp_path / 'divisor.sqlite')
+    db = SqliteDivisorDb(path)
+    db.initialize_schema()
+    directory = str(tmp_path / 'export')
+    os.makedirs(directory)
+    # a chunk past the watermark, left by an export that did not finish
+    with open(os.path.join(directory, 'ids-000000000000-000000000002'
+                           '.log_n.f64'), 'wb') as outfile:
+        outfile.write(b'partial')
+
+    finish_block(db, 10, [2, 1.8, 1.9])
+    assert export_binary_columns(
+        partial(SqliteDivisorDb, path), directory, processes=2) == 3
+    assert list(load_binary_columns(directory)[1]) == [2, 1.8, 1.9]
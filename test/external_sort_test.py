@@ -0,0 +1,35 @@
+import numpy as np
+
+from riemann.external_sort import external_sort
+from riemann.external_sort import load_columns
+from riemann.external_sort import sort_runs
+
+
+def test_sort_runs_bounds_run_size(tmp_path):
+    chunks = [(np.arange(5.0)[::-1], np.arange(5.0)),
+              (np.array([7.0, 6.0]), np.array([0.0, 1.0]))]
+    runs = sort_runs(chunks, str(tmp_path), max_rows=3)
+    assert [list(load_columns(run)[0]) for run in runs] == [
+        [2.0, 3.0, 4.0], [0.0, 1.0, 7.0], [6.0]]
+
+
+def test_external_sort_matches_in_memory_sort(tmp_path):
+    rng = np.random.default_rng(1)
+    # rounding leaves many equal keys
+    keys = np.round(rng.uniform(0, 100, 10000), 1)
+    values = rng.uniform(0, 1, 10000)
+    chunks = [(keys[i:i+700], values[i:i+700]) for i in range(0, 10000, 700)]
+
+    prefix = str(tmp_path / 'sorted')
+    assert external_sort(chunks, prefix, max_rows=1000) == 10000
+
+    (sorted_keys, sorted_values) = load_columns(prefix)
+    assert np.array_equal(sorted_keys, np.sort(keys))
+    # the values moved with their keys
+    assert sorted(zip(sorted_keys, sorted_values)) == sorted(zip(keys, values))
+
+
+def test_external_sort_empty(tmp_path):
+    prefix = str(tmp_path / 'sorted')
+    assert external_sort([], prefix) == 0
+    assert len(load_columns(prefix)[0]) == 0
@@ -0,0 +1,50 @@
+import numpy as np
+import os
+
+from riemann.feature_cache import FeatureCache
+from riemann.feature_cache import cache_key
+
+
+def test_cache_key_depends_on_contents_and_params():
+    a = np.arange(10.0)
+    assert cache_key([a], threshold=1.69) == cache_key(
+        [np.arange(10.0)], threshold=1.69)
+    assert cache_key([a], threshold=1.69) != cache_key([a], threshold=1.7)
+    assert cache_key([a]) != cache_key([a.astype(np.float32)])
+    assert cache_key([a]) != cache_key([a.reshape(2, 5)])
+    # params are hashed independently of their order
+    assert cache_key([a], x=1, y=2) == cache_key([a], y=2, x=1)
+
+
+def test_get_or_compute_reuses_results(tmp_path):
+    cache = FeatureCache(str(tmp_path))
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return np.ones((3, 2))
+
+    data = np.arange(5.0)
+    first = cache.get_or_compute(compute, [data], n_neighbors=15)
+    second = cache.get_or_compute(compute, [data], n_neighbors=15)
+    assert np.array_equal(first, second)
+    assert len(calls) == 1
+
+    cache.get_or_compute(compute, [data], n_neighbors=30)
+    assert len(calls) == 2
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = FeatureCache(str(tmp_path))
+    cache.put('a', np.zeros(100))
+    cache.max_bytes = 2 * os.path.getsize(cache.path('a'))
+    cache.put('b', np.zeros(100))
+    os.utime(cache.path('a'), (0, 0))
+    os.utime(cache.path('b'), (0, 0))
+    # a is used most recently, so b is evicted
+    assert cache.get('a') is not None
+    cache.put('c', np.zeros(100))
+
+    assert cache.get('b') is None
+    assert cache.get('a') is not None
+    assert cache.get('c') is not None
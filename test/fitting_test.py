@@ -0,0 +1,62 @@
+from gmpy2 import exp
+from gmpy2 import mpz
+import numpy as np
+import pytest
+
+from riemann.fitting import IncrementalFit
+from riemann.fitting import MODELS
+from riemann.fitting import Model
+from riemann.fitting import bisect_root
+from riemann.fitting import crossing
+from riemann.fitting import evaluate
+from riemann.fitting import fit
+from riemann.fitting import points_below_max
+from riemann.types import RiemannDivisorSum
+
+
+@pytest.mark.parametrize('name', sorted(MODELS))
+def test_fit_recovers_params(name):
+    model = MODELS[name]
+    x = np.linspace(10, 1000, 200)
+    y = evaluate(model, (1.78, -0.3), x)
+    assert fit(model, x, y) == pytest.approx((1.78, -0.3))
+
+
+def test_crossing_inverts_model():
+    model = MODELS['log_log']
+    params = (1.5, 0.05)
+    x = crossing(model, params, 1.782)
+    assert evaluate(model, params, x) == pytest.approx(1.782)
+    # a reciprocal curve approaching 1.78 from below never reaches 1.782
+    assert crossing(MODELS['reciprocal'], (1.78, -1), 1.782) is None
+
+
+def test_crossing_by_bisection():
+    model = Model(name='sqrt', feature=np.sqrt, inverse=None, min_x=0)
+    assert crossing(model, (1, 1), 3, bracket=(0, 100)) == pytest.approx(4)
+    assert crossing(model, (1, 1), 30, bracket=(0, 100)) is None
+    assert bisect_root(lambda x: x - 2, 2, 3) == 2
+
+
+def test_points_below_max():
+    (x, y) = points_below_max(np.array([1, 2, 3]), np.array([1.0, 2.0, 2.0]))
+    assert list(x) == [1]
+
+
+def test_incremental_fit_matches_batch_fit():
+    model = MODELS['reciprocal']
+    log_n = np.linspace(5, 50, 30)
+    witness_value = evaluate(model, (1.78, -0.5), log_n)
+    records = [
+        RiemannDivisorSum(n=mpz(exp(x)), divisor_sum=1, witness_value=w)
+        for (x, w) in zip(log_n, witness_value)
+    ]
+
+    incremental_fit = IncrementalFit(model)
+    assert incremental_fit.update(records[:10]) == 10
+    assert incremental_fit.update(records[:20]) == 10
+    assert incremental_fit.update(records[:20]) == 0
+    # the latest record is left out, as the current maximum
+    actual_log_n = np.array([float(np.log(float(r.n))) for r in records])
+    assert incremental_fit.params() == pytest.approx(
+        fit(model, actual_log_n[:19], witness_value[:19]))
@@ -0,0 +1,47 @@
+from argparse import Namespace
+import pytest
+
+from riemann.generate_search_blocks import refresh_search_blocks
+from riemann.in_memory_database import InMemoryDivisorDb
+from riemann.search_strategy import ExhaustiveSearchStrategy
+from riemann.search_strategy import SuperabundantSearchStrategy
+from riemann.types import ExhaustiveSearchIndex
+
+
+def refresh_args():
+    return Namespace(
+        refresh_count=3,
+        refresh_threshold=100,
+        block_size=5,
+        target_block_seconds=None,
+    )
+
+
+@pytest.mark.parametrize(
+    'make_strategy', [ExhaustiveSearchStrategy, SuperabundantSearchStrategy])
+def test_refresh_twice_continues_after_last_block(make_strategy):
+    db = InMemoryDivisorDb()
+    strategy = make_strategy()
+    refresh_search_blocks(db, strategy, refresh_args())
+    refresh_search_blocks(db, strategy, refresh_args())
+
+    blocks = db.load_metadata()
+    assert len(blocks) == 6
+    starts = [block.starting_search_index for block in blocks]
+    assert len(set(starts)) == 6
+
+    next_index = db.load_next_search_index(strategy.index_name())
+    assert next_index == make_strategy().starting_from(
+        blocks[-1].ending_search_index).generate_search_blocks(
+            count=1, batch_size=2)[0].ending_search_index
+
+
+def test_exhaustive_refresh_stores_index_after_batch():
+    db = InMemoryDivisorDb()
+    strategy = ExhaustiveSearchStrategy()
+    refresh_search_blocks(db, strategy, refresh_args())
+    refresh_search_blocks(db, strategy, refresh_args())
+
+    first = db.load_metadata()[0].starting_search_index.n
+    assert db.load_next_search_index(strategy.index_name()) == \
+        ExhaustiveSearchIndex(n=first + 2 * 3 * 5)
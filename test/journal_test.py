@@ -0,0 +1,196 @@
+from datetime import datetime
+from datetime import timedelta
+from dataclasses import replace
+import pytest
+
+from riemann.in_memory_database import InMemoryDivisorDb
+from riemann.journal import Journal
+from riemann.journal import JournalingDivisorDb
+from riemann.journal import check_lease_duration
+from riemann.types import ExhaustiveSearchIndex
+from riemann.types import LevelStats
+from riemann.types import RiemannDivisorSum
+from riemann.types import SearchBlockState
+from riemann.types import SearchMetadata
+from riemann.types import SuperabundantEnumerationIndex
+
+
+class FlakyConnection:
+    '''A connection factory whose database can be taken offline.'''
+
+    def __init__(self):
+        self.db = InMemoryDivisorDb()
+        self.available = True
+
+    def __call__(self):
+        if not self.available:
+            raise ConnectionError('Database is down')
+        return self
+
+    def __getattr__(self, name):
+        if not self.available:
+            raise ConnectionError('Database is down')
+        return getattr(self.db, name)
+
+
+def populate_search_blocks(db, count=10):
+    db.insert_search_blocks([
+        SearchMetadata(
+            search_index_type='ExhaustiveSearchIndex',
+            starting_search_index=ExhaustiveSearchIndex(n=i),
+            ending_search_index=ExhaustiveSearchIndex(n=i+1))
+        for i in range(1, 2 * count, 2)])
+
+
+def records_for(block):
+    n = block.starting_search_index.n
+    return [
+        RiemannDivisorSum(n=n, divisor_sum=1, witness_value=1),
+        RiemannDivisorSum(n=n+1, divisor_sum=1, witness_value=2),
+    ]
+
+
+def count_in_state(db, state):
+    return len([x for x in db.load_metadata() if x.state == state])
+
+
+def test_computation_continues_through_outage(tmp_path):
+    connection = FlakyConnection()
+    populate_search_blocks(connection.db)
+    db = JournalingDivisorDb(connection, str(tmp_path), lease_size=4)
+
+    block = db.claim_next_search_block('ExhaustiveSearchIndex')
+    db.finish_search_block(block, records_for(block))
+    assert count_in_state(connection.db, SearchBlockState.FINISHED) == 1
+
+    connection.available = False
+    for i in range(3):
+        block = db.claim_next_search_block('ExhaustiveSearchIndex')
+        db.finish_search_block(block, records_for(block))
+
+    # the lease is exhausted
+    with pytest.raises(ValueError):
+        db.claim_next_search_block('ExhaustiveSearchIndex')
+    assert count_in_state(connection.db, SearchBlockState.FINISHED) == 1
+    assert len(Journal(str(tmp_path)).load()) == 3
+
+    connection.available = True
+    db.claim_next_search_block('ExhaustiveSearchIndex')
+    assert count_in_state(connection.db, SearchBlockState.FINISHED) == 4
+    assert len(list(connection.db.load())) == 4
+    assert len(Journal(str(tmp_path)).load()) == 0
+
+
+def test_journaled_blocks_keep_hash_of_all_sums(tmp_path):
+    connection = FlakyConnection()
+    populate_search_blocks(connection.db)
+    expected = InMemoryDivisorDb()
+    populate_search_blocks(expected)
+    db = JournalingDivisorDb(connection, str(tmp_path))
+
+    block = db.claim_next_search_block('ExhaustiveSearchIndex')
+    connection.available = False
+    db.finish_search_block(block, records_for(block))
+    connection.available = True
+    db.sync()
+
+    expected_block = expected.claim_next_search_block('ExhaustiveSearchIndex')
+    expected.finish_search_block(expected_block, records_for(expected_block))
+    assert (
+        [m.block_hash for m in connection.db.load_metadata()] ==
+        [m.block_hash for m in expected.load_metadata()]
+    )
+
+
+def test_replay_is_idempotent(tmp_path):
+    connection = FlakyConnection()
+    populate_search_blocks(connection.db)
+    db = JournalingDivisorDb(connection, str(tmp_path))
+
+    block = db.claim_next_search_block('ExhaustiveSearchIndex')
+    db.finish_search_block(block, records_for(block))
+
+    # simulate a crash between committing to the database and truncating
+    Journal(str(tmp_path)).append(
+        connection.db.load_metadata()[0], records_for(block)[1:])
+    db.sync()
+
+    assert len(list(connection.db.load())) == 1
+    assert len(Journal(str(tmp_path)).load()) == 0
+
+
+def test_lease_survives_restart(tmp_path):
+    connection = FlakyConnection()
+    populate_search_blocks(connection.db)
+    db = JournalingDivisorDb(connection, str(tmp_path), lease_size=4)
+    db.claim_next_search_block('ExhaustiveSearchIndex')
+
+    connection.available = False
+    restarted = JournalingDivisorDb(connection, str(tmp_path), lease_size=4)
+    claimed = [
+        restarted.claim_next_search_block('ExhaustiveSearchIndex')
+        for i in range(3)
+    ]
+    assert len(set(b.key() for b in claimed)) == 3
+    with pytest.raises(ValueError):
+        restarted.claim_next_search_block('ExhaustiveSearchIndex')
+
+
+def test_leased_blocks_are_renewed_when_started(tmp_path):
+    connection = FlakyConnection()
+    populate_search_blocks(connection.db)
+    db = JournalingDivisorDb(connection, str(tmp_path), lease_size=4)
+    first = db.claim_next_search_block('ExhaustiveSearchIndex')
+
+    # the rest of the lease was claimed long ago, as far as staleness goes
+    leased_at = datetime.now() - timedelta(hours=3)
+    for block in connection.db.load_metadata():
+        if block.state == SearchBlockState.IN_PROGRESS:
+            connection.db.metadata[block.key()] = replace(
+                block, start_time=leased_at)
+
+    second = db.claim_next_search_block('ExhaustiveSearchIndex')
+    assert second.start_time > leased_at
+    stored = {b.key(): b for b in connection.db.load_metadata()}
+    assert stored[second.key()].start_time == second.start_time
+    assert stored[first.key()].start_time == leased_at
+
+    # a leased block claimed elsewhere since is skipped
+    third = db.leased[0]
+    connection.db.mark_block_as_failed(third)
+    connection.db.claim_next_search_block('ExhaustiveSearchIndex')
+    assert db.claim_next_search_block('ExhaustiveSearchIndex').key() != \
+        third.key()
+    assert len(db.leased) == 0
+
+
+def test_check_lease_duration():
+    check_lease_duration(8, timedelta(minutes=10), timedelta(hours=2))
+    with pytest.raises(ValueError):
+        check_lease_duration(8, timedelta(minutes=15), timedelta(hours=2))
+
+
+def test_journal_keeps_level_stats(tmp_path):
+    block = SearchMetadata(
+        starting_search_index=SuperabundantEnumerationIndex(
+            level=5, index_in_level=0),
+        ending_search_index=SuperabundantEnumerationIndex(
+            level=5, index_in_level=6),
+        level_stats=(LevelStats(level=5, count=7, witness_histogram=(3, 4)),))
+    journal = Journal(str(tmp_path))
+    journal.append(block, [])
+
+    [(loaded, _)] = journal.load()
+    assert loaded.level_stats == block.level_stats
+
+
+def test_journal_keeps_claim_token(tmp_path):
+    connection = FlakyConnection()
+    populate_search_blocks(connection.db)
+    db = JournalingDivisorDb(connection, str(tmp_path), lease_size=4)
+    db.claim_next_search_block('ExhaustiveSearchIndex')
+
+    connection.available = False
+    restarted = JournalingDivisorDb(connection, str(tmp_path), lease_size=4)
+    block = restarted.claim_next_search_block('ExhaustiveSearchIndex')
+    assert block.claim_token == 1
@@ -0,0 +1,116 @@
+from dataclasses import replace
+
+from riemann.level_stats import WITNESS_HISTOGRAM_EDGES
+from riemann.level_stats import block_level_stats
+from riemann.level_stats import block_size
+from riemann.level_stats import compute_level_stats
+from riemann.level_stats import count_pruned
+from riemann.level_stats import histogram_bin
+from riemann.level_stats import merge_all_level_stats
+from riemann.level_stats import row_levels
+from riemann.search_strategy import SuperabundantSearchStrategy
+from riemann.types import ExhaustiveSearchIndex
+from riemann.types import LevelStats
+from riemann.types import RiemannDivisorSum
+from riemann.types import SearchMetadata
+from riemann.types import SuperabundantEnumerationIndex
+
+
+def superabundant_block(start, end):
+    return SearchMetadata(
+        starting_search_index=SuperabundantEnumerationIndex(
+            level=start[0], index_in_level=start[1]),
+        ending_search_index=SuperabundantEnumerationIndex(
+            level=end[0], index_in_level=end[1]),
+    )
+
+
+def test_histogram_bin():
+    assert histogram_bin(-1) == 0
+    assert histogram_bin(0.5) == 0
+    assert histogram_bin(1.767) == WITNESS_HISTOGRAM_EDGES.index(1.767)
+    assert histogram_bin(100) == len(WITNESS_HISTOGRAM_EDGES) - 1
+
+
+def test_compute_level_stats_spanning_levels():
+    # level 5 has 7 partitions, and level 6 has 11
+    block = superabundant_block((5, 4), (6, 2))
+    divisor_sums = SuperabundantSearchStrategy().process_block(block)
+    stats = compute_level_stats(block, divisor_sums, 1.0, seconds=6)
+
+    assert [(s.level, s.count) for s in stats] == [(5, 3), (6, 3)]
+    assert [s.seconds for s in stats] == [3, 3]
+    level_6 = divisor_sums[3:]
+    best = max(range(3), key=lambda i: level_6[i].witness_value)
+    assert stats[1].max_witness_index == best
+    assert stats[1].max_witness_value == level_6[best].witness_value
+    assert stats[1].count_above_threshold == len(
+        [d for d in level_6 if d.witness_value > 1.0])
+    assert sum(stats[1].witness_histogram) == 3
+
+
+def test_compute_level_stats_exhaustive_blocks_by_magnitude():
+    block = SearchMetadata(
+        search_index_type='ExhaustiveSearchIndex',
+        starting_search_index=ExhaustiveSearchIndex(n=19),
+        ending_search_index=ExhaustiveSearchIndex(n=21))
+    divisor_sums = [
+        RiemannDivisorSum(n=19, divisor_sum=20, witness_value=1.1),
+        RiemannDivisorSum(n=20, divisor_sum=42, witness_value=1.5),
+        RiemannDivisorSum(n=21, divisor_sum=32, witness_value=1.2),
+    ]
+    stats = compute_level_stats(block, divisor_sums, 1.3)
+
+    # log 20 is just below 3
+    assert [(s.level, s.count) for s in stats] == [(2, 2), (3, 1)]
+    assert stats[0].max_witness_value == 1.5
+    assert stats[0].count_above_threshold == 1
+
+
+def test_count_pruned():
+    block = superabundant_block((5, 4), (6, 2))
+    divisor_sums = SuperabundantSearchStrategy().process_block(block)
+    stats = compute_level_stats(block, divisor_sums, 1.0)
+
+    pruned = count_pruned(stats, block, [divisor_sums[0], divisor_sums[4]])
+    assert [(s.level, s.count_pruned) for s in pruned] == [(5, 2), (6, 2)]
+
+
+def test_block_level_stats_precomputed_hash_without_stats():
+    block = superabundant_block((5, 0), (5, 1))
+    divisor_sums = SuperabundantSearchStrategy().process_block(block)
+    assert len(block_level_stats(block, divisor_sums, 1.0)) == 1
+
+    hashed = replace(block, block_hash='abc')
+    assert block_level_stats(hashed, divisor_sums[:1], 1.0) == ()
+
+
+def test_merge_level_stats():
+    merged = merge_all_level_stats([
+        LevelStats(level=3, count=2, count_above_threshold=1,
+                   max_witness_value=1.5, max_witness_index=1,
+                   witness_histogram=(1, 1), seconds=1),
+        LevelStats(level=4, count=1, witness_histogram=(1, 0)),
+        LevelStats(level=3, count=3, count_above_threshold=2,
+                   max_witness_value=1.7, max_witness_index=4,
+                   witness_histogram=(0, 3), seconds=2),
+    ])
+    assert merged[3] == LevelStats(
+        level=3, count=5, count_above_threshold=3, max_witness_value=1.7,
+        max_witness_index=4, witness_histogram=(1, 4), seconds=3)
+    assert merged[4].count == 1
+
+
+def test_block_size():
+    assert block_size(superabundant_block((5, 4), (6, 2))) == 6
+    assert block_size(superabundant_block((5, 0), (7, 0))) == 19
+    assert block_size(SearchMetadata(
+        starting_search_index=ExhaustiveSearchIndex(n=3),
+        ending_search_index=ExhaustiveSearchIndex(n=7))) == 5
+
+
+def test_row_levels_with_all_or_some_divisor_sums():
+    block = superabundant_block((5, 4), (6, 2))
+    divisor_sums = SuperabundantSearchStrategy().process_block(block)
+    assert row_levels(block, divisor_sums) == [5, 5, 5, 6, 6, 6]
+    assert row_levels(block, divisor_sums[2:4]) == [5, 6]
@@ -0,0 +1,80 @@
+from datetime import datetime
+
+from riemann.search_archive import archived_range_of_block
+from riemann.search_archive import deserialize_archived_range
+from riemann.search_archive import expand_archived_range
+from riemann.search_archive import merge_archived_ranges
+from riemann.search_archive import next_search_index
+from riemann.search_archive import serialize_range_blocks
+from riemann.types import ExhaustiveSearchIndex
+from riemann.types import SearchBlockState
+from riemann.types import SearchMetadata
+from riemann.types import SuperabundantEnumerationIndex
+
+
+def exhaustive_block(start, end, block_hash=None):
+    return SearchMetadata(
+        search_index_type='ExhaustiveSearchIndex',
+        starting_search_index=ExhaustiveSearchIndex(n=start),
+        ending_search_index=ExhaustiveSearchIndex(n=end),
+        state=SearchBlockState.FINISHED,
+        end_time=datetime(2021, 1, 1, start),
+        block_hash=block_hash or f"hash{start}",
+        storage_policy='fixed:1.767')
+
+
+def ranges_as_tuples(ranges):
+    return sorted(
+        (r.starting_search_index.n, r.ending_search_index.n, len(r))
+        for r in ranges)
+
+
+def test_next_search_index():
+    assert next_search_index(ExhaustiveSearchIndex(n=5)) == \
+        ExhaustiveSearchIndex(n=6)
+    # level 5 has 7 partitions
+    assert next_search_index(SuperabundantEnumerationIndex(5, 5)) == \
+        SuperabundantEnumerationIndex(5, 6)
+    assert next_search_index(SuperabundantEnumerationIndex(5, 6)) == \
+        SuperabundantEnumerationIndex(6, 0)
+
+
+def test_merge_contiguous_blocks():
+    blocks = [exhaustive_block(1, 2), exhaustive_block(5, 6),
+              exhaustive_block(3, 4), exhaustive_block(8, 9)]
+    (removed, added) = merge_archived_ranges([], blocks)
+    assert removed == []
+    assert ranges_as_tuples(added) == [(1, 6, 3), (8, 9, 1)]
+
+    [merged, _] = sorted(added, key=lambda r: r.starting_search_index.n)
+    assert merged.block_hashes == ('hash1', 'hash3', 'hash5')
+    assert merged.last_end_time == datetime(2021, 1, 1, 5)
+
+
+def test_merge_fills_gap_between_archived_ranges():
+    first = archived_range_of_block(exhaustive_block(1, 2))
+    last = archived_range_of_block(exhaustive_block(5, 6))
+    unrelated = archived_range_of_block(exhaustive_block(10, 11))
+    (removed, added) = merge_archived_ranges(
+        [first, last, unrelated], [exhaustive_block(3, 4)])
+    assert removed == [first, last]
+    assert ranges_as_tuples(added) == [(1, 6, 3)]
+
+
+def test_merge_respects_max_blocks_per_range():
+    blocks = [exhaustive_block(i, i) for i in range(1, 6)]
+    (_, added) = merge_archived_ranges([], blocks, max_blocks_per_range=2)
+    assert ranges_as_tuples(added) == [(1, 2, 2), (3, 4, 2), (5, 5, 1)]
+
+
+def test_serialize_and_expand_round_trip():
+    blocks = [exhaustive_block(1, 2), exhaustive_block(3, 4)]
+    (_, [archived]) = merge_archived_ranges([], blocks)
+    restored = deserialize_archived_range(
+        'ExhaustiveSearchIndex', '1', serialize_range_blocks(archived),
+        archived.last_end_time)
+    assert restored == archived
+    assert [
+        (b.key(), b.block_hash, b.storage_policy)
+        for b in expand_archived_range(restored)
+    ] == [(b.key(), b.block_hash, b.storage_policy) for b in blocks]
@@ -0,0 +1,93 @@
+from gmpy2 import mpz
+import pytest
+
+from riemann.search_strategy import SuperabundantSearchStrategy
+from riemann.storage_policy import FixedThresholdPolicy
+from riemann.storage_policy import RecordDeltaPolicy
+from riemann.storage_policy import TopKPerLevelPolicy
+from riemann.storage_policy import storage_policy_from_spec
+from riemann.types import ExhaustiveSearchIndex
+from riemann.types import RiemannDivisorSum
+from riemann.types import SearchMetadata
+from riemann.types import SuperabundantEnumerationIndex
+
+BLOCK = SearchMetadata(
+    starting_search_index=ExhaustiveSearchIndex(n=1),
+    ending_search_index=ExhaustiveSearchIndex(n=6))
+
+DIVISOR_SUMS = [
+    RiemannDivisorSum(n=mpz(n), divisor_sum=1, witness_value=w)
+    for (n, w) in [(2, 1.7), (3, 1.8), (4, 1.75), (6, 1.6)]
+]
+
+
+def test_fixed_threshold():
+    policy = FixedThresholdPolicy(1.72)
+    assert policy.select(BLOCK, DIVISOR_SUMS, None) == [
+        DIVISOR_SUMS[1], DIVISOR_SUMS[2]]
+
+
+def test_record_delta_uses_largest_of_record_and_block():
+    policy = RecordDeltaPolicy(0.1)
+    assert policy.select(BLOCK, DIVISOR_SUMS, 1.5) == DIVISOR_SUMS[:3]
+    assert policy.select(BLOCK, DIVISOR_SUMS, 1.84) == [
+        DIVISOR_SUMS[1], DIVISOR_SUMS[2]]
+    assert policy.select(BLOCK, DIVISOR_SUMS, None) == DIVISOR_SUMS[:3]
+    assert policy.select(BLOCK, [], None) == []
+
+
+def test_record_delta_without_record_is_a_superset():
+    policy = RecordDeltaPolicy(0.1)
+    without_record = policy.select(BLOCK, DIVISOR_SUMS, None)
+    for record in [1.0, 1.79, 1.85, 2.0]:
+        assert set(d.n for d in policy.select(BLOCK, DIVISOR_SUMS, record)) <= \
+            set(d.n for d in without_record)
+
+
+def test_top_k_per_level():
+    # levels are 1, 1, 2, 2
+    policy = TopKPerLevelPolicy(1)
+    assert policy.select(BLOCK, DIVISOR_SUMS, None) == [
+        DIVISOR_SUMS[1], DIVISOR_SUMS[2]]
+
+
+def test_top_k_per_level_with_level_cutoffs():
+    # levels are 1, 1, 2, 2
+    policy = TopKPerLevelPolicy(2)
+    cutoffs = {1: 1.75, 2: None}
+    assert policy.select(BLOCK, DIVISOR_SUMS, None, cutoffs.get) == [
+        DIVISOR_SUMS[1], DIVISOR_SUMS[2], DIVISOR_SUMS[3]]
+
+
+def test_top_k_per_level_breaks_ties_by_smaller_n():
+    divisor_sums = [
+        RiemannDivisorSum(n=mpz(n), divisor_sum=1, witness_value=1.7)
+        for n in [5, 3, 2]
+    ]
+    assert TopKPerLevelPolicy(2).select(BLOCK, divisor_sums, None) == \
+        divisor_sums[1:]
+
+
+def test_top_k_per_level_is_stable_under_filtering():
+    block = SearchMetadata(
+        starting_search_index=SuperabundantEnumerationIndex(
+            level=6, index_in_level=0),
+        ending_search_index=SuperabundantEnumerationIndex(
+            level=8, index_in_level=3))
+    divisor_sums = SuperabundantSearchStrategy().process_block(block)
+    policy = TopKPerLevelPolicy(3)
+    selected = policy.select(block, divisor_sums, None)
+    assert len(selected) == 9
+    assert policy.select(block, selected, None) == selected
+
+
+@pytest.mark.parametrize('spec', [
+    'fixed:1.767', 'record_delta:0.01', 'top_k_per_level:100'])
+def test_spec_round_trip(spec):
+    assert storage_policy_from_spec(spec).version() == spec
+
+
+@pytest.mark.parametrize('spec', ['fixed', 'top_k_per_level:x', 'other:1'])
+def test_invalid_spec(spec):
+    with pytest.raises(ValueError):
+        storage_policy_from_spec(spec)
@@ -10,6 +10,7 @@ from riemann.superabundant import compute_riemann_divisor_sum
 from riemann.superabundant import count_partitions_of_n
 from riemann.superabundant import factorize
 from riemann.superabundant import partitions_of_n
+from riemann.superabundant import prime_factor_count
 from riemann.superabundant import prime_factor_divisor_sum
 import hypothesis.strategies as st
 import pytest
@@ -138,6 +139,17 @@ def test_factorize(prime_factorization):
     assert prime_factorization == factorize(n, primes)
 
 
+@given(prime_factorization())
+def test_prime_factor_count(prime_factorization):
+    n = reduce(lambda x, y: x * y, (mpz(p)**a for (p, a) in prime_factorization))
+    assert prime_factor_count(n) == sum(a for (p, a) in prime_factorization)
+
+
+def test_prime_factor_count_large_prime_factor():
+    assert prime_factor_count(1) == 0
+    assert prime_factor_count(mpz(2)**3 * 104729) == 4
+
+
 def test_prime_factor_divisor_sum_2():
     assert prime_factor_divisor_sum([(2, 1)]) == divisor_sum(2)
 
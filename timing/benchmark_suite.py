@@ -0,0 +1,269 @@
+'''
+A micro-benchmark suite for the hot kernels of the search.
+
+Each benchmark is timed over several samples, after a warmup call that also
+compiles any numba functions. Results are written as JSON along with the
+machine they ran on, and can be compared against a stored baseline, e.g.,
+
+    python -m timing.benchmark_suite --output_path=results.json \
+        --baseline_path=timing/baselines/baseline.json
+
+The comparison exits with a nonzero status if any benchmark is slower than
+its baseline by more than the tolerance.
+'''
+from dataclasses import dataclass
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+
+from functools import partial
+from gmpy2 import mpz
+from riemann import divisor
+from riemann import superabundant
+from riemann.export_for_plotting import export_binary_columns
+from riemann.external_sort import external_sort
+from riemann.search_strategy import ExhaustiveSearchStrategy
+from riemann.search_strategy import SuperabundantSearchStrategy
+from riemann.sqlite_database import SqliteDivisorDb
+from riemann.types import ExhaustiveSearchIndex
+from riemann.types import RiemannDivisorSum
+from riemann.types import SuperabundantEnumerationIndex
+from riemann.types import hash_divisor_sums
+import numpy as np
+
+
+@dataclass(frozen=True)
+class Benchmark:
+    name: str
+    run: Callable[[], Any]
+    # the number of calls to run in each sample
+    number: int = 1
+
+
+def staircase_partition(level: int) -> List[int]:
+    '''A partition of level into decreasing parts, like a superabundant n.'''
+    parts: List[int] = []
+    while sum(parts) + len(parts) + 1 <= level:
+        parts.insert(0, len(parts) + 1)
+    parts[0] += level - sum(parts)
+    return parts
+
+
+def superabundant_block(level: int, size: int):
+    return SuperabundantSearchStrategy().starting_from(
+        SuperabundantEnumerationIndex(level=level, index_in_level=0)
+    ).generate_next_block(size)
+
+
+def exhaustive_block(start: int, size: int):
+    return ExhaustiveSearchStrategy().starting_from(
+        ExhaustiveSearchIndex(n=start)).generate_search_blocks(1, size)[0]
+
+
+def sqlite_with_divisor_sums(directory: str, rows: int) -> str:
+    '''A sqlite database in directory with one block of rows divisor sums.'''
+    path = os.path.join(directory, 'divisor.sqlite')
+    db = SqliteDivisorDb(path)
+    db.initialize_schema()
+    block = exhaustive_block(10000, rows)
+    db.insert_search_blocks([block])
+    # witness values above the default storage threshold, so all are stored
+    divisor_sums = [
+        RiemannDivisorSum(
+            n=mpz(n), divisor_sum=mpz(n), witness_value=1.8 + (n % 997) / 1e4)
+        for n in range(10000, 10000 + rows)
+    ]
+    db.finish_search_block(
+        db.claim_next_search_block(search_index_type=block.search_index_type),
+        divisor_sums)
+    db.connection.close()
+    return path
+
+
+def export_to_fresh_directory(path: str, directory: str) -> int:
+    with tempfile.TemporaryDirectory(dir=directory) as export_directory:
+        return export_binary_columns(
+            partial(SqliteDivisorDb, path), export_directory,
+            processes=2, rows_per_range=50000)
+
+
+def sort_to_fresh_directory(
+        chunks: List[Tuple[np.ndarray, np.ndarray]],
+        directory: str,
+        max_rows: int) -> int:
+    with tempfile.TemporaryDirectory(dir=directory) as sort_directory:
+        return external_sort(
+            chunks, os.path.join(sort_directory, 'sorted'), max_rows=max_rows)
+
+
+def benchmarks() -> List[Benchmark]:
+    '''The benchmarks of the suite, with inputs built ahead of timing.'''
+    suite = []
+    for n in [10**6, 10**9, 10**12]:
+        suite.append(Benchmark(
+            f"divisor_sum[n=10^{len(str(n)) - 1}]",
+            lambda n=n: divisor.divisor_sum(n),
+            number=10))
+
+    for level in [20, 30, 40]:
+        suite.append(Benchmark(
+            f"partitions_of_n[level={level}]",
+            lambda level=level: superabundant.partitions_of_n(level)))
+
+    for level in [50, 60, 70]:
+        suite.append(Benchmark(
+            f"count_partitions_of_n[level={level}]",
+            lambda level=level: superabundant.count_partitions_of_n(level)))
+
+    for level in [20, 60, 100]:
+        factorization = superabundant.partition_to_prime_factorization(
+            staircase_partition(level))
+        suite.append(Benchmark(
+            f"compute_riemann_divisor_sum[level={level}]",
+            lambda f=factorization: superabundant.compute_riemann_divisor_sum(
+                f),
+            number=100))
+
+    sums = SuperabundantSearchStrategy().process_block(
+        superabundant_block(30, 10000))
+    suite.append(Benchmark(
+        "hash_divisor_sums[rows=10000]",
+        lambda: hash_divisor_sums(sums)))
+
+    for level in [30, 50, 60]:
+        block = superabundant_block(level, 1000)
+        suite.append(Benchmark(
+            f"process_block[superabundant,level={level},size=1000]",
+            lambda block=block:
+                SuperabundantSearchStrategy().process_block(block)))
+
+    for start in [10**6, 10**8]:
+        block = exhaustive_block(start, 1000)
+        suite.append(Benchmark(
+            f"process_block[exhaustive,n=10^{len(str(start)) - 1},size=1000]",
+            lambda block=block:
+                ExhaustiveSearchStrategy().process_block(block)))
+
+    # kept alive by the closures below, and removed when they are
+    scratch = tempfile.TemporaryDirectory()
+    path = sqlite_with_divisor_sums(scratch.name, 100000)
+    suite.append(Benchmark(
+        "export_binary_columns[sqlite,rows=100000]",
+        lambda: (scratch, export_to_fresh_directory(path, scratch.name))))
+
+    rng = np.random.default_rng(0)
+    chunks = [(rng.random(250000), rng.random(250000)) for _ in range(4)]
+    suite.append(Benchmark(
+        "external_sort[rows=1000000,max_rows=250000]",
+        lambda: (scratch, sort_to_fresh_directory(
+            chunks, scratch.name, max_rows=250000))))
+    return suite
+
+
+def time_benchmark(benchmark: Benchmark, repeat: int) -> Dict[str, float]:
+    '''The fastest and median seconds per call over repeat samples.'''
+    benchmark.run()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(benchmark.number):
+            benchmark.run()
+        samples.append((time.perf_counter() - start) / benchmark.number)
+    return dict(min=min(samples), median=statistics.median(samples))
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+            check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def machine_metadata() -> Dict[str, Any]:
+    import gmpy2
+    import numba
+    import numpy
+    return dict(
+        platform=platform.platform(),
+        processor=platform.processor(),
+        cpu_count=os.cpu_count(),
+        python=platform.python_version(),
+        numpy=numpy.__version__,
+        numba=numba.__version__,
+        gmpy2=gmpy2.version(),
+        numba_disable_jit=os.environ.get('NUMBA_DISABLE_JIT'),
+        git_commit=git_commit(),
+        time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+    )
+
+
+def run_suite(repeat: int = 5, name_filter: str = '') -> Dict[str, Any]:
+    results = {}
+    for benchmark in benchmarks():
+        if name_filter not in benchmark.name:
+            continue
+        results[benchmark.name] = time_benchmark(benchmark, repeat)
+        print(f"{benchmark.name}: {results[benchmark.name]['min']:.6f}s")
+    return dict(machine=machine_metadata(), results=results)
+
+
+def compare(results: Dict[str, Any],
+            baseline: Dict[str, Any],
+            tolerance: float) -> List[str]:
+    '''
+    Print the ratio of each benchmark's fastest time to its baseline, and
+    return the names of those slower by more than tolerance.
+    '''
+    regressions = []
+    for (name, result) in results['results'].items():
+        if name not in baseline['results']:
+            print(f"{name}: no baseline")
+            continue
+        ratio = result['min'] / baseline['results'][name]['min']
+        regressed = ratio > 1 + tolerance
+        print(f"{name}: {ratio:.3f}x baseline"
+              f"{' REGRESSION' if regressed else ''}")
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Run the micro-benchmark suite')
+    parser.add_argument('--output_path', type=str, default=None,
+                        help='If set, write the results as JSON to this file')
+    parser.add_argument('--baseline_path', type=str, default=None,
+                        help='If set, compare the results to this file')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='The fraction by which a benchmark may be '
+                             'slower than its baseline')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='The number of samples of each benchmark')
+    parser.add_argument('--filter', type=str, default='',
+                        help='Run only benchmarks whose name contains this')
+    args = parser.parse_args()
+
+    results = run_suite(repeat=args.repeat, name_filter=args.filter)
+    if args.output_path:
+        with open(args.output_path, 'w') as outfile:
+            json.dump(results, outfile, indent=2, sort_keys=True)
+
+    if args.baseline_path:
+        with open(args.baseline_path) as infile:
+            baseline = json.load(infile)
+        if compare(results, baseline, args.tolerance):
+            raise SystemExit(1)
@@ -0,0 +1,329 @@
+'''
+A load test of the work queue: many concurrent connections claiming,
+finishing and failing search blocks, against a throwaway database with a
+large SearchMetadata table, e.g.,
+
+    python -m timing.claim_contention --backend=postgres --connections=300 \
+        --finished_blocks=1000000 --eligible_blocks=100000
+
+The blocks are tiny exhaustive search blocks, and finishing one stores no
+divisor sums, so the test measures only the queue. Each connection runs in
+its own thread, since the database drivers release the GIL while waiting on
+the database. The test reports throughput, latency percentiles, the time
+backends spent waiting on locks, sampled from pg_stat_activity for
+postgres, and any claims that violate the queue's guarantees:
+
+ - a block claimed twice with the same claim token, i.e., by two
+   connections at once,
+ - a block claimed again after it was finished.
+'''
+from collections import Counter
+from dataclasses import dataclass
+from dataclasses import field
+from threading import Event
+from threading import Thread
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+import json
+import os
+import random
+import tempfile
+import time
+
+from riemann.database import DivisorDb
+from riemann.postgres_database import PostgresDivisorDb
+from riemann.search_strategy import ExhaustiveSearchStrategy
+from riemann.types import ExhaustiveSearchIndex
+from timing.throughput_benchmark import BACKENDS
+from timing.throughput_benchmark import connect
+from timing.throughput_benchmark import percentiles
+from timing.throughput_benchmark import print_summary
+
+# A claimed block, as its serialized starting search index and claim token
+Claim = Tuple[str, int]
+
+
+@dataclass
+class ConnectionStats:
+    empty_claims: int = 0
+    rejected_finishes: int = 0
+    errors: int = 0
+    claim_seconds: List[float] = field(default_factory=list)
+    finish_seconds: List[float] = field(default_factory=list)
+    fail_seconds: List[float] = field(default_factory=list)
+    claimed: List[Claim] = field(default_factory=list)
+    finished: List[Claim] = field(default_factory=list)
+
+
+def insert_blocks(db: DivisorDb,
+                  start: int,
+                  count: int,
+                  insert_batch_size: int = 10000) -> int:
+    '''
+    Insert count exhaustive search blocks of size 1 starting from n=start,
+    returning the n after the last block.
+    '''
+    search_strategy = ExhaustiveSearchStrategy()
+    for batch_start in range(0, count, insert_batch_size):
+        batch_count = min(insert_batch_size, count - batch_start)
+        db.insert_search_blocks(search_strategy.starting_from(
+            ExhaustiveSearchIndex(n=start)).generate_search_blocks(
+                count=batch_count, batch_size=1))
+        start += batch_count
+    return start
+
+
+def populate(backend: str,
+             location: Any,
+             finished_blocks: int,
+             eligible_blocks: int) -> None:
+    '''
+    Insert finished_blocks finished search blocks, followed by
+    eligible_blocks blocks that have not been started.
+    '''
+    db = connect(backend, location)
+    start = insert_blocks(
+        db, ExhaustiveSearchStrategy().search_index().n, finished_blocks)
+    cursor = db.connection.cursor()
+    cursor.execute(
+        "UPDATE SearchMetadata SET state = 'FINISHED', "
+        "start_time = creation_time, end_time = creation_time;")
+    db.connection.commit()
+    insert_blocks(db, start, eligible_blocks)
+    db.connection.close()
+
+
+def run_connection(backend: str,
+                   location: Any,
+                   claim_count: int,
+                   fail_fraction: float,
+                   start: Event,
+                   deadline: List[float],
+                   stats: ConnectionStats) -> None:
+    '''
+    Claim blocks, then finish or fail each of them, until the deadline.
+    '''
+    db = connect(backend, location)
+    index_name = ExhaustiveSearchStrategy().index_name()
+    start.wait()
+    while time.time() < deadline[0]:
+        try:
+            claim_start = time.perf_counter()
+            blocks = db.claim_next_search_blocks(index_name, claim_count)
+            stats.claim_seconds.append(time.perf_counter() - claim_start)
+        except ValueError:
+            stats.empty_claims += 1
+            time.sleep(0.01)
+            continue
+        except Exception:
+            stats.errors += 1
+            continue
+
+        for block in blocks:
+            claim = (block.starting_search_index.serialize(),
+                     block.claim_token or 0)
+            stats.claimed.append(claim)
+            try:
+                operation_start = time.perf_counter()
+                if random.random() < fail_fraction:
+                    db.mark_block_as_failed(block)
+                    stats.fail_seconds.append(
+                        time.perf_counter() - operation_start)
+                else:
+                    db.finish_search_block(block, [])
+                    stats.finish_seconds.append(
+                        time.perf_counter() - operation_start)
+                    stats.finished.append(claim)
+            except ValueError:
+                stats.rejected_finishes += 1
+            except Exception:
+                stats.errors += 1
+    db.connection.close()
+
+
+def sample_lock_waits(location: Any,
+                      stop: Event,
+                      interval_seconds: float,
+                      samples: List[int]) -> None:
+    '''
+    Count the postgres backends waiting on a lock every interval_seconds,
+    until stop is set.
+    '''
+    db = PostgresDivisorDb(data_source_dict=location)
+    cursor = db.connection.cursor()
+    while not stop.wait(interval_seconds):
+        cursor.execute('''
+            SELECT count(*)
+            FROM pg_stat_activity
+            WHERE
+              wait_event_type = 'Lock'
+              AND datname = current_database();
+        ''')
+        samples.append(cursor.fetchone()[0])
+        db.connection.commit()
+    db.connection.close()
+
+
+def claim_violations(stats: List[ConnectionStats]) -> Dict[str, int]:
+    '''
+    Count the blocks claimed by two connections with the same claim token,
+    and the claims of blocks after they were finished.
+    '''
+    claim_counts = Counter(claim for s in stats for claim in s.claimed)
+    finished_tokens = {
+        block: token for s in stats for (block, token) in s.finished}
+    return dict(
+        duplicate_claims=sum(
+            count - 1 for count in claim_counts.values() if count > 1),
+        claims_after_finish=sum(
+            count for ((block, token), count) in claim_counts.items()
+            if block in finished_tokens and token > finished_tokens[block]),
+    )
+
+
+def run_load_test(backend: str,
+                  location: Any,
+                  connections: int,
+                  duration_seconds: float,
+                  claim_count: int = 1,
+                  fail_fraction: float = 0.05,
+                  lock_sample_seconds: float = 0.1) -> Dict[str, Any]:
+    '''
+    Run the connections against a populated database for duration_seconds,
+    and summarize their throughput, latencies, lock waits and violations.
+    '''
+    start = Event()
+    # set once every connection is open, so connecting is not timed
+    deadline = [float('inf')]
+    stats = [ConnectionStats() for _ in range(connections)]
+    threads = [
+        Thread(target=run_connection,
+               args=(backend, location, claim_count, fail_fraction, start,
+                     deadline, connection_stats))
+        for connection_stats in stats
+    ]
+    for thread in threads:
+        thread.start()
+
+    stop_sampling = Event()
+    lock_samples: List[int] = []
+    sampler = None
+    if backend == 'postgres':
+        sampler = Thread(
+            target=sample_lock_waits,
+            args=(location, stop_sampling, lock_sample_seconds, lock_samples))
+        sampler.start()
+
+    # give the connections time to connect before starting the clock
+    time.sleep(min(10, 0.05 * connections))
+    begin = time.time()
+    deadline[0] = begin + duration_seconds
+    start.set()
+    for thread in threads:
+        thread.join()
+    elapsed_seconds = time.time() - begin
+    stop_sampling.set()
+    if sampler is not None:
+        sampler.join()
+
+    claim_seconds = [s for c in stats for s in c.claim_seconds]
+    finish_seconds = [s for c in stats for s in c.finish_seconds]
+    fail_seconds = [s for c in stats for s in c.fail_seconds]
+    lock_wait_seconds: Optional[float] = None
+    max_lock_waiters: Optional[int] = None
+    if sampler is not None:
+        lock_wait_seconds = sum(lock_samples) * lock_sample_seconds
+        max_lock_waiters = max(lock_samples, default=0)
+
+    return dict(
+        elapsed_seconds=elapsed_seconds,
+        claims_per_second=len(claim_seconds) / elapsed_seconds,
+        blocks_claimed_per_second=(
+            sum(len(c.claimed) for c in stats) / elapsed_seconds),
+        finishes_per_second=len(finish_seconds) / elapsed_seconds,
+        fails_per_second=len(fail_seconds) / elapsed_seconds,
+        empty_claims=sum(c.empty_claims for c in stats),
+        rejected_finishes=sum(c.rejected_finishes for c in stats),
+        errors=sum(c.errors for c in stats),
+        claim_latency_seconds=percentiles(claim_seconds),
+        finish_latency_seconds=percentiles(finish_seconds),
+        fail_latency_seconds=percentiles(fail_seconds),
+        # the total time backends spent waiting on locks, estimated by
+        # sampling how many were waiting
+        lock_wait_seconds=lock_wait_seconds,
+        max_lock_waiters=max_lock_waiters,
+        **claim_violations(stats),
+    )
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Load test claiming search blocks from many connections')
+    parser.add_argument('--backend', type=str, choices=BACKENDS,
+                        default='postgres', help='The database to run against')
+    parser.add_argument('--connections', type=int, default=200,
+                        help='The number of concurrent connections')
+    parser.add_argument('--duration_seconds', type=float, default=60,
+                        help='How long to run the connections for')
+    parser.add_argument('--finished_blocks', type=int, default=1000000,
+                        help='The number of finished blocks to populate the '
+                             'SearchMetadata table with')
+    parser.add_argument('--eligible_blocks', type=int, default=100000,
+                        help='The number of blocks available to claim')
+    parser.add_argument('--claim_count', type=int, default=1,
+                        help='The number of blocks to claim at a time')
+    parser.add_argument('--fail_fraction', type=float, default=0.05,
+                        help='The fraction of claimed blocks to mark as '
+                             'failed instead of finishing')
+    parser.add_argument('--output_path', type=str, default=None,
+                        help='If set, write the summary as JSON to this file')
+    args = parser.parse_args()
+
+    settings = dict(
+        connections=args.connections,
+        duration_seconds=args.duration_seconds,
+        claim_count=args.claim_count,
+        fail_fraction=args.fail_fraction,
+    )
+
+    def populate_and_run(location: Any) -> Dict[str, Any]:
+        populate_start = time.time()
+        populate(args.backend, location,
+                 args.finished_blocks, args.eligible_blocks)
+        print(f"Populated SearchMetadata in {time.time() - populate_start:.1f}s")
+        return run_load_test(args.backend, location, **settings)
+
+    if args.backend == 'postgres':
+        import testing.postgresql
+        with testing.postgresql.Postgresql(
+                postgres_args=(
+                    '-h 127.0.0.1 -F -c logging_collector=off '
+                    f'-c max_connections={args.connections + 20}')
+        ) as postgresql:
+            db = connect('postgres', postgresql.dsn())
+            db.initialize_schema()
+            db.connection.close()
+            summary = populate_and_run(postgresql.dsn())
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'divisor.sqlite')
+            db = connect('sqlite', path)
+            db.initialize_schema()
+            db.connection.close()
+            summary = populate_and_run(path)
+
+    print_summary(summary)
+    if args.output_path:
+        with open(args.output_path, 'w') as outfile:
+            json.dump(
+                dict(settings=dict(
+                    backend=args.backend,
+                    finished_blocks=args.finished_blocks,
+                    eligible_blocks=args.eligible_blocks,
+                    **settings),
+                    summary=summary),
+                outfile, indent=2, sort_keys=True)
@@ -6,7 +6,8 @@ tracemalloc.start()
 
 search_strategy = SuperabundantSearchStrategy().starting_from(
     SuperabundantEnumerationIndex(71, 196047))
-batch = search_strategy.next_batch(250000)
+block = search_strategy.generate_next_block(250000)
+divisor_sums = search_strategy.process_block(block)
 
 snapshot = tracemalloc.take_snapshot()
 top_stats = snapshot.statistics('lineno')
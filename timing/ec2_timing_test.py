@@ -9,14 +9,19 @@ db = PostgresDivisorDb(data_source_name='')
 samples = 5
 search_strategy = SuperabundantSearchStrategy().starting_from(
     SuperabundantEnumerationIndex(71, 196047))
-batch = search_strategy.next_batch(250000)
 
-def run_test(batch):
+
+def run_test():
     times = []
     for i in range(samples):
+        # each sample stores a new block, since stored blocks are unique
+        block = search_strategy.generate_next_block(250000)
+        divisor_sums = search_strategy.process_block(block)
         print(f'Running sample {i}')
         start = time.time()
-        db.insert(batch)
+        db.insert_search_blocks([block])
+        metadata = db.claim_next_search_block(block.search_index_type)
+        db.finish_search_block(metadata, divisor_sums)
         end = time.time()
         print(end - start)
         times.append(end - start)
@@ -24,7 +29,7 @@ def run_test(batch):
     return sum(times) / samples
 
 
-print(run_test(batch))
+print(run_test())
 
 print("------- cprofile -------")
-cProfile.runctx('run_test(batch)', globals(), locals())
+cProfile.runctx('run_test()', globals(), locals())
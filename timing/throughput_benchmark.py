@@ -0,0 +1,372 @@
+'''
+An end-to-end throughput benchmark of the search, against a throwaway
+database.
+
+A generator and a number of process_search_blocks workers run against a fresh
+database for a fixed duration, as in test/end_to_end_test.py. A backlog of
+blocks is generated before the clock starts, and the generator keeps it
+topped up, so that the workers are not limited by how often the generator
+refreshes. The benchmark reports the blocks and divisor sums finished per second, the
+latency percentiles of claiming and finishing blocks, the share of claims
+that found the queue empty, and the share of CPU time spent in the
+database, e.g.,
+
+    python -m timing.throughput_benchmark --backend=postgres --workers=8 \
+        --block_size=10000 --duration_seconds=120
+
+The postgres backend starts a temporary server with testing.postgresql, and
+the sqlite backend uses a file in a temporary directory. The database CPU
+share is only measured for postgres, since sqlite runs inside the workers.
+'''
+from argparse import Namespace
+from contextlib import redirect_stdout
+from dataclasses import dataclass
+from dataclasses import field
+from multiprocessing import Barrier
+from multiprocessing import Process
+from multiprocessing import Queue
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Union
+import json
+import os
+import tempfile
+import time
+
+from riemann import generate_search_blocks
+from riemann.generate_search_blocks import refresh_search_blocks
+from riemann.database import DivisorDb
+from riemann.postgres_database import PostgresDivisorDb
+from riemann.process_search_blocks import claim_and_compute_one_block
+from riemann.search_strategy import search_strategy_by_name
+from riemann.sqlite_database import SqliteDivisorDb
+from riemann.types import SearchBlockState
+
+BACKENDS = ['postgres', 'sqlite']
+PERCENTILES = [50, 90, 99]
+
+
+@dataclass
+class WorkerStats:
+    blocks: int = 0
+    divisor_sums: int = 0
+    # claims that found no block to claim, and other failed attempts
+    empty_claims: int = 0
+    errors: int = 0
+    cpu_seconds: float = 0
+    claim_seconds: List[float] = field(default_factory=list)
+    finish_seconds: List[float] = field(default_factory=list)
+
+
+def connect(backend: str,
+            location: Any) -> Union[PostgresDivisorDb, SqliteDivisorDb]:
+    '''
+    Connect to the benchmark database, where location is the postgres dsn
+    dict or the sqlite path.
+    '''
+    if backend == 'postgres':
+        return PostgresDivisorDb(data_source_dict=location)
+    return SqliteDivisorDb(location)
+
+
+def time_calls(db: DivisorDb,
+               method_name: str,
+               latencies: List[float],
+               on_call: Optional[Callable[..., None]] = None) -> None:
+    '''
+    Record the seconds taken by each successful call of db's method in
+    latencies, calling on_call with the call's arguments.
+    '''
+    method = getattr(db, method_name)
+
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        result = method(*args, **kwargs)
+        latencies.append(time.perf_counter() - start)
+        if on_call is not None:
+            on_call(*args, **kwargs)
+        return result
+
+    setattr(db, method_name, timed)
+
+
+def cpu_seconds() -> float:
+    times = os.times()
+    return times.user + times.system
+
+
+def run_worker(backend: str,
+               location: Any,
+               search_strategy_name: str,
+               duration_seconds: float,
+               barrier: Any,
+               results: Queue) -> None:
+    '''
+    Claim and compute blocks for duration_seconds after all workers are
+    ready, and put the worker's stats in results.
+    '''
+    db = connect(backend, location)
+    search_strategy = search_strategy_by_name(search_strategy_name)()
+    stats = WorkerStats()
+
+    def count_finished(metadata, divisor_sums):
+        stats.blocks += 1
+        stats.divisor_sums += len(divisor_sums)
+
+    time_calls(db, 'claim_next_search_block', stats.claim_seconds)
+    time_calls(db, 'finish_search_block', stats.finish_seconds,
+               on_call=count_finished)
+
+    # compile the numba functions before the clock starts
+    search_strategy.process_block(
+        search_strategy.generate_search_blocks(count=1, batch_size=10)[0])
+    barrier.wait()
+    start_cpu = cpu_seconds()
+    deadline = time.time() + duration_seconds
+
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        while time.time() < deadline:
+            try:
+                claim_and_compute_one_block(db, search_strategy)
+            except ValueError:
+                stats.empty_claims += 1
+                time.sleep(0.1)
+            except Exception:
+                stats.errors += 1
+
+    stats.cpu_seconds = cpu_seconds() - start_cpu
+    db.connection.close()
+    results.put(stats)
+
+
+def run_generator(backend: str,
+                  location: Any,
+                  search_strategy_name: str,
+                  args: Namespace) -> None:
+    db = connect(backend, location)
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        generate_search_blocks.main(
+            db, search_strategy_by_name(search_strategy_name)(), args=args)
+
+
+def postgres_cpu_seconds(postmaster_pid: int) -> float:
+    '''
+    The CPU time used by a postgres server, including its exited backends,
+    which the postmaster has waited for, and its running processes.
+    '''
+    ticks_per_second = os.sysconf('SC_CLK_TCK')
+    total_ticks = 0
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f'/proc/{pid}/stat') as infile:
+                stat = infile.read()
+        except OSError:
+            continue
+        # the command name is parenthesized and may contain spaces
+        fields = stat[stat.rindex(')') + 2:].split()
+        (ppid, utime, stime, cutime, cstime) = (
+            int(fields[1]), int(fields[11]), int(fields[12]),
+            int(fields[13]), int(fields[14]))
+        if int(pid) == postmaster_pid:
+            total_ticks += utime + stime + cutime + cstime
+        elif ppid == postmaster_pid:
+            total_ticks += utime + stime
+    return total_ticks / ticks_per_second
+
+
+def percentiles(seconds: List[float]) -> Dict[str, Optional[float]]:
+    if not seconds:
+        return {f'p{p}': None for p in PERCENTILES + [100]}
+    ordered = sorted(seconds)
+    return {
+        f'p{p}': ordered[min(len(ordered) - 1, len(ordered) * p // 100)]
+        for p in PERCENTILES + [100]
+    }
+
+
+def summarize(stats: List[WorkerStats],
+              elapsed_seconds: float,
+              db_cpu_seconds: Optional[float],
+              finished_blocks: int) -> Dict[str, Any]:
+    claim_seconds = [s for w in stats for s in w.claim_seconds]
+    finish_seconds = [s for w in stats for s in w.finish_seconds]
+    worker_cpu_seconds = sum(w.cpu_seconds for w in stats)
+    empty_claims = sum(w.empty_claims for w in stats)
+    db_cpu_share = None
+    if db_cpu_seconds is not None and db_cpu_seconds + worker_cpu_seconds:
+        db_cpu_share = db_cpu_seconds / (db_cpu_seconds + worker_cpu_seconds)
+    return dict(
+        elapsed_seconds=elapsed_seconds,
+        blocks=sum(w.blocks for w in stats),
+        finished_blocks_in_db=finished_blocks,
+        blocks_per_second=sum(w.blocks for w in stats) / elapsed_seconds,
+        divisor_sums_per_second=(
+            sum(w.divisor_sums for w in stats) / elapsed_seconds),
+        empty_claims=empty_claims,
+        # a large share means the workers were starved of blocks, and the
+        # throughput is a measure of the generator instead
+        starved_claim_share=(
+            empty_claims / (empty_claims + len(claim_seconds))
+            if empty_claims + len(claim_seconds) else None),
+        errors=sum(w.errors for w in stats),
+        claim_latency_seconds=percentiles(claim_seconds),
+        finish_latency_seconds=percentiles(finish_seconds),
+        worker_cpu_seconds=worker_cpu_seconds,
+        db_cpu_seconds=db_cpu_seconds,
+        db_cpu_share=db_cpu_share,
+    )
+
+
+def run_benchmark(backend: str,
+                  location: Any,
+                  workers: int,
+                  block_size: int,
+                  duration_seconds: float,
+                  search_strategy_name: str = 'SuperabundantSearchStrategy',
+                  backlog_blocks: int = 1000,
+                  postmaster_pid: Optional[int] = None) -> Dict[str, Any]:
+    '''
+    Generate backlog_blocks blocks in an initialized, empty database, then
+    run the generator and workers against it, and summarize their
+    throughput and latencies.
+    '''
+    db = connect(backend, location)
+    generate_start = time.time()
+    refresh_search_blocks(
+        db,
+        search_strategy_by_name(search_strategy_name)(),
+        Namespace(
+            refresh_count=backlog_blocks,
+            refresh_threshold=1,
+            block_size=block_size,
+            target_block_seconds=None,
+        ))
+    # a connection left open across fork loses the workers' writes
+    db.connection.close()
+    print(f"Generated {backlog_blocks} blocks "
+          f"in {time.time() - generate_start:.1f}s")
+
+    # refill half the backlog whenever half of it has been claimed
+    generator_args = Namespace(
+        refresh_count=max(1, backlog_blocks // 2),
+        refresh_threshold=max(1, backlog_blocks // 2),
+        block_size=block_size,
+        refresh_period_seconds=1,
+        target_block_seconds=None,
+    )
+    generator = Process(
+        target=run_generator,
+        args=(backend, location, search_strategy_name, generator_args))
+    generator.start()
+
+    barrier = Barrier(workers + 1)
+    results: Queue = Queue()
+    processes = [
+        Process(target=run_worker,
+                args=(backend, location, search_strategy_name,
+                      duration_seconds, barrier, results))
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    barrier.wait()
+    start_db_cpu = None
+    if postmaster_pid is not None:
+        start_db_cpu = postgres_cpu_seconds(postmaster_pid)
+    start = time.time()
+    # the workers must be drained before joining, or a full queue blocks them
+    stats = [results.get() for _ in processes]
+    elapsed_seconds = time.time() - start
+    for process in processes:
+        process.join()
+    generator.terminate()
+    generator.join()
+
+    db_cpu_seconds = None
+    if postmaster_pid is not None and start_db_cpu is not None:
+        # wait for the closed connections' backends to exit
+        time.sleep(1)
+        db_cpu_seconds = postgres_cpu_seconds(postmaster_pid) - start_db_cpu
+
+    db = connect(backend, location)
+    finished_blocks = sum(
+        1 for block in db.load_metadata()
+        if block.state == SearchBlockState.FINISHED)
+    db.connection.close()
+    return summarize(stats, elapsed_seconds, db_cpu_seconds, finished_blocks)
+
+
+def print_summary(summary: Dict[str, Any]) -> None:
+    for (name, value) in summary.items():
+        if isinstance(value, dict):
+            value = ', '.join(
+                f'{k}={v:.4f}' if v is not None else f'{k}=None'
+                for (k, v) in value.items())
+        elif isinstance(value, float):
+            value = f'{value:.4f}'
+        print(f'{name}: {value}')
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Measure the throughput of the search end to end')
+    parser.add_argument('--backend', type=str, choices=BACKENDS,
+                        default='postgres', help='The database to run against')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='The number of process_search_blocks workers')
+    parser.add_argument('--block_size', type=int, default=10000,
+                        help='The size of the generated search blocks')
+    parser.add_argument('--duration_seconds', type=float, default=60,
+                        help='How long to run the workers for')
+    parser.add_argument('--backlog_blocks', type=int, default=1000,
+                        help='The number of blocks to generate before the '
+                             'clock starts, which should be more than the '
+                             'workers can finish in --duration_seconds')
+    parser.add_argument('--search_strategy_name', type=str,
+                        choices=['ExhaustiveSearchStrategy',
+                                 'SuperabundantSearchStrategy'],
+                        default='SuperabundantSearchStrategy',
+                        help='The search strategy name')
+    parser.add_argument('--output_path', type=str, default=None,
+                        help='If set, write the summary as JSON to this file')
+    args = parser.parse_args()
+
+    settings = dict(
+        backend=args.backend,
+        workers=args.workers,
+        block_size=args.block_size,
+        duration_seconds=args.duration_seconds,
+        search_strategy_name=args.search_strategy_name,
+        backlog_blocks=args.backlog_blocks,
+    )
+    if args.backend == 'postgres':
+        import testing.postgresql
+        with testing.postgresql.Postgresql() as postgresql:
+            db = connect('postgres', postgresql.dsn())
+            db.initialize_schema()
+            db.connection.close()
+            summary = run_benchmark(
+                location=postgresql.dsn(),
+                postmaster_pid=postgresql.child_process.pid,
+                **settings)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'divisor.sqlite')
+            db = connect('sqlite', path)
+            db.initialize_schema()
+            # a connection left open across fork loses the workers' writes
+            db.connection.close()
+            summary = run_benchmark(location=path, **settings)
+
+    print_summary(summary)
+    if args.output_path:
+        with open(args.output_path, 'w') as outfile:
+            json.dump(dict(settings=settings, summary=summary), outfile,
+                      indent=2, sort_keys=True)